@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+import argparse
+import logging
+import random
+import time
+import bson
+from ovm import environment
+from ovm.mongoconnection import get_mongo_client
+from ovm.mongostatestore import MongoStateStore
+from ovm.snapshotcodec import KEYFRAME_FIELD, SnapshotDecoder, SnapshotEncoder
+from ovm.statepartitions import StatePartitions
+from ovm.statereader import StateReader
+
+
+def generate_snapshots(snapshots: int, planes: int, cached: float, seed: int):
+    """
+    Generates snapshots of planes moving around, a share of the planes keeps its cached position every tick like
+    flightradar24 does and planes enter and leave the area
+    """
+    rng = random.Random(seed)
+    next_id = 0
+
+    def new_plane():
+        nonlocal next_id
+        next_id += 1
+        return {'longitude': rng.uniform(3.5, 7.5),
+                'latitude': rng.uniform(51.0, 53.5),
+                'callsign': 'BM%05i' % next_id,
+                'geo_altitude': rng.choice([300.0, 1200.0, 3000.0, 9000.0, 11000.0]),
+                'icao24': rng.choice(['KLM', 'TRA', 'EZY', 'RYR'])}
+
+    current = [new_plane() for _ in range(planes)]
+    for idx in range(snapshots):
+        states = []
+        for state in current:
+            if rng.random() < 0.002:
+                states.append(new_plane())
+            elif rng.random() < cached:
+                states.append(state)
+            else:
+                state = dict(state)
+                state['longitude'] += rng.uniform(-0.01, 0.01)
+                state['latitude'] += rng.uniform(-0.01, 0.01)
+                states.append(state)
+        current = states
+        yield 20230101000000 + idx, states
+
+
+def scan_memory(documents: list):
+    decoder = SnapshotDecoder()
+    count = 0
+    for data in documents:
+        states = decoder.decode(bson.decode(data))
+        count += len(states)
+    return count
+
+
+def scan_collection(database, name: str):
+    count = 0
+    for _, states in StateReader(MongoStateStore(StatePartitions(database, name, partition_by_day=False))).scan(0):
+        count += len(states)
+    return count
+
+
+if __name__ == '__main__':
+    # parse cli arguments
+    parser = argparse.ArgumentParser(description='Compares size and scan speed of full snapshots with keyframes and '
+                                                 'deltas')
+    parser.add_argument('-n', '--snapshots',
+                        type=int,
+                        default=8640,
+                        help='Amount of snapshots, default is a day at a 10 second interval')
+    parser.add_argument('-p', '--planes',
+                        type=int,
+                        default=300,
+                        help='Amount of planes per snapshot')
+    parser.add_argument('-c', '--cached',
+                        type=float,
+                        default=0.5,
+                        help='Share of planes keeping their position between snapshots')
+    parser.add_argument('-k', '--keyframe-interval',
+                        type=int,
+                        default=30,
+                        help='Every n-th snapshot is a keyframe')
+    parser.add_argument('-m', '--mongo',
+                        action=argparse.BooleanOptionalAction,
+                        help='Scan from MongoDB configured in environment.json instead of from memory, uses and drops '
+                             'collections benchmark_full and benchmark_delta')
+    parser.add_argument('-l', '--loglevel',
+                        type=str.upper,
+                        default='INFO',
+                        help='LOG Level (DEBUG, INFO, WARNING, ERROR, CRITICAL)')
+    args = parser.parse_args()
+
+    # Set log level
+    logging.basicConfig(level=args.loglevel)
+
+    # Encode snapshots in both formats
+    encoder = SnapshotEncoder(keyframe_interval=args.keyframe_interval)
+    full_documents = []
+    delta_documents = []
+    for key, states in generate_snapshots(args.snapshots, args.planes, args.cached, seed=1):
+        full_documents.append({'Time': key, KEYFRAME_FIELD: states})
+        name, value = encoder.encode(states, key)
+        delta_documents.append({'Time': key, name: value})
+    stats = encoder.get_stats()
+    logging.info('Full snapshots: %i bytes, keyframes and deltas: %i bytes, compression ratio %.2f' %
+                 (stats['raw_bytes'], stats['encoded_bytes'], stats['compression_ratio']))
+
+    if args.mongo:
+        env = environment.load_environment('environment.json')
+        database = get_mongo_client(env.mongodb_config)[env.mongodb_config.database]
+        collections = []
+        for name, documents in (('benchmark_full', full_documents), ('benchmark_delta', delta_documents)):
+            collection = database[name]
+            collection.drop()
+            collection.insert_many(documents)
+            collections.append(collection)
+        scans = [('full', lambda: scan_collection(database, 'benchmark_full')),
+                 ('delta', lambda: scan_collection(database, 'benchmark_delta'))]
+    else:
+        full_encoded = [bson.encode(document) for document in full_documents]
+        delta_encoded = [bson.encode(document) for document in delta_documents]
+        scans = [('full', lambda: scan_memory(full_encoded)), ('delta', lambda: scan_memory(delta_encoded))]
+
+    try:
+        for name, scan in scans:
+            begin = time.perf_counter()
+            count = scan()
+            elapsed = time.perf_counter() - begin
+            logging.info('Scan %s: %i snapshots, %i states in %f seconds, %.0f snapshots per second' %
+                         (name, args.snapshots, count, elapsed, args.snapshots / elapsed))
+    finally:
+        if args.mongo:
+            for collection in collections:
+                collection.drop()
+
+    exit(0)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+import argparse
+import logging
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+import geopy.distance
+from benchmark_snapshots import generate_snapshots
+from ovm import environment
+from ovm.mongoconnection import get_mongo_client
+from ovm.mongostatestore import MongoStateStore
+from ovm.sqlitestatestore import SqliteStateStore
+from ovm.statepartitions import StatePartitions
+from ovm.statereader import StateReader
+from ovm.utils import convert_datetime_to_int, get_geo_bbox_around_coord
+
+
+def get_snapshots(args):
+    """
+    Returns the generated snapshots keyed by Time at the log interval
+    """
+    begin = datetime(2023, 1, 1)
+    return [(convert_datetime_to_int(begin + timedelta(seconds=idx * args.interval)), states)
+            for idx, (_, states) in enumerate(generate_snapshots(args.snapshots, args.planes, args.cached, seed=1))]
+
+
+def find_states(reader: StateReader, begin: int, end: int, origin: tuple, radius: int, altitude: int):
+    """
+    Counts the states within radius around origin and below altitude like the FlightInfoFinder does
+    """
+    count = 0
+    bbox = get_geo_bbox_around_coord(origin, radius * 1.01 / 1000.0)
+    for _, states in reader.scan(begin, end, bbox=bbox, max_altitude=altitude):
+        for state in states:
+            if state['geo_altitude'] is not None and state['geo_altitude'] < altitude and \
+                    geopy.distance.great_circle(origin, (state['latitude'], state['longitude'])).meters < radius:
+                count += 1
+    return count
+
+
+def run(name: str, store, snapshots: list, args):
+    # Write in batches like the StateWriter does
+    begin = time.perf_counter()
+    for idx in range(0, len(snapshots), args.batch_size):
+        store.write(snapshots[idx:idx + args.batch_size])
+    elapsed = time.perf_counter() - begin
+    logging.info('%s write: %i snapshots in %f seconds, %.0f snapshots per second' %
+                 (name, len(snapshots), elapsed, len(snapshots) / elapsed))
+
+    reader = StateReader(store)
+    first = snapshots[0][0]
+    last = snapshots[-1][0]
+
+    begin = time.perf_counter()
+    count = sum(len(states) for _, states in reader.scan(first, last))
+    elapsed = time.perf_counter() - begin
+    logging.info('%s scan: %i states in %f seconds' % (name, count, elapsed))
+
+    begin = time.perf_counter()
+    count = find_states(reader, first, last, (args.lat, args.lon), args.radius, args.altitude)
+    elapsed = time.perf_counter() - begin
+    logging.info('%s radius and altitude query: %i states in %f seconds' % (name, count, elapsed))
+
+    begin = time.perf_counter()
+    for idx in range(0, len(snapshots), max(1, len(snapshots) // 100)):
+        reader.scan_before(snapshots[idx][0], 15)
+        reader.scan_after(snapshots[idx][0], 15)
+    elapsed = time.perf_counter() - begin
+    logging.info('%s neighbour scans: 100 lookups in %f seconds' % (name, elapsed))
+
+
+if __name__ == '__main__':
+    # parse cli arguments
+    parser = argparse.ArgumentParser(description='Compares writing and querying the SQLite and MongoDB state stores on '
+                                                 'generated snapshots')
+    parser.add_argument('-n', '--snapshots',
+                        type=int,
+                        default=8640,
+                        help='Amount of snapshots, default is a day at a 10 second interval')
+    parser.add_argument('-i', '--interval',
+                        type=int,
+                        default=10,
+                        help='Seconds between snapshots')
+    parser.add_argument('-p', '--planes',
+                        type=int,
+                        default=300,
+                        help='Amount of planes per snapshot')
+    parser.add_argument('-c', '--cached',
+                        type=float,
+                        default=0.5,
+                        help='Share of planes keeping their position between snapshots')
+    parser.add_argument('-b', '--batch-size',
+                        type=int,
+                        default=16,
+                        help='Amount of snapshots per write')
+    parser.add_argument('--lat',
+                        type=float,
+                        default=52.1,
+                        help='Latitude of the radius query')
+    parser.add_argument('--lon',
+                        type=float,
+                        default=5.6,
+                        help='Longitude of the radius query')
+    parser.add_argument('-r', '--radius',
+                        type=int,
+                        default=10000,
+                        help='Radius of the radius query in meters')
+    parser.add_argument('-a', '--altitude',
+                        type=int,
+                        default=3000,
+                        help='Altitude of the radius query in meters')
+    parser.add_argument('-m', '--mongo',
+                        action=argparse.BooleanOptionalAction,
+                        help='Include MongoDB configured in environment.json, uses and drops collection '
+                             'benchmark_states')
+    parser.add_argument('-l', '--loglevel',
+                        type=str.upper,
+                        default='INFO',
+                        help='LOG Level (DEBUG, INFO, WARNING, ERROR, CRITICAL)')
+    args = parser.parse_args()
+
+    # Set log level
+    logging.basicConfig(level=args.loglevel)
+
+    snapshots = get_snapshots(args)
+
+    with tempfile.TemporaryDirectory() as directory:
+        sqlite_store = SqliteStateStore(os.path.join(directory, 'benchmark.sqlite'))
+        run('sqlite', sqlite_store, snapshots, args)
+        sqlite_store.close()
+
+    if args.mongo:
+        env = environment.load_environment('environment.json')
+        database = get_mongo_client(env.mongodb_config)[env.mongodb_config.database]
+        database.drop_collection('benchmark_states')
+        try:
+            run('mongodb', MongoStateStore(StatePartitions(database, 'benchmark_states', partition_by_day=False)),
+                snapshots, args)
+        finally:
+            database.drop_collection('benchmark_states')
+
+    exit(0)
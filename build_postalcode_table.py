@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+import argparse
+import logging
+from flaskr import environment
+from flaskr.utils.postalcodetable import PostalCodeTable
+
+if __name__ == '__main__':
+    # parse cli arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('csv',
+                        type=str,
+                        help='CSV file holding postal codes (PC4 and/or PC6) and their centroids')
+    parser.add_argument('-o', '--output',
+                        type=str,
+                        default=environment.POSTALCODE_TABLE_FILE,
+                        help='Postal code table output filename')
+    parser.add_argument('--postalcode-column',
+                        type=str,
+                        default='postalcode',
+                        help='Name of the postal code column')
+    parser.add_argument('--lat-column',
+                        type=str,
+                        default='lat',
+                        help='Name of the latitude column')
+    parser.add_argument('--lon-column',
+                        type=str,
+                        default='lon',
+                        help='Name of the longitude column')
+    parser.add_argument('-d', '--delimiter',
+                        type=str,
+                        default=',',
+                        help='CSV delimiter')
+    parser.add_argument('-l', '--loglevel',
+                        type=str.upper,
+                        default='INFO',
+                        help='LOG Level (DEBUG, INFO, WARNING, ERROR, CRITICAL)')
+    args = parser.parse_args()
+
+    # Set log level
+    logging.basicConfig(level=args.loglevel)
+
+    # Build table
+    written, skipped = PostalCodeTable.build(args.csv,
+                                             args.output,
+                                             postalcode_column=args.postalcode_column,
+                                             lat_column=args.lat_column,
+                                             lon_column=args.lon_column,
+                                             delimiter=args.delimiter)
+    logging.info('Wrote %i postal codes to %s, skipped %i rows' % (written, args.output, skipped))
+
+    # Exit gracefully
+    exit(0)
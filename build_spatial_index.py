@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+import argparse
+import logging
+import time
+from ovm import environment
+from ovm.statestore import get_state_store
+
+if __name__ == '__main__':
+    # parse cli arguments
+    parser = argparse.ArgumentParser(description='Creates the position index collections and indexes positions of '
+                                                 'states stored before the index was enabled, requires spatial_index '
+                                                 'in environment.json')
+    parser.add_argument('-b', '--batch-size',
+                        type=int,
+                        default=1000,
+                        help='Amount of snapshots per write')
+    parser.add_argument('-l', '--loglevel',
+                        type=str.upper,
+                        default='INFO',
+                        help='LOG Level (DEBUG, INFO, WARNING, ERROR, CRITICAL)')
+    args = parser.parse_args()
+
+    # Set log level
+    logging.basicConfig(level=args.loglevel)
+
+    # Load environment
+    environment = environment.load_environment('environment.json')
+    if environment.state_store.backend != 'mongodb' or not environment.mongodb_config.spatial_index:
+        raise Exception('The position index requires the mongodb state store and spatial_index')
+    store = get_state_store(environment)
+
+    # Create indexes and backfill
+    begin = time.perf_counter()
+    store.create_indexes()
+    count = store.backfill_positions(batch_size=args.batch_size)
+    logging.info('Indexed positions of %i snapshots in %f seconds' % (count, time.perf_counter() - begin))
+
+    exit(0)
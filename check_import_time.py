@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import logging
+import subprocess
+import sys
+
+"""
+Import time budgets in milliseconds of the entry points, every entry point runs in its own fresh interpreter
+"""
+IMPORT_BUDGETS_MS = {'flaskr.api': 750,
+                     'logger': 500,
+                     'disturbancecheck': 500}
+
+"""
+Heavy modules the entry points must not import, they are loaded on first use
+"""
+LAZY_MODULES = ('matplotlib', 'pandas', 'geopandas', 'shapely', 'pyproj', 'contextily', 'pyarrow')
+
+# Imports the module and reports the heavy modules it loaded and the peak RSS of the interpreter
+PROBE = '''
+import json, resource, sys
+import %s
+print(json.dumps({'loaded': [name for name in %r if name in sys.modules],
+                  'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))
+'''
+
+
+def measure_import(module: str):
+    """
+    Imports module in a new interpreter using -X importtime
+    :param module: name of the module
+    :return: cumulative import time in milliseconds, loaded heavy modules and peak RSS in kilobytes
+    """
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', PROBE % (module, LAZY_MODULES)],
+                             capture_output=True,
+                             text=True)
+    if process.returncode != 0:
+        raise Exception('Importing %s failed: %s' % (module, process.stderr.strip().splitlines()[-1:]))
+
+    # The last line of the module itself holds its cumulative time in microseconds
+    cumulative_us = 0
+    for line in process.stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == module:
+            cumulative_us = int(fields[1])
+    probe = json.loads(process.stdout.strip().splitlines()[-1])
+    return cumulative_us / 1000, probe['loaded'], probe['max_rss_kb']
+
+
+if __name__ == '__main__':
+    # parse cli arguments
+    parser = argparse.ArgumentParser(description='Measures the import time of the API, logger.py and '
+                                                 'disturbancecheck.py and checks them against their budgets, exits '
+                                                 'with 1 when a budget is exceeded or a heavy module is imported')
+    parser.add_argument('-r', '--runs',
+                        type=int,
+                        default=3,
+                        help='Imports per module, the fastest one is checked')
+    parser.add_argument('-s', '--scale',
+                        type=float,
+                        default=1.0,
+                        help='Multiplies the budgets, for slower machines')
+    parser.add_argument('-l', '--loglevel',
+                        type=str.upper,
+                        default='INFO',
+                        help='LOG Level (DEBUG, INFO, WARNING, ERROR, CRITICAL)')
+    args = parser.parse_args()
+
+    # Set log level
+    logging.basicConfig(level=args.loglevel)
+
+    violations = 0
+    for module, budget in IMPORT_BUDGETS_MS.items():
+        results = [measure_import(module) for _ in range(max(1, args.runs))]
+        milliseconds, loaded, max_rss_kb = min(results, key=lambda result: result[0])
+        budget *= args.scale
+        logging.info('%s imports in %.0f ms of %.0f ms budget, peak RSS %.1f MB' %
+                     (module, milliseconds, budget, max_rss_kb / 1024))
+        if milliseconds > budget:
+            logging.error('%s exceeds its import time budget' % module)
+            violations += 1
+        if len(loaded) > 0:
+            logging.error('%s imports %s, load them on first use' % (module, ', '.join(loaded)))
+            violations += 1
+
+    exit(1 if violations > 0 else 0)
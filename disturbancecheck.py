@@ -5,6 +5,8 @@ from datetime import datetime, timedelta
 import logging
 from ovm import environment
 from ovm.flightinfofinder import FlightInfoFinder
+from ovm.memory import get_peak_rss_bytes
+from ovm.metrics import get_stages
 
 if __name__ == '__main__':
     # parse cli arguments
@@ -20,6 +22,10 @@ if __name__ == '__main__':
                         type=int,
                         default=14,
                         help='Zoom level of contextly maps')
+    parser.add_argument('--maxgap',
+                        type=float,
+                        help='Seconds a plane may be missing from the snapshots before its trajectory ends, '
+                             'defaults to the gap of the default ingest policy, see the startup log of logger.py')
     args = parser.parse_args()
 
     # Set log level
@@ -31,7 +37,7 @@ if __name__ == '__main__':
     # Find all disturbances
     user = 'John Doe'
     now = datetime.now()
-    disturbance_finder: FlightInfoFinder = FlightInfoFinder(environment)
+    disturbance_finder: FlightInfoFinder = FlightInfoFinder(environment, max_trajectory_gap=args.maxgap)
     disturbances = disturbance_finder.find_disturbances(begin=now - timedelta(hours=24),
                                                         end=now,
                                                         zoomlevel=args.zoomlevel,
@@ -43,6 +49,9 @@ if __name__ == '__main__':
                                                         timeframe=60)
     elapsed = datetime.now() - now
     logging.info('Operation took %f seconds' % elapsed.seconds)
+    for stage, seconds in sorted(get_stages().take().items()):
+        logging.info('Stage %s took %f seconds' % (stage, seconds))
+    logging.info('Peak resident memory %.1f MB' % (get_peak_rss_bytes() / (1024 * 1024)))
 
     # Write plots to disk
     if args.plot:
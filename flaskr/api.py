@@ -1,17 +1,46 @@
+import hmac
+import json
+import logging
+import math
 import multiprocessing
 import os.path
+import queue
+import resource
+import signal
+import threading
+import time
 from datetime import timedelta
 from multiprocessing import Process
 import requests
 from flasgger import swag_from
-from flask import Blueprint, request
+from flask import Blueprint, Response, request, send_file
 from flask_cors import cross_origin
 
 import flaskr.environment
+from flaskr.utils.admission import AdmissionController
+from flaskr.utils.encoders import TABLE_DISTURBANCES, TABLE_TRAJECTORY, encode_response, negotiate
+from flaskr.utils.geocoder import Geocoder
+from flaskr.utils.jobstore import FINAL_JOB_STATES, get_job_store
 from flaskr.utils.latloncache import LatLonCache
-from ovm.flightinfofinder import FlightInfoFinder
+from flaskr.utils.postalcodetable import PostalCodeTable
+from flaskr.utils.profilestore import get_profile_store
+from flaskr.utils.querycoalescer import QueryCoalescer
+from flaskr.utils.resulttransport import SpooledResult, create_result_path, get_spool_dir, write_result, send_result, \
+    remove_result
+from ovm.coldstorage import get_cold_storage
+from ovm.disturbanceperiod import DisturbancePeriod
+from ovm.flightinfofinder import FlightInfoFinder, OUTPUT_FORMATS
 from ovm.environment import load_environment
-from ovm.utils import convert_int_to_datetime
+from ovm.geojson import trajectory_to_feature
+from ovm.ingestpolicy import IngestPolicy
+from ovm.memory import get_memory_ceiling, get_peak_rss_bytes, trace_memory
+from ovm.metrics import MEMORY_BUCKETS, get_metrics, get_stages
+from ovm.mongoconnection import get_pool_stats
+from ovm.sharedscan import ScanSubscription, SharedScan
+from ovm.statereader import StateReader
+from ovm.statestore import get_state_store
+from ovm.trajectory import MIN_RESAMPLE_SECONDS, MIN_SIMPLIFY_METERS, Trajectory, TrajectoryProcessor
+from ovm.utils import convert_int_to_datetime, dataclass_to_dict
 
 # Create api page
 api_page = Blueprint('api', __name__, template_folder='templates')
@@ -23,6 +52,73 @@ environment = load_environment('environment.json')
 latlon_cache = LatLonCache(environment=environment,
                            expire_days=flaskr.environment.LATLON_CACHE_EXPIRATION_DAYS)
 
+# Get offline postal code centroid table
+postalcode_table = PostalCodeTable(flaskr.environment.POSTALCODE_TABLE_FILE)
+
+# Get geocoder, in-process cache and request coalescing in front of the latlon cache and pro6pp
+geocoder = Geocoder(max_size=flaskr.environment.GEOCODER_CACHE_SIZE,
+                    ttl=flaskr.environment.GEOCODER_CACHE_TTL_SECONDS)
+
+# Get query coalescer, concurrent find_flights and find_disturbances calls overlapping in time share a single scan
+query_coalescer = QueryCoalescer(execute_group=lambda queries: coalesced_task(queries),
+                                 window=flaskr.environment.QUERY_COALESCING_WINDOW_SECONDS,
+                                 max_queries=flaskr.environment.QUERY_COALESCING_MAX_QUERIES)
+
+# Get job store, status and results of jobs are shared between web processes through the filesystem
+job_store = get_job_store()
+
+# Get admission controller, limits the amount of running cheap and expensive calls of all web processes together
+admission_controller = AdmissionController(
+    directory=flaskr.environment.ADMISSION_DIR if flaskr.environment.ADMISSION_DIR is not None else
+    os.path.join(get_spool_dir(flaskr.environment.RESULT_SPOOL_DIR), 'omd_admission'),
+    limits={'cheap': (flaskr.environment.ADMISSION_CHEAP_MAX_RUNNING,
+                      flaskr.environment.ADMISSION_CHEAP_MAX_WAITING,
+                      flaskr.environment.ADMISSION_CHEAP_MAX_QUEUED_JOBS),
+            'expensive': (flaskr.environment.ADMISSION_EXPENSIVE_MAX_RUNNING,
+                          flaskr.environment.ADMISSION_EXPENSIVE_MAX_WAITING,
+                          flaskr.environment.ADMISSION_EXPENSIVE_MAX_QUEUED_JOBS)},
+    max_wait=flaskr.environment.ADMISSION_MAX_WAIT_SECONDS)
+
+# Get profile store, profiles of API calls requested by admins are written by the worker processes
+profile_store = get_profile_store()
+
+# Held while the raster plotting stack is imported by warm_plotter, worker processes are not forked meanwhile
+plotter_import_lock = threading.Lock()
+
+# Share metrics of all web and worker processes, see /metrics
+get_metrics().configure(flaskr.environment.METRICS_DIR if flaskr.environment.METRICS_DIR is not None else
+                        os.path.join(get_spool_dir(flaskr.environment.RESULT_SPOOL_DIR), 'omd_metrics'))
+for admission_class_name, admission_class_limits in admission_controller.get_stats().items():
+    get_metrics().set('omd_worker_capacity', admission_class_limits['max_running'],
+                      labels={'class': admission_class_name})
+get_metrics().flush()
+
+
+# Seconds between status reads of a job event stream
+JOB_EVENTS_POLL_SECONDS = 0.5
+
+# Milliseconds a client waits before reconnecting to a job event stream that ended
+JOB_EVENTS_RETRY_MS = 500
+
+# Seconds between admission attempts of a queued job
+JOB_ADMISSION_POLL_SECONDS = 0.1
+
+# Seconds a worker gets on top of its time budget to report the exceeded budget itself before it is killed
+WORKER_GRACE_SECONDS = 10
+
+# Seconds a plane may be missing from the snapshots around a flight before its trajectory ends
+if flaskr.environment.TRAJECTORY_MAX_GAP_SECONDS is not None:
+    TRAJECTORY_MAX_GAP_SECONDS = flaskr.environment.TRAJECTORY_MAX_GAP_SECONDS
+else:
+    TRAJECTORY_MAX_GAP_SECONDS = IngestPolicy(full_rate_altitude=flaskr.environment.PLANELOGGER_FULL_RATE_ALTITUDE,
+                                              tiers=flaskr.environment.PLANELOGGER_ALTITUDE_TIERS,
+                                              min_interval=flaskr.environment.LOG_INTERVAL_SECONDS,
+                                              max_interval=flaskr.environment.LOG_INTERVAL_MAX_SECONDS)\
+        .get_max_gap_seconds()
+
+# Output formats of get_trajectory, it returns coordinates and doesn't plot
+TRAJECTORY_OUTPUT_FORMATS = ('jpg', 'geojson')
+
 
 def get_swag_path(filename: str):
     return os.path.join(os.path.dirname(os.path.realpath(__file__)), filename)
@@ -59,183 +155,718 @@ def find_flights_api():
 @cross_origin()
 def get_trajectory_api():
     """
-    The get_trajectory API call
+    The get_trajectory API call, formats other than TRAJECTORY_OUTPUT_FORMATS get a 400 response
     :return: response data
     """
+    output_format = request.args.get('format', type=str, default='jpg')
+    if output_format not in TRAJECTORY_OUTPUT_FORMATS:
+        return bad_request('format must be one of %s' % ', '.join(TRAJECTORY_OUTPUT_FORMATS))
     return execute(function=get_trajectory_process,
                    args=request.args)
 
 
-def find_disturbances_process(shared_queue, args):
+@api_page.route('/api/stats/geocoder')
+@cross_origin()
+def geocoder_stats_api():
     """
-    Process of finding disturbances, exits on error or completion
-    :param shared_queue: the shared_queue where data will be put
-    :param args: arguments
+    Returns hit, miss and latency statistics of the geocoder of this web process
+    :return: response data
+    """
+    return respond({'value': geocoder.get_stats(),
+                    'status': 'OK'})
+
+
+@api_page.route('/api/stats/mongo')
+@cross_origin()
+def mongo_stats_api():
+    """
+    Returns connection pool statistics of the MongoDB client of this web process
+    :return: response data
+    """
+    return respond({'value': get_pool_stats(),
+                    'status': 'OK'})
+
+
+@api_page.route('/api/stats/ingest')
+@cross_origin()
+def ingest_stats_api():
+    """
+    Returns queue depth, write latency and lag statistics of the plane logger
+    The plane logger runs in a single process, the gunicorn master when preloading, and publishes its statistics
+    after every tick, see Metrics.publish, so every web process serves the same statistics
+    :return: response data
+    """
+    return respond({'value': get_metrics().get_published('ingest') or {},
+                    'status': 'OK'})
+
+
+@api_page.route('/api/stats/coalescer')
+@cross_origin()
+def coalescer_stats_api():
+    """
+    Returns the coalescing factor and group statistics of the query coalescer of this web process
+    :return: response data
+    """
+    return respond({'value': query_coalescer.get_stats(),
+                    'status': 'OK'})
+
+
+@api_page.route('/api/stats/admission')
+@cross_origin()
+def admission_stats_api():
+    """
+    Returns admission, rejection and queue wait statistics of cheap and expensive calls of this web process
+    :return: response data
+    """
+    return respond({'value': admission_controller.get_stats(),
+                    'status': 'OK'})
+
+
+@api_page.route('/metrics')
+def metrics_api():
+    """
+    Returns request latency, stage timing, worker utilisation and ingest metrics of all web and worker processes in the
+    Prometheus text format
+    :return: response data
     """
+    return Response(get_metrics().render(), mimetype='text/plain; version=0.0.4')
+
+
+@api_page.route('/api/profiles')
+@cross_origin()
+def profiles_api():
+    """
+    Returns the stored profiles of API calls and planelogger runs, latest first, requires the admin token
+    :return: response data
+    """
+    if not is_admin():
+        return forbidden()
+    return respond({'value': profile_store.list_profiles(),
+                    'status': 'OK'})
+
+
+@api_page.route('/api/profiles/<profile_id>/<kind>')
+@cross_origin()
+def profile_api(profile_id: str, kind: str):
+    """
+    Returns a stored profile, requires the admin token
+    pstats is loaded using pstats.Stats, collapsed holds the sampled stacks in the folded format of flame graph tools
+    :param profile_id: the profile id
+    :param kind: pstats or collapsed
+    :return: the profile file
+    """
+    if not is_admin():
+        return forbidden()
     try:
-        # Sanity check input
-        modified_args = process_input(args, extra_args=['occurrences', 'timeframe'])
-
-        # Get input
-        lat = float(modified_args['lat'])
-        lon = float(modified_args['lon'])
-        radius = int(modified_args['radius'])
-        altitude = int(modified_args['altitude'])
-        begin = int(modified_args['begin'])
-        end = int(modified_args['end'])
-        occurrences = int(modified_args['occurrences'])
-        timeframe = int(modified_args['timeframe'])
-
-        zoomlevel = 14
-        if modified_args['zoomlevel'] is not None:
-            zoomlevel = int(modified_args['zoomlevel'])
-        plot = False
-        if args['plot'] is not None:
-            plot = bool(int(modified_args['plot']))
-
-        begin_dt = convert_int_to_datetime(begin)
-        end_dt = convert_int_to_datetime(end)
-
-        flight_finder: FlightInfoFinder = FlightInfoFinder(environment)
-        disturbances = flight_finder.find_disturbances(begin=begin_dt,
-                                                            end=end_dt,
-                                                            zoomlevel=zoomlevel,
-                                                            plot=plot,
-                                                            origin=(lat, lon),
-                                                            radius=radius,
-                                                            altitude=altitude,
-                                                            occurrences=occurrences,
-                                                            timeframe=timeframe)
-        shared_queue.put(disturbances)
-        exit(0)
-    except Exception as ex:
-        shared_queue.put(ex.__str__())
-        exit(1)
+        filename = profile_store.get_filename(profile_id, kind)
+        if not os.path.exists(filename):
+            raise Exception('Unknown profile %s' % profile_id)
+        return send_file(filename,
+                         mimetype='application/octet-stream' if kind == 'pstats' else 'text/plain',
+                         as_attachment=True,
+                         download_name='%s.%s' % (profile_id, kind))
+    except Exception as e:
+        return respond({'value': e.__str__(),
+                        'status': 'ERROR'})
 
 
-def find_flights_process(shared_queue, args):
+@api_page.route('/api/jobs/submit/<name>', methods=['GET', 'POST'])
+@cross_origin()
+def submit_job_api(name: str):
     """
-    Process of finding flights, exits on error or completion
-    :param shared_queue: the shared_queue where data will be put
-    :param args: arguments
+    Submits find_disturbances or find_flights as job, takes the same arguments as the API call
+    A job that can't run right away is queued, a job is rejected with 429 when the queue of its class is full
+    Returns the job id, status, progress and partial results are polled on /api/jobs/<job id> or streamed from
+    /api/jobs/<job id>/events, the response is fetched from /api/jobs/<job id>/result once the job is done
+    :param name: name of the API call
+    :return: response data
     """
+    try:
+        if name not in JOB_FUNCTIONS:
+            raise Exception('Unknown job %s, expected one of %s' % (name, ', '.join(JOB_FUNCTIONS.keys())))
+
+        # Negotiate encoding of the result up front, the worker encodes the response itself
+        mimetype, encoding = negotiate(request.accept_mimetypes, request.accept_encodings)
+        if is_profiling_requested(request.args) and not is_admin():
+            return forbidden()
+        message = check_trajectory_options(request.args)
+        if message is not None:
+            return bad_request(message)
+        args, geocoding = resolve_address(request.args)
+        meta = {'geocoding': geocoding} if geocoding else {}
+        if is_profiling_requested(args):
+            meta['profile'] = profile_store.create_id()
+
+        # Admit the job or queue it, excess jobs are rejected right away
+        admission_class = get_admission_class(JOB_FUNCTIONS[name], args)
+        ticket = admission_controller.try_acquire(admission_class)
+        queued_fd = admission_controller.try_queue(admission_class) if ticket is None else None
+        if ticket is None and queued_fd is None:
+            get_metrics().inc('omd_request_rejected_total', labels={'class': admission_class})
+            return reject(admission_class, job=True)
+        return respond({'value': {'job': submit_job(name, args, mimetype, encoding, meta, ticket, queued_fd)},
+                        'status': 'OK'})
+    except Exception as e:
+        return respond({'value': e.__str__(),
+                        'status': 'ERROR'})
+    finally:
+        get_metrics().observe_stages(labels={'endpoint': name})
 
+
+@api_page.route('/api/jobs/<job_id>', methods=['GET', 'DELETE'])
+@cross_origin()
+def job_status_api(job_id: str):
+    """
+    Returns state, progress and partial results of a job, DELETE cancels the job
+    :param job_id: the job id
+    :return: response data
+    """
     try:
-        # Sanity check input
-        modified_args = process_input(args)
-
-        # Get input
-        lat = float(modified_args['lat'])
-        lon = float(modified_args['lon'])
-        radius = int(modified_args['radius'])
-        altitude = int(modified_args['altitude'])
-        begin = int(modified_args['begin'])
-        end = int(modified_args['end'])
-
-        # Get optional args
-        zoomlevel = 14
-        if modified_args['zoomlevel'] is not None:
-            zoomlevel = int(modified_args['zoomlevel'])
-        plot = False
-        if args['plot'] is not None:
-            plot = bool(int(modified_args['plot']))
-
-        # Get begin & end datetime
-        begin_dt = convert_int_to_datetime(begin)
-        end_dt = convert_int_to_datetime(end)
-
-        flight_finder: FlightInfoFinder = FlightInfoFinder(environment)
-        flights = flight_finder.find_flights(origin=(lat, lon),
-                                                  begin=begin_dt,
-                                                  end=end_dt,
-                                                  radius=radius,
-                                                  altitude=altitude,
-                                                  plot=plot,
-                                                  zoomlevel=zoomlevel).disturbances
-        shared_queue.put(flights)
-        exit(0)
-    except Exception as ex:
-        shared_queue.put(ex.__str__())
-        exit(1)
+        status = job_store.cancel(job_id) if request.method == 'DELETE' else job_store.read_status(job_id)
+        if status is None:
+            raise Exception('Unknown job %s' % job_id)
+        return respond({'value': get_public_status(status),
+                        'status': 'OK'})
+    except Exception as e:
+        return respond({'value': e.__str__(),
+                        'status': 'ERROR'})
 
 
-def get_trajectory_process(shared_queue, args):
+@api_page.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+@cross_origin()
+def cancel_job_api(job_id: str):
     """
-    Process of finding trajectories of flights, exits on error or completion
-    :param shared_queue: the shared_queue where data will be put
-    :param args: arguments
+    Cancels a job and kills its worker process
+    :param job_id: the job id
+    :return: response data
     """
     try:
-        # Get input
-        callsign = str(args['callsign'])
-        timestamp = int(args['timestamp'])
-        duration = int(args['duration'])
-
-        # Get timestamp datetime
-        timestamp_dt = convert_int_to_datetime(timestamp)
-
-        disturbance_finder: FlightInfoFinder = FlightInfoFinder(environment)
-        coords = disturbance_finder.get_trajectory(callsign=callsign,
-                                                   timestamp=timestamp_dt,
-                                                   duration=duration)
-        shared_queue.put(coords)
-        exit(0)
-    except Exception as ex:
-        shared_queue.put(ex.__str__())
-        exit(1)
+        status = job_store.cancel(job_id)
+        if status is None:
+            raise Exception('Unknown job %s' % job_id)
+        return respond({'value': get_public_status(status),
+                        'status': 'OK'})
+    except Exception as e:
+        return respond({'value': e.__str__(),
+                        'status': 'ERROR'})
+
+
+@api_page.route('/api/jobs/<job_id>/events')
+@cross_origin()
+def job_events_api(job_id: str):
+    """
+    Streams the status of a job as server-sent events until the job is finished
+    Every event holds the status as returned by /api/jobs/<job id>, its id is the time the status was updated
+    A stream ends after JOB_EVENTS_MAX_SECONDS, so it doesn't hold a sync web worker for the duration of the job.
+    The client reconnects after JOB_EVENTS_RETRY_MS sending the id of the last event it received as Last-Event-ID,
+    the stream continues from there. Reconnecting after the final status was received returns 204, which tells
+    EventSource clients to stop reconnecting
+    :param job_id: the job id
+    :return: event stream response
+    """
+    last_event_id = request.headers.get('Last-Event-ID')
+    try:
+        status = job_store.read_status(job_id)
+    except Exception as e:
+        return respond({'value': e.__str__(),
+                        'status': 'ERROR'})
+    if status is not None and status['state'] in FINAL_JOB_STATES and str(status['updated']) == last_event_id:
+        return Response(status=204)
+
+    def events(status):
+        updated = last_event_id
+        deadline = time.monotonic() + flaskr.environment.JOB_EVENTS_MAX_SECONDS
+        yield 'retry: %i\n\n' % JOB_EVENTS_RETRY_MS
+        while True:
+            if status is None:
+                yield 'event: error\ndata: %s\n\n' % json.dumps('Unknown job %s' % job_id)
+                return
+            if str(status['updated']) != updated:
+                updated = str(status['updated'])
+                yield 'id: %s\ndata: %s\n\n' % (updated, json.dumps(get_public_status(status)))
+            if status['state'] in FINAL_JOB_STATES or time.monotonic() >= deadline:
+                return
+            time.sleep(JOB_EVENTS_POLL_SECONDS)
+            status = job_store.read_status(job_id)
+
+    return Response(events(status),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@api_page.route('/api/jobs/<job_id>/result')
+@cross_origin()
+def job_result_api(job_id: str):
+    """
+    Returns the response of a finished job, encoded as requested on submit, and removes the job
+    :param job_id: the job id
+    :return: response data
+    """
+    try:
+        status = job_store.read_status(job_id)
+        if status is None:
+            raise Exception('Unknown job %s' % job_id)
+        if status['state'] not in FINAL_JOB_STATES:
+            raise Exception('Job %s is %s' % (job_id, status['state']))
+        if status['state'] != 'done':
+            job_store.remove(job_id)
+            raise Exception(status['error'])
+        response = send_result(SpooledResult(**status['result']))
+        job_store.remove(job_id)
+        return response
+    except Exception as e:
+        return respond({'value': e.__str__(),
+                        'status': 'ERROR'})
+
+
+def find_disturbances_process(args, shared_scan: ScanSubscription = None, progress=None):
+    """
+    Process of finding disturbances, runs in a worker process, raises exception on error
+    :param args: arguments
+    :param shared_scan: subscription to the scan shared with coalesced queries, None scans the state store
+    :param progress: called with the scanned fraction and the disturbance periods found so far, see FlightInfoFinder
+    :return: found disturbances and metadata
+    """
+    # Sanity check input
+    modified_args = process_input(args, extra_args=['occurrences', 'timeframe'])
+
+    # Get input
+    lat = float(modified_args['lat'])
+    lon = float(modified_args['lon'])
+    radius = int(modified_args['radius'])
+    altitude = int(modified_args['altitude'])
+    begin = int(modified_args['begin'])
+    end = int(modified_args['end'])
+    occurrences = int(modified_args['occurrences'])
+    timeframe = int(modified_args['timeframe'])
+
+    zoomlevel = 14
+    if modified_args['zoomlevel'] is not None:
+        zoomlevel = int(modified_args['zoomlevel'])
+    plot = False
+    if args['plot'] is not None:
+        plot = bool(int(modified_args['plot']))
+    output_format, precision, trajectory_processor = process_output_options(args)
+
+    begin_dt = convert_int_to_datetime(begin)
+    end_dt = convert_int_to_datetime(end)
+
+    flight_finder: FlightInfoFinder = FlightInfoFinder(
+        environment,
+        max_time_ms=get_max_time_ms(),
+        max_result_periods=flaskr.environment.QUERY_MAX_RESULT_PERIODS,
+        max_trajectory_gap=TRAJECTORY_MAX_GAP_SECONDS)
+    disturbances = flight_finder.find_disturbances(begin=begin_dt,
+                                                   end=end_dt,
+                                                   zoomlevel=zoomlevel,
+                                                   plot=plot,
+                                                   origin=(lat, lon),
+                                                   radius=radius,
+                                                   altitude=altitude,
+                                                   occurrences=occurrences,
+                                                   timeframe=timeframe,
+                                                   output_format=output_format,
+                                                   precision=precision,
+                                                   trajectory_processor=trajectory_processor,
+                                                   shared_scan=shared_scan,
+                                                   progress=progress)
+    return disturbances, {'trajectories': trajectory_processor.get_metadata()}
+
+
+def find_flights_process(args, shared_scan: ScanSubscription = None, progress=None):
+    """
+    Process of finding flights, runs in a worker process, raises exception on error
+    :param args: arguments
+    :param shared_scan: subscription to the scan shared with coalesced queries, None scans the state store
+    :param progress: called with the scanned fraction and the flights found so far, see FlightInfoFinder
+    :return: found flights and metadata
+    """
+    # Sanity check input
+    modified_args = process_input(args)
+
+    # Get input
+    lat = float(modified_args['lat'])
+    lon = float(modified_args['lon'])
+    radius = int(modified_args['radius'])
+    altitude = int(modified_args['altitude'])
+    begin = int(modified_args['begin'])
+    end = int(modified_args['end'])
+
+    # Get optional args
+    zoomlevel = 14
+    if modified_args['zoomlevel'] is not None:
+        zoomlevel = int(modified_args['zoomlevel'])
+    plot = False
+    if args['plot'] is not None:
+        plot = bool(int(modified_args['plot']))
+    output_format, precision, trajectory_processor = process_output_options(args)
+
+    # Get begin & end datetime
+    begin_dt = convert_int_to_datetime(begin)
+    end_dt = convert_int_to_datetime(end)
+
+    flight_finder: FlightInfoFinder = FlightInfoFinder(environment,
+                                                         max_time_ms=get_max_time_ms(),
+                                                         max_trajectory_gap=TRAJECTORY_MAX_GAP_SECONDS)
+    flights = flight_finder.find_flights(origin=(lat, lon),
+                                         begin=begin_dt,
+                                         end=end_dt,
+                                         radius=radius,
+                                         altitude=altitude,
+                                         plot=plot,
+                                         zoomlevel=zoomlevel,
+                                         output_format=output_format,
+                                         precision=precision,
+                                         trajectory_processor=trajectory_processor,
+                                         shared_scan=shared_scan,
+                                         progress=progress).disturbances
+    return flights, {'trajectories': trajectory_processor.get_metadata()}
+
+
+# API calls that can be submitted as job
+JOB_FUNCTIONS = {'find_disturbances': find_disturbances_process,
+                 'find_flights': find_flights_process}
+
+
+def get_trajectory_process(args):
+    """
+    Process of finding trajectories of flights, runs in a worker process, raises exception on error
+    :param args: arguments
+    :return: trajectory coordinates and metadata
+    """
+    # Get input
+    callsign = str(args['callsign'])
+    timestamp = int(args['timestamp'])
+    duration = int(args['duration'])
+    output_format, precision, trajectory_processor = process_output_options(args,
+                                                                            output_formats=TRAJECTORY_OUTPUT_FORMATS)
+
+    # Get timestamp datetime
+    timestamp_dt = convert_int_to_datetime(timestamp)
+
+    disturbance_finder: FlightInfoFinder = FlightInfoFinder(environment,
+                                                            max_time_ms=get_max_time_ms(),
+                                                            max_trajectory_gap=TRAJECTORY_MAX_GAP_SECONDS)
+    coords = disturbance_finder.get_trajectory(callsign=callsign,
+                                               timestamp=timestamp_dt,
+                                               duration=duration,
+                                               trajectory_processor=trajectory_processor)
+
+    # Trajectory coordinates are ordered lat, lon, convert to a GeoJSON feature if requested
+    if output_format == 'geojson':
+        coords = trajectory_to_feature(Trajectory(callsign=callsign, coords=coords),
+                                       precision=precision,
+                                       lonlat=False)
+    return coords, {'trajectories': trajectory_processor.get_metadata()}
 
 
 def execute(function, args):
     """
     All api calls get executed by this function
-    Returns response object in json on success
+    Returns response object on success, encoded according to the Accept header (JSON by default)
     {
         status: 'OK',
         value: <string> <-- JSON string
+        meta: <dict> <-- metadata about the call, such as trajectory point counts
     }
-    Returns response object in json on failure
+    Returns response object on failure
     {
         status: 'ERROR',
         value: <string> <-- failure description
     }
+    The response is encoded by the worker process and streamed from the result spool, see task
+    find_flights and find_disturbances calls are coalesced with concurrent calls overlapping in time, see coalesced_task
+    Calls are admitted by the admission controller first, rejected calls get a 429 response with Retry-After header
+    Latency, stage timings and worker utilisation are recorded in the metrics, which are flushed after every call
     :param function: function to execute
     :param args: arguments that need to be passed into the function
-    :return: response object with status and value
+    :return: flask response
+    """
+    begin = time.perf_counter()
+    endpoint = get_endpoint_name(function)
+    if is_profiling_requested(args) and not is_admin():
+        return forbidden()
+    message = check_trajectory_options(args)
+    if message is not None:
+        return bad_request(message)
+    try:
+        # Admit the call, excess load is rejected right away
+        admission_class = get_admission_class(function, args)
+        ticket = admission_controller.acquire(admission_class)
+        if ticket is None:
+            get_metrics().inc('omd_request_rejected_total', labels={'class': admission_class})
+            return reject(admission_class)
+        try:
+            return execute_admitted(function, args)
+        finally:
+            admission_controller.release(ticket)
+            get_metrics().inc('omd_worker_busy_seconds_total', time.perf_counter() - ticket.admitted,
+                              labels={'class': admission_class})
+    finally:
+        get_metrics().observe('omd_request_seconds', time.perf_counter() - begin, labels={'endpoint': endpoint})
+        get_metrics().observe_stages(labels={'endpoint': endpoint})
+        get_metrics().flush()
+
+
+def get_table_kind(function):
+    """
+    Returns the kind of the value of an API call, the schema of its Arrow responses, see response_to_table
+    """
+    return {'find_disturbances': TABLE_DISTURBANCES,
+            'find_flights': TABLE_DISTURBANCES,
+            'get_trajectory': TABLE_TRAJECTORY}.get(get_endpoint_name(function))
+
+
+def get_endpoint_name(function):
+    """
+    Returns the name of the API call of a worker function, the label of its metrics
     """
+    return function.__name__[:-len('_process')] if function.__name__.endswith('_process') else function.__name__
 
-    # Create response dict
-    response = {}
 
-    # Try and execute the API call and fill response object
+def execute_admitted(function, args):
+    """
+    Executes an admitted api call, see execute
+    :param function: function to execute
+    :param args: arguments that need to be passed into the function
+    :return: flask response
+    """
+
+    # Negotiate encoding up front, the worker encodes the response itself
+    mimetype, encoding = negotiate(request.accept_mimetypes, request.accept_encodings)
+    result_path = create_result_path(flaskr.environment.RESULT_SPOOL_DIR)
+
+    # Try and execute the API call and stream the spooled response
     try:
-        response['value'] = task(function, args)
-        response['status'] = 'OK'
+        # Geocode in this process, the worker only gets lat, lon
+        args, geocoding = resolve_address(args)
+        meta = {'geocoding': geocoding} if geocoding else {}
+
+        # Profiled calls run in a worker process of their own, they are never coalesced
+        if is_profiling_requested(args):
+            meta['profile'] = profile_store.create_id()
+        elif is_coalescable(function, args):
+            return send_result(query_coalescer.submit((function, args, result_path, mimetype, encoding, meta),
+                                                      begin=args.get('begin', type=int),
+                                                      end=args.get('end', type=int)))
+        return send_result(task(function, args, result_path, mimetype, encoding, meta=meta))
     except Exception as e:
-        response['value'] = e.__str__()
-        response['status'] = 'ERROR'
+        get_metrics().inc('omd_request_errors_total', labels={'endpoint': get_endpoint_name(function)})
+        remove_result(result_path)
+        return respond({'value': e.__str__(),
+                        'status': 'ERROR'})
+
+
+def warm_plotter():
+    """
+    Imports the raster plotting stack in a background thread, so the first jpg plot of this web process and the
+    worker processes forked from it don't pay for the import. Called by gunicorn in every worker after it is forked
+    """
+    def run():
+        with plotter_import_lock:
+            begin = time.perf_counter()
+            try:
+                import ovm.plotter
+                logging.info('Imported plotting stack in %f seconds' % (time.perf_counter() - begin))
+            except Exception as ex:
+                logging.exception(ex)
+
+    threading.Thread(target=run, daemon=True).start()
 
-    # Return response object
+
+def start_process(process: Process):
+    """
+    Starts a worker process, waits for a running import of the plotting stack so the process is never forked while a
+    module is half imported
+    :param process: the process
+    """
+    with plotter_import_lock:
+        process.start()
+
+
+def get_admission_class(function, args):
+    """
+    Returns the admission class of an api call, calls producing a plot are expensive, other calls are cheap
+    :param function: the api function call
+    :param args: the arguments
+    :return: 'cheap' or 'expensive'
+    """
+    plot = args.get('plot', type=int, default=0)
+    if plot is not None and plot != 0 and args.get('format', type=str, default='jpg') != 'geojson':
+        return 'expensive'
+    return 'cheap'
+
+
+def reject(admission_class: str, job: bool = False):
+    """
+    Returns the response of a call rejected by the admission controller, 429 with a Retry-After header
+    :param admission_class: the admission class of the call
+    :param job: the call was submitted as job
+    :return: flask response
+    """
+    retry_after = admission_controller.get_retry_after(admission_class, job=job)
+    response = respond({'value': 'Too many requests, retry after %i seconds' % retry_after,
+                        'status': 'ERROR'})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
     return response
 
 
-def task(function, args):
+def is_admin():
+    """
+    Returns True if the request carries the admin token in the X-Admin-Token header, False if no token is configured
+    """
+    token = flaskr.environment.PROFILING_ADMIN_TOKEN
+    if token is None:
+        return False
+    return hmac.compare_digest(request.headers.get('X-Admin-Token', ''), token)
+
+
+def is_profiling_requested(args):
+    """
+    Returns True if the api call asks to be profiled using the profile argument or the X-Profile header
+    """
+    return args.get('profile', type=int, default=0) == 1 or request.headers.get('X-Profile') == '1'
+
+
+def bad_request(message: str):
+    """
+    Returns the response of a request with invalid arguments, 400
+    :param message: description of the invalid argument
+    :return: flask response
+    """
+    response = respond({'value': message,
+                        'status': 'ERROR'})
+    response.status_code = 400
+    return response
+
+
+def forbidden():
+    """
+    Returns the response of a request that requires the admin token, 403
+    :return: flask response
+    """
+    response = respond({'value': 'Forbidden, requires a valid X-Admin-Token header',
+                        'status': 'ERROR'})
+    response.status_code = 403
+    return response
+
+
+def respond(response: dict):
+    """
+    Encodes the response object using content negotiation
+    JSON (default), MessagePack or Arrow IPC depending on the Accept header, brotli or gzip compressed depending on
+    the Accept-Encoding header
+    :param response: response object with status and value
+    :return: flask response
+    """
+    return encode_response(response,
+                           accept_mimetypes=request.accept_mimetypes,
+                           accept_encodings=request.accept_encodings,
+                           min_compress_size=flaskr.environment.RESPONSE_COMPRESSION_MIN_BYTES)
+
+
+def task_process(function, args, result_path: str, mimetype: str, encoding: str, meta: dict, shared_queue):
+    """
+    Entry point of the worker process, exits on error or completion
+    Executes the api function, encodes the response and writes it into the result spool
+    Only the small SpooledResult header is put in the shared queue, on error the exception message is put instead
+    :param function: the api function call
+    :param args: the arguments
+    :param result_path: spool file path the response is written to
+    :param mimetype: the negotiated mimetype
+    :param encoding: the negotiated content encoding
+    :param meta: metadata gathered before the worker started, merged into the response metadata
+    :param shared_queue: the shared_queue where the result header will be put
+    """
+    try:
+        limit_worker()
+        value, function_meta = call_profiled(function, args, meta)
+        meta.update(function_meta)
+        with get_stages().time('encode'):
+            result = write_result(result_path,
+                                  {'value': value, 'meta': meta, 'status': 'OK'},
+                                  mimetype=mimetype,
+                                  encoding=encoding,
+                                  min_compress_size=flaskr.environment.RESPONSE_COMPRESSION_MIN_BYTES,
+                                  kind=get_table_kind(function))
+        shared_queue.put(result)
+        exit_code = 0
+    except MemoryError:
+        shared_queue.put(get_memory_error_message())
+        exit_code = 1
+    except Exception as ex:
+        shared_queue.put(ex.__str__())
+        exit_code = 1
+    flush_worker_metrics(get_endpoint_name(function))
+    exit(exit_code)
+
+
+def call_profiled(function, args, meta: dict, **kwargs):
+    """
+    Calls the api function in a worker process, under the profiler if meta holds a profile id
+    The profile is stored under that id, also when the function raises
+    With QUERY_MEMORY_TRACING the peak memory of the call is added to meta as memory
+    :param function: the api function call
+    :param args: the arguments
+    :param meta: metadata of the call
+    :return: the result of the function
+    """
+    with trace_memory(flaskr.environment.QUERY_MEMORY_TRACING) as memory:
+        if meta.get('profile') is None:
+            result = function(args, **kwargs)
+        else:
+            with profile_store.profile(get_endpoint_name(function),
+                                       profile_id=meta['profile'],
+                                       info={key: args.get(key) for key in args.keys()}):
+                result = function(args, **kwargs)
+    if memory.enabled:
+        meta['memory'] = memory.get_report()
+        get_metrics().observe('omd_request_traced_peak_bytes', memory.traced_peak_bytes,
+                              labels={'endpoint': get_endpoint_name(function)}, buckets=MEMORY_BUCKETS)
+    return result
+
+
+def flush_worker_metrics(endpoint: str):
+    """
+    Observes the stage timings and peak memory of a worker process and flushes its metrics, called before the worker
+    exits
+    :param endpoint: the endpoint label of the stage timings
+    """
+    try:
+        get_metrics().observe_stages(labels={'endpoint': endpoint})
+        get_metrics().observe('omd_worker_peak_rss_bytes', get_peak_rss_bytes(), labels={'endpoint': endpoint},
+                              buckets=MEMORY_BUCKETS)
+        get_metrics().flush()
+    except Exception as ex:
+        logging.exception(ex)
+
+
+def task(function, args, result_path: str, mimetype: str, encoding: str, meta: dict = None):
     """
     A Task encapsulates an api call and expects a result to be put in a shared queue
     We create a new process because matplotlib cannot run from multiple threads within the same context
+    The encoded response travels through a spool file instead of the queue, this avoids pickling large payloads
+    through the queue's pipe and re-encoding them in this process
     :param function: the api function call
     :param args: the arguments
-    :return: the data returned by the function, data has error string if exception is raised
+    :param result_path: spool file path the response is written to
+    :param mimetype: the negotiated mimetype
+    :param encoding: the negotiated content encoding
+    :param meta: metadata gathered before the worker started
+    :return: SpooledResult describing the response, data has error string if exception is raised
     """
 
     # Create a queue to share data with between this and new process
     shared_queue = multiprocessing.Queue()
 
     # Create & start process
-    process = Process(target=function, args=(shared_queue, args))
-    process.start()
+    process = Process(target=task_process,
+                      args=(function, args, result_path, mimetype, encoding, meta or {}, shared_queue))
+    start_process(process)
 
     # Get data from process
-    data = shared_queue.get()
+    data = get_worker_data(process, shared_queue)
 
     # Join process
     process.join()
@@ -252,6 +883,315 @@ def task(function, args):
     return data
 
 
+def is_coalescable(function, args):
+    """
+    Returns True if the api call can share its scan with concurrent calls
+    Raster plots are not coalesced, matplotlib cannot run from multiple threads within the same process
+    :param function: the api function call
+    :param args: the arguments
+    :return: True if the call can be coalesced
+    """
+    if flaskr.environment.QUERY_COALESCING_WINDOW_SECONDS <= 0:
+        return False
+    if function not in (find_disturbances_process, find_flights_process):
+        return False
+    if args.get('begin', type=int) is None or args.get('end', type=int) is None:
+        return False
+    plot = args.get('plot', type=int, default=0)
+    return plot is None or plot == 0 or args.get('format', type=str, default='jpg') != 'jpg'
+
+
+def coalesced_task_process(queries: list, shared_queue):
+    """
+    Entry point of the worker process of a group of coalesced api calls, exits on completion
+    Every call runs in its own thread and consumes a subscription to one shared scan of the state store, responses are
+    encoded and written into the result spool by every call itself
+    A list holding the SpooledResult or the exception message of every call is put in the shared queue
+    :param queries: list of function, args, result_path, mimetype, encoding, meta tuples
+    :param shared_queue: the shared_queue where the results will be put
+    """
+    results = [None] * len(queries)
+    try:
+        limit_worker()
+        shared_scan = SharedScan(StateReader(get_state_store(environment),
+                                             cold_storage=get_cold_storage(environment)))
+        subscriptions = [shared_scan.subscribe() for _ in queries]
+    except Exception as ex:
+        shared_queue.put([ex.__str__()] * len(queries))
+        exit(1)
+
+    def run_query(idx: int, function, args, result_path: str, mimetype: str, encoding: str, meta: dict):
+        try:
+            value, function_meta = function(args, shared_scan=subscriptions[idx])
+            meta.update(function_meta)
+            meta['coalesced'] = len(queries)
+            with get_stages().time('encode'):
+                results[idx] = write_result(result_path,
+                                            {'value': value, 'meta': meta, 'status': 'OK'},
+                                            mimetype=mimetype,
+                                            encoding=encoding,
+                                            min_compress_size=flaskr.environment.RESPONSE_COMPRESSION_MIN_BYTES,
+                                  kind=get_table_kind(function))
+        except MemoryError:
+            results[idx] = get_memory_error_message()
+        except Exception as ex:
+            results[idx] = ex.__str__()
+        finally:
+            subscriptions[idx].close()
+
+    # Queries are daemon threads, the process does not wait for them when the time budget is exceeded
+    threads = [threading.Thread(target=run_query, args=(idx,) + tuple(query), daemon=True)
+               for idx, query in enumerate(queries)]
+    try:
+        for thread in threads:
+            thread.start()
+        scanned = shared_scan.run()
+        for thread in threads:
+            thread.join()
+        logging.debug('Coalesced %i queries into a single scan of %i snapshots' % (len(queries), scanned))
+    except Exception as ex:
+        shared_queue.put([result if result is not None else ex.__str__() for result in results])
+        flush_worker_metrics('coalesced')
+        exit(1)
+
+    shared_queue.put(results)
+    flush_worker_metrics('coalesced')
+    exit(0)
+
+
+def coalesced_task(queries: list):
+    """
+    Executes a group of coalesced api calls in a single worker process sharing one scan, see task
+    :param queries: list of function, args, result_path, mimetype, encoding, meta tuples
+    :return: list holding the SpooledResult of every call, or an exception if the call failed
+    """
+
+    # Create a queue to share data with between this and new process
+    shared_queue = multiprocessing.Queue()
+
+    # Create & start process
+    process = Process(target=coalesced_task_process,
+                      args=(queries, shared_queue))
+    start_process(process)
+
+    # Get data from process
+    data = get_worker_data(process, shared_queue)
+
+    # Join process
+    process.join()
+    process.close()
+
+    # Failed calls hold the exception message, pass it on
+    results = []
+    for (function, args, result_path, mimetype, encoding, meta), result in zip(queries, data):
+        if isinstance(result, str):
+            remove_result(result_path)
+            results.append(Exception(result))
+        else:
+            results.append(result)
+    return results
+
+
+def get_max_time_ms():
+    """
+    Returns the time limit of database queries of an API call in milliseconds, None for no limit
+    """
+    if flaskr.environment.QUERY_MAX_SECONDS is None:
+        return None
+    return int(flaskr.environment.QUERY_MAX_SECONDS * 1000)
+
+
+def get_memory_error_message():
+    return 'Query exceeded the memory budget of %i MB' % flaskr.environment.QUERY_MEMORY_LIMIT_MB
+
+
+def on_time_budget_exceeded(signum, frame):
+    raise Exception('Query exceeded the time budget of %i seconds' % flaskr.environment.QUERY_MAX_SECONDS)
+
+
+def limit_worker():
+    """
+    Applies the time and memory budget of an API call to the worker process it runs in
+    Exceeding the time budget raises an exception in the main thread, exceeding the memory budget raises MemoryError
+    The memory ceiling fails the call with an exception before that, when the finder checks it while scanning
+    """
+    get_memory_ceiling().configure(flaskr.environment.QUERY_MEMORY_CEILING_MB)
+    if flaskr.environment.QUERY_MEMORY_LIMIT_MB is not None:
+        limit = flaskr.environment.QUERY_MEMORY_LIMIT_MB * 1024 * 1024
+        _, hard = resource.getrlimit(resource.RLIMIT_DATA)
+        resource.setrlimit(resource.RLIMIT_DATA, (limit if hard == resource.RLIM_INFINITY else min(limit, hard), hard))
+    if flaskr.environment.QUERY_MAX_SECONDS is not None:
+        signal.signal(signal.SIGALRM, on_time_budget_exceeded)
+        signal.alarm(int(flaskr.environment.QUERY_MAX_SECONDS))
+
+
+def get_worker_data(process: Process, shared_queue):
+    """
+    Returns the data the worker process puts in the shared queue
+    The worker is killed if it puts nothing within its time budget, for example when it is stuck outside the
+    interpreter, raises exception then
+    :param process: the worker process
+    :param shared_queue: the shared queue
+    :return: the data
+    """
+    timeout = None
+    if flaskr.environment.QUERY_MAX_SECONDS is not None:
+        timeout = flaskr.environment.QUERY_MAX_SECONDS + WORKER_GRACE_SECONDS
+    try:
+        return shared_queue.get(timeout=timeout)
+    except queue.Empty:
+        process.kill()
+        process.join()
+        process.close()
+        raise Exception('Query exceeded the time budget of %i seconds' % flaskr.environment.QUERY_MAX_SECONDS)
+
+
+def summarize_partial(partial: list):
+    """
+    Returns the partial result of a job as it is reported in its status
+    Disturbance periods are summarized without their disturbances and trajectories
+    :param partial: list of CallsignInfo or DisturbancePeriod
+    :return: list of dictionaries
+    """
+    summary = []
+    for item in partial:
+        if isinstance(item, DisturbancePeriod):
+            summary.append({'begin': item.begin.__str__(),
+                            'end': item.end.__str__(),
+                            'flights': item.flights,
+                            'average_altitude': item.average_altitude})
+        else:
+            summary.append(dataclass_to_dict(item))
+    return summary
+
+
+def get_public_status(status: dict):
+    """
+    Returns the status of a job without the internals of its worker and result
+    """
+    return {key: value for key, value in status.items() if key not in ('pid', 'result')}
+
+
+def job_process(job_id: str, function, args, mimetype: str, encoding: str, meta: dict, ticket, queued_fd: int):
+    """
+    Entry point of the worker process of a job, exits on error or completion
+    A queued job holds its queue slot until it is admitted, executes the api function, reports progress and partial results in the job status and writes
+    the encoded response into the result spool of the job. A cancelled job stops at its next progress report
+    :param job_id: the job id
+    :param function: the api function call
+    :param args: the arguments
+    :param mimetype: the negotiated mimetype
+    :param encoding: the negotiated content encoding
+    :param meta: metadata gathered before the worker started, merged into the response metadata
+    :param ticket: the admission ticket of a job admitted on submit, None for a queued job
+    :param queued_fd: the queue slot of a queued job, None for an admitted job
+    """
+    # Wait for admission in the queued state, the queue and running slots are released when the worker ends
+    while ticket is None:
+        status = job_store.read_status(job_id, access=False)
+        if status is None or status['state'] in FINAL_JOB_STATES:
+            exit(0)
+        time.sleep(JOB_ADMISSION_POLL_SECONDS)
+        ticket = admission_controller.try_acquire(get_admission_class(function, args))
+    if queued_fd is not None:
+        admission_controller.release_queued(queued_fd)
+
+    status = job_store.read_status(job_id, access=False)
+    if status is None or status['state'] in FINAL_JOB_STATES:
+        exit(0)
+    status['state'] = 'running'
+    status['pid'] = os.getpid()
+    job_store.write_status(job_id, status)
+
+    last_report = [time.monotonic()]
+
+    def progress(fraction: float, partial: list):
+        now = time.monotonic()
+        if now - last_report[0] < flaskr.environment.JOB_PROGRESS_INTERVAL_SECONDS:
+            return
+        last_report[0] = now
+        current = job_store.read_status(job_id, access=False)
+        if current is None or current['state'] in FINAL_JOB_STATES:
+            exit(0)
+        status['progress'] = fraction
+        status['partial'] = summarize_partial(partial)
+        job_store.write_status(job_id, status)
+
+    try:
+        limit_worker()
+        value, function_meta = call_profiled(function, args, meta, progress=progress)
+        meta.update(function_meta)
+        with get_stages().time('encode'):
+            result = write_result(job_store.get_result_path(job_id),
+                                  {'value': value, 'meta': meta, 'status': 'OK'},
+                                  mimetype=mimetype,
+                                  encoding=encoding,
+                                  min_compress_size=flaskr.environment.RESPONSE_COMPRESSION_MIN_BYTES,
+                                  kind=get_table_kind(function))
+        status['state'] = 'done'
+        status['progress'] = 1.0
+        status['result'] = dataclass_to_dict(result)
+    except MemoryError:
+        status['state'] = 'failed'
+        status['error'] = get_memory_error_message()
+    except Exception as ex:
+        status['state'] = 'failed'
+        status['error'] = ex.__str__()
+
+    # Don't overwrite a cancellation
+    current = job_store.read_status(job_id, access=False)
+    if current is not None and current['state'] not in FINAL_JOB_STATES:
+        job_store.write_status(job_id, status)
+    get_metrics().inc('omd_worker_busy_seconds_total', time.perf_counter() - ticket.admitted,
+                      labels={'class': ticket.admission_class.name})
+    flush_worker_metrics(get_endpoint_name(function))
+    exit(0)
+
+
+def monitor_job(job_id: str, process: Process):
+    """
+    Waits for the worker process of a job, fails the job if the worker ended without finishing it
+    :param job_id: the job id
+    :param process: the worker process
+    """
+    process.join()
+    if process.exitcode == -signal.SIGKILL:
+        job_store.finish(job_id, 'cancelled', 'Job was cancelled')
+    else:
+        job_store.finish(job_id, 'failed', 'Job worker exited with code %i' % process.exitcode)
+    process.close()
+
+
+def submit_job(name: str, args, mimetype: str, encoding: str, meta: dict, ticket, queued_fd: int):
+    """
+    Creates a job and starts its worker process, returns immediately
+    The running or queue slot of the job is handed over to the worker, a thread of this process waits for the worker
+    so it does not linger as zombie
+    :param name: name of the api call
+    :param args: the arguments
+    :param mimetype: the negotiated mimetype
+    :param encoding: the negotiated content encoding
+    :param meta: metadata gathered before the worker started
+    :param ticket: the admission ticket of an admitted job, None for a queued job
+    :param queued_fd: the queue slot of a queued job, None for an admitted job
+    :return: the job id
+    """
+    try:
+        job_id = job_store.create(name)
+        process = Process(target=job_process,
+                          args=(job_id, JOB_FUNCTIONS[name], args, mimetype, encoding, meta, ticket, queued_fd))
+        start_process(process)
+    except Exception:
+        if ticket is not None:
+            admission_controller.release(ticket)
+        if queued_fd is not None:
+            admission_controller.release_queued(queued_fd)
+        raise
+    admission_controller.hand_over(ticket, queued_fd)
+    threading.Thread(target=monitor_job, args=(job_id, process), daemon=True).start()
+    return job_id
+
+
 def get_lat_lon_from_pro6pp(args):
     """
     Queries lat and lon from given postalcode and streetnumber
@@ -260,70 +1200,130 @@ def get_lat_lon_from_pro6pp(args):
     :param args: dict, except postalcode and streetnumber as keys
     :return: latitude and longitude
     """
+    return geocode_address(args)[0]
+
+
+def geocode_address(args):
+    """
+    Geocodes postalcode and streetnumber, served from the in-process cache, the latlon cache or pro6pp in that order
+    Concurrent misses for the same address are coalesced into a single lookup
+    Raises exception on error
+    :param args: dict, except postalcode and streetnumber as keys
+    :return: latitude and longitude tuple and the source it was served from (memory, database or pro6pp)
+    """
 
     postalcode = args['postalcode']
 
     # remove whitespaces from postal code
     postalcode = postalcode.lstrip().rstrip()
     postalcode = postalcode.replace(' ', '')
+    streetnumber = args.get('streetnumber', type=str)
     address_key = postalcode + args.get('streetnumber', type=str, default='')
 
-    if latlon_cache.address_valid(address_key):
-        return latlon_cache.get_latlon_from_address(address_key)
-    else:
-        if len(postalcode) == 6 and args.get('streetnumber', type=str) is not None:
-            url = '%s?' \
-                  'authKey=%s&' \
-                  'postalCode=%s&' \
-                  'streetNumberAndPremise=%s' % \
-                  (flaskr.environment.PRO6PP_API_AUTO_COMPLETE_URL,
-                   flaskr.environment.PRO6PP_AUTH_KEY,
-                   postalcode, str(args['streetnumber']))
-
-            data = requests.get(url).json()
-
-            if 'lat' not in data or 'lng' not in data:
-                err = 'Could not get latitude or longitude from pro6pp server'
-                if 'error_id' in data:
-                    err += ' : ' + data['error_id']
-                raise Exception(err)
-
-            latlon_cache.add_or_update_address(address_key, (data['lat'], data['lng']))
-            return data['lat'], data['lng']
-        elif len(postalcode) == 4 or len(postalcode) == 6:
-            postalcode = postalcode[0:4]
-            url = '%s?' \
-                  'authKey=%s&' \
-                  'targetPostalCodes=%s&' \
-                  'postalCode=%s' % \
-                  (flaskr.environment.PRO6PP_API_AUTO_LOCATOR_URL,
-                   flaskr.environment.PRO6PP_AUTH_KEY,
-                   postalcode, postalcode)
-
-            response = requests.get(url).json()
-
-            if isinstance(response, list):
-                if len(response) >= 1:
-                    data = response[0]
-                    if 'lat' not in data or 'lng' not in data:
-                        err = 'Could not get latitude or longitude from pro6pp server'
-                        if 'error_id' in data:
-                            err += ' : ' + data['error_id']
-                        raise Exception(err)
-
-                    latlon_cache.add_or_update_address(address_key, (data['lat'], data['lng']))
-                    return data['lat'], data['lng']
-                else:
-                    raise Exception('Returned list is empty')
+    return geocoder.get(address_key, lambda: lookup_lat_lon(postalcode, streetnumber, address_key))
+
+
+def lookup_lat_lon(postalcode: str, streetnumber: str, address_key: str):
+    """
+    Looks up lat and lon of postal codes without streetnumber in the offline postal code table first, then in the
+    latlon cache and queries pro6pp if address is not cached or expired
+    Uses pro6pp (https://www.pro6pp.nl/)
+    Raises exception on error
+    :param postalcode: postalcode without whitespaces
+    :param streetnumber: streetnumber, can be None
+    :param address_key: key of the address in the latlon cache
+    :return: latitude and longitude tuple and the source (table, database or pro6pp)
+    """
+
+    # PC6 and PC4 centroids don't need a network call
+    if streetnumber is None or len(postalcode) == 4:
+        latlon = postalcode_table.get(postalcode)
+        if latlon is None and len(postalcode) == 6:
+            latlon = postalcode_table.get(postalcode[0:4])
+        if latlon is not None:
+            return latlon, 'table'
+
+    latlon = latlon_cache.get(address_key)
+    if latlon is not None:
+        return latlon, 'database'
+
+    if len(postalcode) == 6 and streetnumber is not None:
+        url = '%s?' \
+              'authKey=%s&' \
+              'postalCode=%s&' \
+              'streetNumberAndPremise=%s' % \
+              (flaskr.environment.PRO6PP_API_AUTO_COMPLETE_URL,
+               flaskr.environment.PRO6PP_AUTH_KEY,
+               postalcode, str(streetnumber))
+
+        data = requests.get(url).json()
+
+        if 'lat' not in data or 'lng' not in data:
+            err = 'Could not get latitude or longitude from pro6pp server'
+            if 'error_id' in data:
+                err += ' : ' + data['error_id']
+            raise Exception(err)
+
+        latlon_cache.add_or_update_address(address_key, (data['lat'], data['lng']))
+        return (data['lat'], data['lng']), 'pro6pp'
+    elif len(postalcode) == 4 or len(postalcode) == 6:
+        postalcode = postalcode[0:4]
+        url = '%s?' \
+              'authKey=%s&' \
+              'targetPostalCodes=%s&' \
+              'postalCode=%s' % \
+              (flaskr.environment.PRO6PP_API_AUTO_LOCATOR_URL,
+               flaskr.environment.PRO6PP_AUTH_KEY,
+               postalcode, postalcode)
+
+        response = requests.get(url).json()
+
+        if isinstance(response, list):
+            if len(response) >= 1:
+                data = response[0]
+                if 'lat' not in data or 'lng' not in data:
+                    err = 'Could not get latitude or longitude from pro6pp server'
+                    if 'error_id' in data:
+                        err += ' : ' + data['error_id']
+                    raise Exception(err)
+
+                latlon_cache.add_or_update_address(address_key, (data['lat'], data['lng']))
+                return (data['lat'], data['lng']), 'pro6pp'
             else:
-                err = 'Invalid response from pro6pp'
-                if 'error_id' in response:
-                    err += ' : ' + response['error_id']
-                raise Exception(err)
+                raise Exception('Returned list is empty')
+        else:
+            err = 'Invalid response from pro6pp'
+            if 'error_id' in response:
+                err += ' : ' + response['error_id']
+            raise Exception(err)
 
     raise Exception('No valid data supplied to get lat, lon from postalcode')
 
 
+def resolve_address(args):
+    """
+    Replaces postalcode and streetnumber in args by lat, lon
+    Geocoding happens in the web process so the in-process cache and request coalescing are shared between requests
+    Raises exception on error
+    :param args: request arguments
+    :return: arguments holding lat, lon and geocoding metadata, metadata is empty if no postalcode is given
+    """
+    if args.get('postalcode', type=str) is None:
+        return args, {}
+
+    begin = time.perf_counter()
+    with get_stages().time('geocode'):
+        latlon, source = geocode_address(args)
+
+    resolved_args = args.copy()
+    resolved_args['lat'] = str(latlon[0])
+    resolved_args['lon'] = str(latlon[1])
+    resolved_args.pop('postalcode')
+    resolved_args.pop('streetnumber', None)
+    return resolved_args, {'source': source,
+                           'latency': time.perf_counter() - begin}
+
+
 def process_input(args, extra_args: list = []):
     """
     Sanity checks API call input, raises exception if input is not within specs
@@ -390,4 +1390,44 @@ def process_input(args, extra_args: list = []):
     return args_mutable_dict
 
 
+def check_trajectory_options(args):
+    """
+    Sanity checks the simplify and resample options, 0 disables them, tiny values would make a single call process
+    millions of coordinates
+    :param args: arguments
+    :return: description of the invalid option, None if the options are valid
+    """
+    for name, minimum, unit in (('simplify', MIN_SIMPLIFY_METERS, 'meters'),
+                                ('resample', MIN_RESAMPLE_SECONDS, 'seconds')):
+        value = args.get(name, type=float)
+        if args.get(name) is not None and (value is None or not math.isfinite(value)):
+            return '%s must be a number' % name
+        if value is not None and value != 0 and value < minimum:
+            return '%s must be 0 or at least %s %s' % (name, minimum, unit)
+    return None
 
+
+def process_output_options(args, output_formats: tuple = OUTPUT_FORMATS):
+    """
+    Sanity checks output format options, raises exception if options are not within specs
+    :param args: arguments
+    :param output_formats: output formats supported by the api call
+    :return: output format, coordinate precision and trajectory processor
+    """
+    output_format = args.get('format', type=str, default='jpg')
+    if output_format not in output_formats:
+        raise Exception('format must be one of %s' % ', '.join(output_formats))
+
+    precision = args.get('precision', type=int)
+    if args.get('precision') is not None and precision is None:
+        raise Exception('precision must be an integer')
+    if precision is not None and (precision < 0 or precision > 15):
+        raise Exception('precision must be between %i and %i' % (0, 15))
+
+    message = check_trajectory_options(args)
+    if message is not None:
+        raise Exception(message)
+    simplify = args.get('simplify', type=float)
+    resample = args.get('resample', type=float)
+
+    return output_format, precision, TrajectoryProcessor(simplify=simplify, resample=resample)
@@ -1,22 +1,62 @@
+from ovm.ingestpolicy import DEFAULT_ALTITUDE_TIERS, DEFAULT_FULL_RATE_ALTITUDE
+
 # pro6pp configuration
 PRO6PP_AUTH_KEY = '<PRO6PP_AUTH_KEY>'
 PRO6PP_API_AUTO_COMPLETE_URL = 'https://api.pro6pp.nl/v2/autocomplete/nl'
 PRO6PP_API_AUTO_LOCATOR_URL = 'https://api.pro6pp.nl/v2/locator/nl'
 
+# offline postal code centroid table, built from a CSV using build_postalcode_table.py
+POSTALCODE_TABLE_FILE = 'postalcodes.bin'
+
 # lat lon address cache
 LATLON_CACHE_EXPIRATION_DAYS = 180
 
+# in-process geocoder cache in front of the lat lon address cache
+GEOCODER_CACHE_SIZE = 10000
+GEOCODER_CACHE_TTL_SECONDS = 3600
+
 # old records retention in days
 STATES_RETENTION_DAYS = 31
 
 # log interval
 LOG_INTERVAL_SECONDS = 10
 
+# adaptive log interval, grows up to LOG_INTERVAL_MAX_SECONDS while there are no planes at or below
+# PLANELOGGER_FULL_RATE_ALTITUDE, equal to LOG_INTERVAL_SECONDS disables adaptive polling
+LOG_INTERVAL_MAX_SECONDS = 60
+
+# altitude-tiered sampling, planes at or below PLANELOGGER_FULL_RATE_ALTITUDE meters are stored every poll
+# higher planes are stored at most once per interval of their tier given as (min altitude meters, interval seconds)
+PLANELOGGER_FULL_RATE_ALTITUDE = DEFAULT_FULL_RATE_ALTITUDE
+PLANELOGGER_ALTITUDE_TIERS = DEFAULT_ALTITUDE_TIERS
+
+# Seconds a thinned plane may be missing from the snapshots around a flight before its trajectory ends, None derives it
+# from the tiers and LOG_INTERVAL_MAX_SECONDS above. Set it when states are logged by logger.py with other tiers or
+# --maxinterval, logger.py logs the gap of its settings at startup
+TRAJECTORY_MAX_GAP_SECONDS = None
+
 # planelogger bbox
 PLANELOGGER_ENABLE = True
 PLANELOGGER_CENTER = (52.108, 5.665)
 PLANELOGGER_RADIUS = 150000
 
+# planelogger regions as list of ((lat, lon), radius) tuples, replaces center and radius when set
+# regions are split into tiles no larger than PLANELOGGER_TILE_SIZE meters which are fetched concurrently
+PLANELOGGER_REGIONS = None
+PLANELOGGER_TILE_SIZE = None
+PLANELOGGER_FETCH_THREADS = 4
+
+# planelogger storage stage, maximum amount of snapshots waiting to be written and written in one bulk write
+PLANELOGGER_MAX_PENDING_SNAPSHOTS = 64
+PLANELOGGER_WRITE_BATCH_SIZE = 16
+
+# planelogger stores every n-th snapshot in full and the others as delta to the previous snapshot, 1 disables deltas
+PLANELOGGER_KEYFRAME_INTERVAL = 30
+
+# planelogger write-ahead spool for states that could not be written into the database, None disables spooling
+PLANELOGGER_SPOOL_FILE = 'states.spool'
+PLANELOGGER_SPOOL_REPLAY_INTERVAL_SECONDS = 30
+
 # deploy test API
 DEPLOY_TEST_API = True
 
@@ -25,3 +65,77 @@ LOGLEVEL = 'INFO'
 
 # Time of temporary files to stay alive
 TEMP_DIR_FILE_ALIVE_TIME_SECONDS = 300
+
+# API responses larger than this amount of bytes get compressed if the client accepts it
+RESPONSE_COMPRESSION_MIN_BYTES = 1024
+
+# Directory worker processes spool encoded responses to, None uses /dev/shm when available
+RESULT_SPOOL_DIR = None
+
+# find_flights and find_disturbances calls arriving within this window and overlapping in time range share a single
+# scan in one worker process, 0 disables coalescing
+QUERY_COALESCING_WINDOW_SECONDS = 0.05
+QUERY_COALESCING_MAX_QUERIES = 16
+
+# Time budget of a single API call in seconds, enforced on the worker process and as time limit of database queries
+# Memory budget of a worker process in megabytes, counts the data inherited from the web process. None for no limit
+QUERY_MAX_SECONDS = 300
+QUERY_MEMORY_LIMIT_MB = 4096
+
+# Memory ceiling of a worker process in megabytes, the resident memory it may add to what it inherited from the web
+# process. Checked while scanning and before plotting, the call fails with an error once it is exceeded. None for no
+# ceiling. QUERY_MEMORY_TRACING traces the allocations of every API call using tracemalloc and reports the peak in
+# meta.memory, tracing slows the calls down
+QUERY_MEMORY_CEILING_MB = 1024
+QUERY_MEMORY_TRACING = False
+
+# Maximum amount of disturbance periods with a plot or GeoJSON a find_disturbances call returns, the call fails with an
+# error when it finds more. Found disturbances are held in memory until the result is encoded, a plotted period takes
+# up to a few megabytes, keep the product well below QUERY_MEMORY_CEILING_MB. None for no limit
+QUERY_MAX_RESULT_PERIODS = 64
+
+# Admission control of API calls for all web processes together, calls requesting a plot are expensive, others cheap
+# At most MAX_RUNNING calls of a class run at the same time and at most MAX_WAITING calls wait up to
+# ADMISSION_MAX_WAIT_SECONDS for their turn, other calls are rejected with 429 Too Many Requests
+# A waiting call holds a sync gunicorn worker, by default calls are rejected right away when no running slot is free.
+# When enabling waiting keep the sum of both MAX_WAITING well below the amount of gunicorn workers
+# Jobs don't hold a web worker, at most MAX_QUEUED_JOBS jobs of a class wait in the queued state for a running slot,
+# other jobs are rejected with 429 as well. Every queued job is a waiting worker process
+# Slots are lock files in ADMISSION_DIR, None uses omd_admission in the result spool directory
+ADMISSION_CHEAP_MAX_RUNNING = 8
+ADMISSION_CHEAP_MAX_WAITING = 0
+ADMISSION_EXPENSIVE_MAX_RUNNING = 2
+ADMISSION_EXPENSIVE_MAX_WAITING = 0
+ADMISSION_CHEAP_MAX_QUEUED_JOBS = 16
+ADMISSION_EXPENSIVE_MAX_QUEUED_JOBS = 4
+ADMISSION_MAX_WAIT_SECONDS = 2
+ADMISSION_DIR = None
+
+# Job API, jobs are kept in JOB_DIR, None uses omd_jobs in the result spool directory
+# Running jobs whose status is not requested within JOB_ABANDON_SECONDS are cancelled, finished jobs are removed
+# JOB_EXPIRE_SECONDS after their status was last requested. Progress is written at most every
+# JOB_PROGRESS_INTERVAL_SECONDS. Job event streams end after JOB_EVENTS_MAX_SECONDS so they hold a web worker only
+# shortly, clients reconnect and continue using Last-Event-ID
+JOB_DIR = None
+JOB_ABANDON_SECONDS = 60
+JOB_EXPIRE_SECONDS = 600
+JOB_PROGRESS_INTERVAL_SECONDS = 1.0
+JOB_EVENTS_MAX_SECONDS = 15
+
+# Metrics of all web and worker processes are added up in METRICS_DIR and exposed on /metrics in the Prometheus text
+# format, None uses omd_metrics in the result spool directory
+METRICS_DIR = None
+
+# Profiling, an API call is profiled when it passes profile=1 or the X-Profile: 1 header together with the
+# X-Admin-Token header matching PROFILING_ADMIN_TOKEN, None disables profiling of API calls and the profiles endpoints
+# PLANELOGGER_PROFILE_RATE is the fraction of planelogger runs that is profiled, 0 disables it
+# Profiles are kept in PROFILE_DIR, None uses omd_profiles in the result spool directory, the latest PROFILE_MAX_COUNT
+# profiles are kept
+PROFILING_ADMIN_TOKEN = None
+PLANELOGGER_PROFILE_RATE = 0.0
+PROFILE_DIR = None
+PROFILE_MAX_COUNT = 100
+
+# Import the raster plotting stack in a background thread of every gunicorn worker after it is forked, see
+# gunicorn.conf.py, so the first jpg plot of a worker doesn't pay for the import. Workers start as fast as before
+WARM_PLOTTER = True
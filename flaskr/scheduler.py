@@ -3,9 +3,15 @@ from datetime import datetime, timedelta
 from apscheduler.schedulers.background import BackgroundScheduler
 from flaskr import environment
 from flaskr.filehandler import remove_temp_files
+from flaskr.utils.jobstore import get_job_store
+from flaskr.utils.profilestore import get_profile_store
 from flaskr.utils.databasecollectionhandler import DatabaseCollectionHandler
 from ovm.environment import load_environment
+from ovm.ingestpolicy import IngestPolicy
 from ovm.planelogger import PlaneLogger
+from ovm.statespool import StateSpool
+from ovm.statestore import get_state_store
+from ovm.statewriter import StateWriter
 
 
 class Scheduler:
@@ -23,24 +29,63 @@ class Scheduler:
         # Fire up temporary files remove job
         self.scheduler.add_job(func=remove_temp_files, trigger='interval', seconds=60)
 
+        # Fire up job cleanup, cancels abandoned jobs and removes expired jobs of all web processes
+        self.job_store = get_job_store()
+        self.scheduler.add_job(func=self.job_store.cleanup, trigger='interval', seconds=15)
+
         # Create database handler
         self.database_handler = DatabaseCollectionHandler(self.environment)
-        self.scheduler.add_job(func=self._remove_entries_job, trigger='interval', days=1)
-        self._remove_entries_job()
+        self.scheduler.add_job(func=self._remove_entries_job, trigger='interval', days=1, next_run_time=datetime.now())
 
         # Create plane logger
+        self.plane_logger = None
         if environment.PLANELOGGER_ENABLE:
-            self.plane_logger = PlaneLogger(self.environment)
-            self.scheduler.add_job(func=self._log_planes, trigger='interval', seconds=environment.LOG_INTERVAL_SECONDS)
+            spool = None
+            if environment.PLANELOGGER_SPOOL_FILE is not None:
+                spool = StateSpool(environment.PLANELOGGER_SPOOL_FILE)
+            state_writer = StateWriter(get_state_store(self.environment,
+                                                       keyframe_interval=environment.PLANELOGGER_KEYFRAME_INTERVAL),
+                                       max_pending=environment.PLANELOGGER_MAX_PENDING_SNAPSHOTS,
+                                       batch_size=environment.PLANELOGGER_WRITE_BATCH_SIZE,
+                                       spool=spool,
+                                       replay_interval=environment.PLANELOGGER_SPOOL_REPLAY_INTERVAL_SECONDS)
+            policy = IngestPolicy(full_rate_altitude=environment.PLANELOGGER_FULL_RATE_ALTITUDE,
+                                  tiers=environment.PLANELOGGER_ALTITUDE_TIERS,
+                                  min_interval=environment.LOG_INTERVAL_SECONDS,
+                                  max_interval=environment.LOG_INTERVAL_MAX_SECONDS)
+            self.plane_logger = PlaneLogger(self.environment,
+                                            state_writer=state_writer,
+                                            max_tile_size=environment.PLANELOGGER_TILE_SIZE,
+                                            fetch_threads=environment.PLANELOGGER_FETCH_THREADS,
+                                            policy=policy,
+                                            profile_store=get_profile_store()
+                                            if environment.PLANELOGGER_PROFILE_RATE > 0 else None,
+                                            profile_rate=environment.PLANELOGGER_PROFILE_RATE)
+            self.log_interval = environment.LOG_INTERVAL_SECONDS
+            self.log_job = self.scheduler.add_job(func=self._log_planes, trigger='interval', seconds=self.log_interval)
 
         # Start scheduler
         self.scheduler.start()
 
     def _remove_entries_job(self):
+        # Export closed days to cold storage before they expire, the last day is left open for late spool replays
+        # Entries are only removed once the export succeeded
+        if self.database_handler.cold_storage is not None:
+            self.database_handler.export_days_before(datetime.now() - timedelta(days=1))
+            self.database_handler.cold_storage.preload()
         self.database_handler.remove_entries_older_than(datetime.now() - timedelta(days=environment.STATES_RETENTION_DAYS))
 
     def _log_planes(self):
-        self.plane_logger.log(center=environment.PLANELOGGER_CENTER, radius=environment.PLANELOGGER_RADIUS)
+        self.plane_logger.log(center=environment.PLANELOGGER_CENTER,
+                              radius=environment.PLANELOGGER_RADIUS,
+                              regions=environment.PLANELOGGER_REGIONS)
+
+        # Follow the poll interval decided by the ingest policy
+        interval = self.plane_logger.get_interval(environment.LOG_INTERVAL_SECONDS)
+        if interval != self.log_interval:
+            logging.info('Scheduler: Log interval changes from %f to %f seconds' % (self.log_interval, interval))
+            self.log_interval = interval
+            self.log_job.reschedule(trigger='interval', seconds=interval)
 
 
 
@@ -0,0 +1,245 @@
+import fcntl
+import math
+import os
+import random
+import threading
+import time
+
+
+class _Slots:
+    """
+    A fixed amount of slots shared by all processes, a slot is an exclusive lock on a file
+    The kernel releases the lock when the holding process ends, a crashed process never keeps a slot
+    """
+    def __init__(self, directory: str, name: str, count: int):
+        """
+        Constructor
+        :param directory: directory of the lock files
+        :param name: name of the slots, prefix of the lock files
+        :param count: amount of slots
+        """
+        self.paths = [os.path.join(directory, '%s_%i.lock' % (name, idx)) for idx in range(count)]
+
+    def try_acquire(self):
+        """
+        Returns the file descriptor of a free slot, None if all slots are taken
+        """
+        offset = random.randrange(len(self.paths)) if len(self.paths) > 0 else 0
+        for idx in range(len(self.paths)):
+            fd = os.open(self.paths[(offset + idx) % len(self.paths)], os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                os.close(fd)
+        return None
+
+    @staticmethod
+    def release(fd: int):
+        """
+        Releases a slot, also when the descriptor was inherited by a forked process
+        """
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    @staticmethod
+    def hand_over(fd: int):
+        """
+        Closes the descriptor of a slot inherited by a forked process without releasing the slot, the forked process
+        holds the slot until it releases it or ends
+        """
+        os.close(fd)
+
+
+class _AdmissionClass:
+    """
+    Running, waiting and queued job slots and statistics of a class of requests
+    """
+    def __init__(self, directory: str, name: str, max_running: int, max_waiting: int, max_queued: int):
+        self.name = name
+        self.max_running = max_running
+        self.max_waiting = max_waiting
+        self.max_queued = max_queued
+        self.running = _Slots(directory, name + '_running', max_running)
+        self.waiting = _Slots(directory, name + '_waiting', max_waiting)
+        self.queued = _Slots(directory, name + '_queued', max_queued)
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.run_count = 0
+        self.run_seconds_total = 0.0
+
+
+class AdmissionTicket:
+    """
+    An admitted request, holds its running slot until it is released
+    """
+    def __init__(self, admission_class: _AdmissionClass, fd: int):
+        self.admission_class = admission_class
+        self.fd = fd
+        self.admitted = time.perf_counter()
+
+
+class AdmissionController:
+    """
+    The AdmissionController limits the amount of requests running at the same time per class of requests, for all web
+    processes together. Requests that can't run wait in a bounded queue, a request is rejected right away when the
+    queue is full or when it waited too long, so the admitted requests keep finishing in time under overload
+    A waiting request holds its web worker, without waiting slots requests are rejected as soon as no running slot is
+    free. Waiting requests try to get a running slot with an interval doubling from poll_interval up to
+    max_poll_interval
+    Jobs don't hold a web worker, a job that can't run waits in its own bounded queue of the class until its worker
+    process gets a running slot, a job is rejected right away when that queue is full
+    Slots are locked files in a directory shared by the web processes
+    Keeps admission and queue wait statistics of this process
+    """
+    def __init__(self,
+                 directory: str,
+                 limits: dict,
+                 max_wait: float = 10,
+                 poll_interval: float = 0.01,
+                 max_poll_interval: float = 0.1):
+        """
+        Constructor
+        :param directory: directory of the slot lock files
+        :param limits: maximum amount of running requests, waiting requests and queued jobs as
+        (max_running, max_waiting, max_queued) tuple by class
+        :param max_wait: maximum seconds a request waits in the queue before it is rejected, 0 rejects right away
+        :param poll_interval: initial seconds between attempts to get a running slot while waiting
+        :param max_poll_interval: maximum seconds between attempts to get a running slot while waiting
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.classes = {name: _AdmissionClass(directory, name, max_running, max_waiting, max_queued)
+                        for name, (max_running, max_waiting, max_queued) in limits.items()}
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.lock = threading.Lock()
+
+    def try_acquire(self, name: str):
+        """
+        Admits a request of a class if a running slot is free, without waiting
+        :param name: name of the class
+        :return: AdmissionTicket to release when the request is done, None if no slot is free
+        """
+        fd = self.classes[name].running.try_acquire()
+        if fd is None:
+            return None
+        with self.lock:
+            self.classes[name].admitted += 1
+        return AdmissionTicket(self.classes[name], fd)
+
+    def try_queue(self, name: str):
+        """
+        Queues a job of a class if a queue slot is free, without waiting
+        :param name: name of the class
+        :return: file descriptor of the queue slot to release once the job is admitted, None if the job is rejected
+        """
+        fd = self.classes[name].queued.try_acquire()
+        if fd is None:
+            with self.lock:
+                self.classes[name].rejected += 1
+        return fd
+
+    @staticmethod
+    def release_queued(fd: int):
+        """
+        Releases the queue slot of a job
+        :param fd: the file descriptor returned by try_queue
+        """
+        _Slots.release(fd)
+
+    @staticmethod
+    def hand_over(ticket: AdmissionTicket = None, queued_fd: int = None):
+        """
+        Hands the running slot of an admitted request or the queue slot of a job over to the forked process executing
+        it, closes the descriptors of this process without releasing the slots
+        :param ticket: the ticket returned by try_acquire, None if not admitted
+        :param queued_fd: the file descriptor returned by try_queue, None if not queued
+        """
+        if ticket is not None:
+            _Slots.hand_over(ticket.fd)
+        if queued_fd is not None:
+            _Slots.hand_over(queued_fd)
+
+    def acquire(self, name: str):
+        """
+        Admits a request of a class, waits for a running slot while there is room in the queue
+        :param name: name of the class
+        :return: AdmissionTicket to release when the request is done, None if the request is rejected
+        """
+        admission_class = self.classes[name]
+        begin = time.perf_counter()
+        fd = admission_class.running.try_acquire()
+        if fd is None:
+            waiting_fd = admission_class.waiting.try_acquire() if self.max_wait > 0 else None
+            if waiting_fd is None:
+                with self.lock:
+                    admission_class.rejected += 1
+                return None
+            try:
+                interval = self.poll_interval
+                while fd is None and time.perf_counter() - begin < self.max_wait:
+                    time.sleep(min(interval, max(0.0, self.max_wait - (time.perf_counter() - begin))))
+                    interval = min(interval * 2, self.max_poll_interval)
+                    fd = admission_class.running.try_acquire()
+            finally:
+                _Slots.release(waiting_fd)
+
+        waited = time.perf_counter() - begin
+        with self.lock:
+            admission_class.wait_seconds_total += waited
+            admission_class.wait_seconds_max = max(admission_class.wait_seconds_max, waited)
+            if fd is None:
+                admission_class.timed_out += 1
+                return None
+            admission_class.admitted += 1
+        return AdmissionTicket(admission_class, fd)
+
+    def release(self, ticket: AdmissionTicket):
+        """
+        Releases the running slot of an admitted request
+        :param ticket: the ticket returned by acquire
+        """
+        _Slots.release(ticket.fd)
+        with self.lock:
+            ticket.admission_class.run_count += 1
+            ticket.admission_class.run_seconds_total += time.perf_counter() - ticket.admitted
+
+    def get_retry_after(self, name: str, job: bool = False):
+        """
+        Returns the seconds a rejected request of a class should wait before retrying, the estimated time to work off
+        a full queue
+        :param name: name of the class
+        :param job: estimate for a rejected job, working off the queue of jobs
+        :return: seconds as integer, at least 1
+        """
+        admission_class = self.classes[name]
+        if admission_class.run_count == 0:
+            return 1
+        average = admission_class.run_seconds_total / admission_class.run_count
+        queue_length = admission_class.max_queued if job else admission_class.max_waiting
+        return max(1, math.ceil(average * max(1, queue_length) / max(1, admission_class.max_running)))
+
+    def get_stats(self):
+        """
+        Returns admission, rejection and queue wait statistics by class
+        :return: dictionary holding the statistics
+        """
+        stats = {}
+        for name, admission_class in self.classes.items():
+            requests = admission_class.admitted + admission_class.timed_out
+            stats[name] = {'max_running': admission_class.max_running,
+                           'max_waiting': admission_class.max_waiting,
+                           'max_queued': admission_class.max_queued,
+                           'admitted': admission_class.admitted,
+                           'rejected': admission_class.rejected,
+                           'timed_out': admission_class.timed_out,
+                           'wait_seconds_total': admission_class.wait_seconds_total,
+                           'wait_seconds_max': admission_class.wait_seconds_max,
+                           'wait_seconds_average': admission_class.wait_seconds_total / requests if requests > 0
+                           else 0.0,
+                           'run_seconds_total': admission_class.run_seconds_total}
+        return stats
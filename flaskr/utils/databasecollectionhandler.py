@@ -1,50 +1,86 @@
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 
-import pymongo
-from pymongo import MongoClient
+from ovm.coldstorage import get_cold_storage
 from ovm.environment import Environment, load_environment
+from ovm.mongostatestore import MongoStateStore
+from ovm.snapshotcodec import KEYFRAME_FIELD, DELTA_FIELD
+from ovm.statepartitions import get_day
+from ovm.statereader import StateReader
+from ovm.statestore import get_state_store
 from ovm.utils import convert_datetime_to_int, convert_int_to_datetime
 
 
 class DatabaseCollectionHandler:
     """
-    The database handler exposes some utility methods to modify a collection in a mongo database
+    The database handler exposes some utility methods to modify the states in the state store
     """
     def __init__(self, environment: Environment):
         # Set environment
         self.environment = environment
 
-        # Create MongoDB client
-        self.mongo_client = MongoClient(environment.mongodb_config.host,
-                                        environment.mongodb_config.port)
+        # Acquire the state store
+        self.store = get_state_store(environment)
 
-        # Acquire the collection
-        self.collection = self.mongo_client[self.environment.mongodb_config.database][environment.mongodb_config.collection]
+        # Acquire the cold storage, None if not configured
+        self.cold_storage = get_cold_storage(environment)
+
+    def export_days_before(self, timestamp: datetime):
+        """
+        Exports all days before timestamp that are not in cold storage yet
+        :param timestamp: days before the day of timestamp are exported
+        :return: amount of exported days
+        """
+        if self.cold_storage is None:
+            return 0
+
+        first_time = self.store.get_first_time()
+        if first_time is None:
+            return 0
+
+        exported_days = set(self.cold_storage.list_days())
+        state_reader = StateReader(self.store)
+        day = convert_int_to_datetime(first_time).replace(hour=0, minute=0, second=0)
+        exported = 0
+        while day.date() < timestamp.date():
+            day_int = get_day(convert_datetime_to_int(day))
+            if day_int not in exported_days:
+                logging.info('Exporting states of %s to cold storage' % day.date().__str__())
+                snapshots = state_reader.scan(day_int * 1000000, day_int * 1000000 + 235959)
+                if self.cold_storage.export_day(day_int, snapshots) > 0:
+                    exported += 1
+            day += timedelta(days=1)
+        return exported
 
     def remove_entries_older_than(self, timestamp: datetime):
         logging.info('Deleting states from collection before %s' % timestamp.__str__())
-        timestamp_int = convert_datetime_to_int(timestamp)
-        self.collection.delete_many({'Time': {'$lte': timestamp_int}})
+        self.store.remove_older_than(convert_datetime_to_int(timestamp))
 
     def remove_entries_newer_than(self, timestamp: datetime):
         logging.info('Deleting states from collection after %s' % timestamp.__str__())
-        timestamp_int = convert_datetime_to_int(timestamp)
-        self.collection.delete_many({'Time': {'$gte': timestamp_int}})
+        self.store.remove_newer_than(convert_datetime_to_int(timestamp))
 
     def add_property_to_all_states(self, property_name: str, default_value):
-        cursor = self.collection.find({}).allow_disk_use(True)
-        for doc in cursor:
-            # Get all states
-            states = doc['States']
-            timestamp = doc['Time']
-            update = False
-            for state in states:
-                if property_name not in state:
-                    state[property_name] = default_value
-                    update = True
-            if update:
-                self.collection.update_one({'Time': timestamp}, {"$set": {'States': states}})
-
-
+        if not isinstance(self.store, MongoStateStore):
+            raise Exception('Adding properties is only supported by the mongodb state store')
 
+        for collection in self.store.partitions.get_collections():
+            cursor = collection.find({}).allow_disk_use(True)
+            for doc in cursor:
+                # Get all states, of a delta only the states it holds
+                timestamp = doc['Time']
+                if KEYFRAME_FIELD in doc:
+                    field = KEYFRAME_FIELD
+                    value = doc[KEYFRAME_FIELD]
+                    states = value
+                else:
+                    field = DELTA_FIELD
+                    value = doc[DELTA_FIELD]
+                    states = value['Upserts'] + value['Unkeyed']
+                update = False
+                for state in states:
+                    if property_name not in state:
+                        state[property_name] = default_value
+                        update = True
+                if update:
+                    collection.update_one({'Time': timestamp}, {"$set": {field: value}})
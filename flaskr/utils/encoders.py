@@ -0,0 +1,309 @@
+import dataclasses
+import gzip
+import io
+import json
+import zlib
+import brotli
+import msgpack
+from flask import Response
+from ovm.utils import dataclass_to_dict, DataclassJSONEncoder
+
+# Supported response mimetypes, the first one is the default
+JSON_MIMETYPE = 'application/json'
+MSGPACK_MIMETYPE = 'application/msgpack'
+MSGPACK_LEGACY_MIMETYPE = 'application/x-msgpack'
+ARROW_MIMETYPE = 'application/vnd.apache.arrow.stream'
+RESPONSE_MIMETYPES = [JSON_MIMETYPE, MSGPACK_MIMETYPE, MSGPACK_LEGACY_MIMETYPE, ARROW_MIMETYPE]
+
+# Supported content encodings in order of preference
+RESPONSE_ENCODINGS = ['br', 'gzip']
+
+# Kinds of values with a columnar representation, the kind of an API call fixes the schema of its Arrow responses, also
+# of empty ones. See response_to_table
+TABLE_TRAJECTORY = 'trajectory'
+TABLE_DISTURBANCES = 'disturbances'
+
+
+def encode_json(response: dict):
+    """
+    Encodes response as compact JSON, dataclasses are serialized without deep copies
+    :param response: the response dict
+    :return: encoded bytes
+    """
+    return json.dumps(response, cls=DataclassJSONEncoder, separators=(',', ':')).encode('utf-8')
+
+
+def iter_json(response: dict, chunk_items: int = 16):
+    """
+    Encodes response as compact JSON like encode_json, in chunks
+    Lists at the top level of the response, such as the found disturbances, are encoded chunk_items elements at a time,
+    so the encoded document is never held in memory as a whole
+    :param response: the response dict
+    :param chunk_items: amount of list elements per chunk
+    :return: yields encoded bytes
+    """
+    encoder = DataclassJSONEncoder(separators=(',', ':'))
+    for idx, (key, value) in enumerate(response.items()):
+        yield ('{' if idx == 0 else ',').encode('utf-8') + encoder.encode(key).encode('utf-8') + b':'
+        if not isinstance(value, list):
+            yield encoder.encode(value).encode('utf-8')
+            continue
+        yield b'['
+        for begin in range(0, len(value), chunk_items):
+            chunk = encoder.encode(value[begin:begin + chunk_items])[1:-1].encode('utf-8')
+            yield chunk if begin == 0 else b',' + chunk
+        yield b']'
+    yield b'}' if len(response) > 0 else b'{}'
+
+
+def _msgpack_default(o):
+    if dataclasses.is_dataclass(o):
+        return dataclass_to_dict(o)
+    raise TypeError('Object of type %s is not MessagePack serializable' % o.__class__.__name__)
+
+
+def encode_msgpack(response: dict):
+    """
+    Encodes response as MessagePack, dataclasses are serialized without deep copies
+    :param response: the response dict
+    :return: encoded bytes
+    """
+    return msgpack.packb(response, default=_msgpack_default, use_bin_type=True)
+
+
+def _get(o, name: str):
+    if isinstance(o, dict):
+        return o.get(name)
+    return getattr(o, name, None)
+
+
+def response_to_table(response: dict, kind: str = None):
+    """
+    Converts the value of a response into a columnar arrow table, the schema is given by kind
+    Disturbances are flattened into one row per callsign with a disturbance index column, begin, end, image and
+    geojson of each disturbance are stored as JSON in the schema metadata
+    Trajectories are converted into lat, lon columns
+    Returns None if the value has no columnar representation, for example an error message
+    :param response: the response dict
+    :param kind: TABLE_TRAJECTORY or TABLE_DISTURBANCES, None if the value has no columnar representation
+    :return: pyarrow Table or None
+    """
+    import pyarrow
+
+    value = response.get('value')
+    metadata = {'status': response.get('status', ''),
+                'meta': json.dumps(response.get('meta', {}), cls=DataclassJSONEncoder)}
+
+    if kind == TABLE_TRAJECTORY:
+        # GeoJSON trajectory feature, coordinates are ordered lon, lat
+        if isinstance(value, dict) and value.get('type') == 'Feature':
+            coords = value['geometry']['coordinates']
+            metadata['properties'] = json.dumps(value.get('properties', {}))
+            return pyarrow.table({'lat': pyarrow.array([coord[1] for coord in coords], type=pyarrow.float64()),
+                                  'lon': pyarrow.array([coord[0] for coord in coords], type=pyarrow.float64())},
+                                 metadata=metadata)
+
+        # Trajectory coordinates, ordered lat, lon
+        if isinstance(value, list):
+            return pyarrow.table({'lat': pyarrow.array([coord[0] for coord in value], type=pyarrow.float64()),
+                                  'lon': pyarrow.array([coord[1] for coord in value], type=pyarrow.float64())},
+                                 metadata=metadata)
+        return None
+
+    if kind != TABLE_DISTURBANCES or not isinstance(value, list):
+        return None
+
+    # Disturbances
+    columns = {'disturbance': [], 'callsign': [], 'time': [], 'altitude': [], 'icao24': [], 'lat': [], 'lon': []}
+    disturbances = []
+    for idx, disturbance in enumerate(value):
+        for info in _get(disturbance, 'callsigns') or []:
+            coord = _get(info, 'coord') or (None, None)
+            columns['disturbance'].append(idx)
+            columns['callsign'].append(_get(info, 'callsign'))
+            columns['time'].append(_get(info, 'datetime'))
+            columns['altitude'].append(_get(info, 'altitude'))
+            columns['icao24'].append(_get(info, 'icao24'))
+            columns['lat'].append(coord[0])
+            columns['lon'].append(coord[1])
+        disturbances.append({'begin': _get(disturbance, 'begin'),
+                             'end': _get(disturbance, 'end'),
+                             'img': _get(disturbance, 'img'),
+                             'geojson': _get(disturbance, 'geojson')})
+    metadata['disturbances'] = json.dumps(disturbances)
+
+    return pyarrow.table({'disturbance': pyarrow.array(columns['disturbance'], type=pyarrow.int32()),
+                          'callsign': pyarrow.array(columns['callsign'], type=pyarrow.string()),
+                          'time': pyarrow.array(columns['time'], type=pyarrow.int64()),
+                          'altitude': pyarrow.array(columns['altitude'], type=pyarrow.float64()),
+                          'icao24': pyarrow.array(columns['icao24'], type=pyarrow.string()),
+                          'lat': pyarrow.array(columns['lat'], type=pyarrow.float64()),
+                          'lon': pyarrow.array(columns['lon'], type=pyarrow.float64())},
+                         metadata=metadata)
+
+
+def encode_arrow(response: dict, kind: str = None):
+    """
+    Encodes response as Arrow IPC stream, see response_to_table
+    :param response: the response dict
+    :param kind: kind of the value, see response_to_table
+    :return: encoded bytes or None if the response has no columnar representation
+    """
+    import pyarrow
+
+    table = response_to_table(response, kind)
+    if table is None:
+        return None
+
+    with io.BytesIO() as buffer:
+        with pyarrow.ipc.new_stream(buffer, table.schema) as writer:
+            writer.write_table(table)
+        return buffer.getvalue()
+
+
+def compress(data: bytes, encoding: str):
+    """
+    Compresses data with given content encoding
+    :param data: the data
+    :param encoding: br or gzip
+    :return: compressed data
+    """
+    if encoding == 'br':
+        return brotli.compress(data, quality=5)
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=6)
+    return data
+
+
+def get_compressor(encoding: str):
+    """
+    Returns an incremental compressor of given content encoding, compressing like compress
+    :param encoding: br or gzip
+    :return: compress and finish functions, compress returns compressed data of the data passed so far, finish the
+    remaining compressed data
+    """
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=5)
+        return compressor.process, compressor.finish
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        return compressor.compress, compressor.flush
+    raise Exception('Unsupported content encoding %s' % encoding)
+
+
+def negotiate(accept_mimetypes, accept_encodings):
+    """
+    Picks the response mimetype and content encoding best matching the request
+    :param accept_mimetypes: accepted mimetypes of the request (request.accept_mimetypes)
+    :param accept_encodings: accepted encodings of the request (request.accept_encodings)
+    :return: mimetype and content encoding, encoding is None if no supported encoding is accepted
+    """
+    mimetype = accept_mimetypes.best_match(RESPONSE_MIMETYPES, default=JSON_MIMETYPE)
+    encoding = accept_encodings.best_match(RESPONSE_ENCODINGS)
+    return mimetype, encoding
+
+
+def encode_body(response: dict,
+                mimetype: str,
+                encoding: str = None,
+                min_compress_size: int = 1024,
+                kind: str = None):
+    """
+    Encodes response as JSON, MessagePack or Arrow IPC, responses without a columnar representation fall back to JSON
+    when Arrow is requested. Responses larger than min_compress_size are compressed using given encoding
+    :param response: the response dict
+    :param mimetype: the negotiated mimetype
+    :param encoding: the negotiated content encoding, None disables compression
+    :param min_compress_size: minimum response size in bytes before compression is applied
+    :param kind: kind of the value, see response_to_table
+    :return: encoded data, mimetype and content encoding actually used
+    """
+    data = None
+    if mimetype == ARROW_MIMETYPE:
+        data = encode_arrow(response, kind)
+    elif mimetype in (MSGPACK_MIMETYPE, MSGPACK_LEGACY_MIMETYPE):
+        data = encode_msgpack(response)
+    if data is None:
+        mimetype = JSON_MIMETYPE
+        data = encode_json(response)
+
+    if encoding is not None and len(data) >= min_compress_size:
+        data = compress(data, encoding)
+    else:
+        encoding = None
+
+    return data, mimetype, encoding
+
+
+def write_body(fh,
+               response: dict,
+               mimetype: str,
+               encoding: str = None,
+               min_compress_size: int = 1024,
+               kind: str = None):
+    """
+    Encodes response like encode_body and writes it into a file
+    JSON is encoded and compressed in chunks, see iter_json, so the encoded response is never held in memory as a whole.
+    MessagePack and Arrow IPC are encoded in memory
+    :param fh: file opened for writing bytes
+    :param response: the response dict
+    :param mimetype: the negotiated mimetype
+    :param encoding: the negotiated content encoding, None disables compression
+    :param min_compress_size: minimum response size in bytes before compression is applied
+    :param kind: kind of the value, see response_to_table
+    :return: written size in bytes, mimetype and content encoding actually used
+    """
+    if mimetype != JSON_MIMETYPE:
+        data, mimetype, encoding = encode_body(response, mimetype, encoding, min_compress_size, kind)
+        fh.write(data)
+        return len(data), mimetype, encoding
+
+    # The first min_compress_size bytes are held back until it is known whether the response gets compressed
+    size = 0
+    head = b''
+    compress, finish = None, None
+    for chunk in iter_json(response):
+        if encoding is not None and compress is None:
+            head += chunk
+            if len(head) < min_compress_size:
+                continue
+            compress, finish = get_compressor(encoding)
+            chunk = head
+            head = b''
+        data = compress(chunk) if compress is not None else chunk
+        fh.write(data)
+        size += len(data)
+
+    if finish is not None:
+        data = finish()
+    else:
+        data = head
+        encoding = None
+    fh.write(data)
+    return size + len(data), mimetype, encoding
+
+
+def get_headers(encoding: str = None):
+    """
+    Returns the headers of an encoded response
+    :param encoding: the content encoding used, None if uncompressed
+    :return: headers dict
+    """
+    headers = {'Vary': 'Accept, Accept-Encoding'}
+    if encoding is not None:
+        headers['Content-Encoding'] = encoding
+    return headers
+
+
+def encode_response(response: dict, accept_mimetypes, accept_encodings, min_compress_size: int = 1024):
+    """
+    Encodes response using content negotiation, see negotiate and encode_body
+    :param response: the response dict
+    :param accept_mimetypes: accepted mimetypes of the request (request.accept_mimetypes)
+    :param accept_encodings: accepted encodings of the request (request.accept_encodings)
+    :param min_compress_size: minimum response size in bytes before compression is applied
+    :return: flask Response
+    """
+    mimetype, encoding = negotiate(accept_mimetypes, accept_encodings)
+    data, mimetype, encoding = encode_body(response, mimetype, encoding, min_compress_size)
+    return Response(data, mimetype=mimetype, headers=get_headers(encoding))
@@ -0,0 +1,148 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Bounded in-process LRU cache, entries expire after ttl seconds
+    """
+    def __init__(self, max_size: int, ttl: float):
+        """
+        Constructor
+        :param max_size: maximum amount of entries, least recently used entries are evicted first
+        :param ttl: time to live of an entry in seconds
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns cached value or None if key is not present or expired
+        :param key: the key
+        :return: the value or None
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if time.monotonic() > expires:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """
+        Adds or replaces value, evicts least recently used entries when full
+        :param key: the key
+        :param value: the value
+        """
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class _PendingLookup:
+    """
+    A lookup in flight, concurrent requests for the same key wait for its result
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class Geocoder:
+    """
+    The Geocoder puts a bounded in-process TTL cache and request coalescing in front of a lookup function
+    Concurrent misses for the same key are coalesced into a single lookup, the other callers wait for its result
+    Keeps hit, miss and latency statistics, updated under the lock guarding the pending lookups
+    """
+    def __init__(self, max_size: int = 10000, ttl: float = 3600):
+        """
+        Constructor
+        :param max_size: maximum amount of cached addresses
+        :param ttl: time to live of a cached address in seconds
+        """
+        self.cache = TTLCache(max_size=max_size, ttl=ttl)
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.lookup_count = 0
+        self.lookup_seconds_total = 0.0
+        self.lookup_seconds_max = 0.0
+
+    def get(self, key: str, lookup):
+        """
+        Returns the value of key from the in-process cache or from lookup on a miss
+        Lookup is called at most once at a time per key
+        :param key: the key, for example postalcode and streetnumber
+        :param lookup: function without arguments returning a (value, source) tuple, can raise an exception
+        :return: value and source, source is 'memory' when served from the in-process cache
+        """
+        value = self.cache.get(key)
+        if value is not None:
+            with self.lock:
+                self.hits += 1
+            return value, 'memory'
+
+        with self.lock:
+            pending = self.pending.get(key)
+            leader = pending is None
+            if leader:
+                pending = _PendingLookup()
+                self.pending[key] = pending
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if leader:
+            begin = time.perf_counter()
+            try:
+                pending.value = lookup()
+                self.cache.put(key, pending.value[0])
+            except Exception as ex:
+                pending.error = ex
+            finally:
+                elapsed = time.perf_counter() - begin
+                with self.lock:
+                    if pending.error is not None:
+                        self.errors += 1
+                    self.lookup_count += 1
+                    self.lookup_seconds_total += elapsed
+                    self.lookup_seconds_max = max(self.lookup_seconds_max, elapsed)
+                    del self.pending[key]
+                pending.event.set()
+        else:
+            pending.event.wait()
+
+        if pending.error is not None:
+            raise Exception(pending.error.__str__())
+        return pending.value
+
+    def get_stats(self):
+        """
+        Returns hit, miss and latency statistics
+        :return: dictionary holding the statistics
+        """
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'coalesced': self.coalesced,
+                    'errors': self.errors,
+                    'cached': len(self.cache),
+                    'lookup_count': self.lookup_count,
+                    'lookup_seconds_total': self.lookup_seconds_total,
+                    'lookup_seconds_max': self.lookup_seconds_max}
@@ -0,0 +1,179 @@
+import json
+import logging
+import os
+import re
+import shutil
+import signal
+import time
+import uuid
+import flaskr.environment
+from flaskr.utils.resulttransport import get_spool_dir
+
+"""
+States of a job, a job in a final state has no running worker
+"""
+JOB_STATES = ('queued', 'running', 'done', 'failed', 'cancelled')
+FINAL_JOB_STATES = ('done', 'failed', 'cancelled')
+
+
+class JobStore:
+    """
+    The JobStore keeps status and result of every job in a directory of its own, <directory>/<job id>
+    Web processes don't share memory, the status file written by the worker process is read by whichever web process
+    serves the poll. Every read of a status counts as access and touches the accessed file of the job, jobs that are not
+    accessed for a while are abandoned: running jobs are cancelled and finished jobs are removed by cleanup
+    """
+    def __init__(self, directory: str = None, abandon_seconds: float = 60, expire_seconds: float = 600):
+        """
+        Constructor
+        :param directory: directory of the job directories, None uses omd_jobs in the result spool directory
+        :param abandon_seconds: running jobs not accessed within this time are cancelled
+        :param expire_seconds: finished jobs not accessed within this time are removed
+        """
+        self.directory = directory if directory is not None else os.path.join(get_spool_dir(), 'omd_jobs')
+        self.abandon_seconds = abandon_seconds
+        self.expire_seconds = expire_seconds
+        self.pattern = re.compile('^[0-9a-f]{32}$')
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _get_path(self, job_id: str, filename: str = ''):
+        if self.pattern.match(job_id) is None:
+            raise Exception('Invalid job id %s' % job_id)
+        return os.path.join(self.directory, job_id, filename)
+
+    def get_result_path(self, job_id: str):
+        """
+        Returns the spool file path the response of a job is written to
+        """
+        return self._get_path(job_id, 'result')
+
+    def create(self, name: str):
+        """
+        Creates a queued job
+        :param name: name of the api call
+        :return: the job id
+        """
+        job_id = uuid.uuid4().hex
+        os.makedirs(self._get_path(job_id))
+        open(self._get_path(job_id, 'accessed'), 'w').close()
+        self.write_status(job_id, {'id': job_id,
+                                   'name': name,
+                                   'state': 'queued',
+                                   'progress': 0.0,
+                                   'partial': [],
+                                   'created': time.time()})
+        return job_id
+
+    def write_status(self, job_id: str, status: dict):
+        """
+        Replaces the status of a job, readers never see a partially written status
+        :param job_id: the job id
+        :param status: status dictionary
+        """
+        status['updated'] = time.time()
+        path = self._get_path(job_id, 'status.json')
+        temp_path = '%s.%i.tmp' % (path, os.getpid())
+        with open(temp_path, 'w') as fh:
+            json.dump(status, fh)
+        os.replace(temp_path, path)
+
+    def read_status(self, job_id: str, access: bool = True):
+        """
+        Returns the status of a job, None if the job does not exist
+        :param job_id: the job id
+        :param access: count the read as access of the job
+        :return: status dictionary or None
+        """
+        try:
+            with open(self._get_path(job_id, 'status.json'), 'r') as fh:
+                status = json.load(fh)
+            if access:
+                os.utime(self._get_path(job_id, 'accessed'))
+            return status
+        except FileNotFoundError:
+            return None
+
+    def finish(self, job_id: str, state: str, error: str = None):
+        """
+        Moves a job that is not finished yet into a final state, used when the worker ended without doing so
+        :param job_id: the job id
+        :param state: the final state
+        :param error: description of the failure
+        :return: status dictionary, None if the job does not exist
+        """
+        status = self.read_status(job_id, access=False)
+        if status is None or status['state'] in FINAL_JOB_STATES:
+            return status
+        status['state'] = state
+        status['error'] = error
+        self.write_status(job_id, status)
+        return status
+
+    def cancel(self, job_id: str):
+        """
+        Cancels a job, kills its worker process if it is running
+        :param job_id: the job id
+        :return: status dictionary, None if the job does not exist
+        """
+        status = self.read_status(job_id, access=False)
+        if status is None or status['state'] in FINAL_JOB_STATES:
+            return status
+        pid = status.get('pid')
+        if pid is not None:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        status = self.finish(job_id, 'cancelled', 'Job was cancelled')
+        if os.path.exists(self.get_result_path(job_id)):
+            os.remove(self.get_result_path(job_id))
+        return status
+
+    def remove(self, job_id: str):
+        """
+        Removes a job and its result, the result stays readable through file handles that are still open
+        :param job_id: the job id
+        """
+        shutil.rmtree(self._get_path(job_id), ignore_errors=True)
+
+    def list_jobs(self):
+        """
+        Returns the ids of all jobs
+        """
+        return [name for name in os.listdir(self.directory) if self.pattern.match(name) is not None]
+
+    def cleanup(self):
+        """
+        Cancels running jobs and removes finished jobs that were not accessed in time
+        :return: amount of cancelled and removed jobs
+        """
+        cancelled = 0
+        removed = 0
+        now = time.time()
+        for job_id in self.list_jobs():
+            try:
+                idle = now - os.path.getmtime(self._get_path(job_id, 'accessed'))
+            except FileNotFoundError:
+                continue
+            status = self.read_status(job_id, access=False)
+            if status is None or status['state'] in FINAL_JOB_STATES:
+                if idle > self.expire_seconds:
+                    self.remove(job_id)
+                    removed += 1
+            elif idle > self.abandon_seconds:
+                logging.info('Cancelling abandoned job %s' % job_id)
+                self.cancel(job_id)
+                cancelled += 1
+        return cancelled, removed
+
+
+def get_job_store():
+    """
+    Returns the job store configured in the flask environment
+    """
+    directory = flaskr.environment.JOB_DIR
+    if directory is None:
+        directory = os.path.join(get_spool_dir(flaskr.environment.RESULT_SPOOL_DIR), 'omd_jobs')
+    return JobStore(directory=directory,
+                    abandon_seconds=flaskr.environment.JOB_ABANDON_SECONDS,
+                    expire_seconds=flaskr.environment.JOB_EXPIRE_SECONDS)
@@ -1,6 +1,7 @@
 import datetime
-from pymongo import MongoClient
+import logging
 from ovm.environment import Environment
+from ovm.mongoconnection import get_mongo_client
 from ovm.utils import convert_datetime_to_int, convert_int_to_datetime
 
 
@@ -9,6 +10,7 @@ class LatLonCache:
     The LatLonCache stores and gets lat, lon coordinates stored to addresses
     This is to reduce API calls to pro6pp or another service
     Addresses will get invalidated after expire days in which case they can be updated
+    Without MongoDB configuration nothing is stored, every lookup misses
     """
     def __init__(self, environment: Environment, expire_days: int):
         """
@@ -19,15 +21,49 @@ class LatLonCache:
         # Set environment
         self.environment = environment
 
-        # Create MongoDB client
-        self.mongo_client = MongoClient(environment.mongodb_config.host,
-                                        environment.mongodb_config.port)
-
         # Address entries will be considered invalid after this many days
         self.expire_days = expire_days
 
-        # Acquire the collection
-        self.collection = self.mongo_client[self.environment.mongodb_config.database]['latloncache']
+        # Acquire the collection using the MongoDB client shared by this process
+        self.collection = None
+        if environment.mongodb_config is not None:
+            mongo_client = get_mongo_client(environment.mongodb_config)
+            self.collection = mongo_client[self.environment.mongodb_config.database]['latloncache']
+
+        # Index on address is created on first use so constructing the cache doesn't need a database connection
+        self.index_created = False
+
+    def ensure_index(self):
+        """
+        Creates the index on address if not done yet, lookups by address are a single index lookup
+        """
+        if self.index_created or self.collection is None:
+            return
+        try:
+            self.collection.create_index('address')
+            self.index_created = True
+        except Exception as ex:
+            logging.exception(ex)
+
+    def get(self, address: str):
+        """
+        Gets lat, lon of address using a single indexed lookup returning coordinates and timestamp together
+        :param address: the address key
+        :return: lat, lon tuple, None if address doesn't exist or is expired
+        """
+        if self.collection is None:
+            return None
+
+        self.ensure_index()
+        entry = self.collection.find_one({'address': address},
+                                         projection={'_id': False, 'lat': True, 'lon': True, 'timestamp': True})
+        if entry is None or 'lat' not in entry or 'lon' not in entry or 'timestamp' not in entry:
+            return None
+
+        timestamp: datetime = convert_int_to_datetime(entry['timestamp'])
+        if datetime.datetime.now() - timestamp > datetime.timedelta(days=self.expire_days):
+            return None
+        return entry['lat'], entry['lon']
 
     def address_valid(self, address: str):
         """
@@ -35,14 +71,7 @@ class LatLonCache:
         :param address: the address key
         :return: True if address exists and is not expired
         """
-        if self.collection.count_documents({'address': {"$in": [address]}}) > 0:
-            entry = self.collection.find_one({'address': address})
-            if 'lat' in entry and 'lon' in entry and 'timestamp' in entry:
-                timestamp: datetime = convert_int_to_datetime(entry['timestamp'])
-                if datetime.datetime.now() - timestamp > datetime.timedelta(days=self.expire_days):
-                    return False
-                return True
-        return False
+        return self.get(address) is not None
 
     def add_or_update_address(self, address: str, latlon: tuple):
         """
@@ -50,6 +79,9 @@ class LatLonCache:
         :param address: the address to update
         :param latlon: the lat, lon value
         """
+        if self.collection is None:
+            return
+
         self.collection.update_one({'address': address},
                                    {"$set": {
                                        'address': address,
@@ -0,0 +1,142 @@
+import csv
+import logging
+import os
+import numpy
+
+"""
+Binary layout of a postal code table file
+header: magic (4 bytes), version (uint32), count (uint32)
+followed by count sorted keys (uint32), count latitudes (float64) and count longitudes (float64)
+"""
+TABLE_MAGIC = b'PCCT'
+TABLE_VERSION = 1
+TABLE_HEADER_SIZE = 12
+
+
+def encode_postalcode(postalcode: str):
+    """
+    Encodes a dutch postal code into an integer key
+    PC4 (1234) and PC6 (1234AB) codes get distinct keys, PC6 keys of the same PC4 area are adjacent
+    :param postalcode: postal code, whitespaces and case are ignored
+    :return: integer key or None if postal code is not a PC4 or PC6 code
+    """
+    postalcode = postalcode.replace(' ', '').upper()
+    if len(postalcode) not in (4, 6) or not postalcode[0:4].isdigit():
+        return None
+
+    key = int(postalcode[0:4]) * 677
+    if len(postalcode) == 6:
+        letters = postalcode[4:6]
+        if not ('A' <= letters[0] <= 'Z' and 'A' <= letters[1] <= 'Z'):
+            return None
+        key += 1 + (ord(letters[0]) - ord('A')) * 26 + (ord(letters[1]) - ord('A'))
+    return key
+
+
+class PostalCodeTable:
+    """
+    The PostalCodeTable looks up centroids of PC4 and PC6 postal codes from a memory-mapped file
+    Keys are sorted so a lookup is a binary search, no network or database is involved
+    The table is disabled if the file does not exist, build it from a CSV using build_postalcode_table.py
+    """
+    def __init__(self, filename: str):
+        """
+        Constructor, memory-maps the table file
+        :param filename: the table file
+        """
+        self.filename = filename
+        self.keys = None
+        self.lat = None
+        self.lon = None
+
+        if filename is None or not os.path.exists(filename):
+            logging.info('Postal code table %s not found, offline postal code lookups disabled' % filename)
+            return
+
+        with open(filename, 'rb') as fh:
+            header = fh.read(TABLE_HEADER_SIZE)
+        if len(header) != TABLE_HEADER_SIZE or header[0:4] != TABLE_MAGIC:
+            raise Exception('%s is not a postal code table' % filename)
+        version, count = numpy.frombuffer(header[4:], dtype='<u4')
+        if version != TABLE_VERSION:
+            raise Exception('Unsupported postal code table version %i' % version)
+
+        count = int(count)
+        if count == 0:
+            return
+        offset = TABLE_HEADER_SIZE
+        self.keys = numpy.memmap(filename, dtype='<u4', mode='r', offset=offset, shape=(count,))
+        offset += 4 * count
+        self.lat = numpy.memmap(filename, dtype='<f8', mode='r', offset=offset, shape=(count,))
+        offset += 8 * count
+        self.lon = numpy.memmap(filename, dtype='<f8', mode='r', offset=offset, shape=(count,))
+
+    def __len__(self):
+        return 0 if self.keys is None else len(self.keys)
+
+    def get(self, postalcode: str):
+        """
+        Gets the centroid of a postal code
+        :param postalcode: PC4 or PC6 postal code
+        :return: lat, lon tuple or None if postal code is not in the table
+        """
+        if self.keys is None:
+            return None
+
+        key = encode_postalcode(postalcode)
+        if key is None:
+            return None
+
+        idx = int(numpy.searchsorted(self.keys, key))
+        if idx < len(self.keys) and self.keys[idx] == key:
+            return float(self.lat[idx]), float(self.lon[idx])
+        return None
+
+    @staticmethod
+    def build(csv_filename: str,
+              filename: str,
+              postalcode_column: str = 'postalcode',
+              lat_column: str = 'lat',
+              lon_column: str = 'lon',
+              delimiter: str = ','):
+        """
+        Builds a table file from a CSV holding postal codes and their centroids
+        Rows with invalid postal codes or coordinates are skipped, for duplicate postal codes the last row wins
+        :param csv_filename: the CSV file
+        :param filename: the table file to write
+        :param postalcode_column: name of the postal code column
+        :param lat_column: name of the latitude column
+        :param lon_column: name of the longitude column
+        :param delimiter: CSV delimiter
+        :return: amount of postal codes written and amount of rows skipped
+        """
+        entries = {}
+        skipped = 0
+        with open(csv_filename, newline='', encoding='utf-8-sig') as fh:
+            for row in csv.DictReader(fh, delimiter=delimiter):
+                try:
+                    key = encode_postalcode(row[postalcode_column])
+                    lat = float(row[lat_column])
+                    lon = float(row[lon_column])
+                except (KeyError, ValueError, AttributeError):
+                    key = None
+                if key is None:
+                    skipped += 1
+                    continue
+                entries[key] = (lat, lon)
+
+        keys = numpy.array(sorted(entries.keys()), dtype='<u4')
+        lat = numpy.array([entries[key][0] for key in keys.tolist()], dtype='<f8')
+        lon = numpy.array([entries[key][1] for key in keys.tolist()], dtype='<f8')
+
+        # Write to a temporary file first, a running app keeps mapping the old table
+        temp_filename = filename + '.tmp'
+        with open(temp_filename, 'wb') as fh:
+            fh.write(TABLE_MAGIC)
+            fh.write(numpy.array([TABLE_VERSION, len(keys)], dtype='<u4').tobytes())
+            fh.write(keys.tobytes())
+            fh.write(lat.tobytes())
+            fh.write(lon.tobytes())
+        os.replace(temp_filename, filename)
+
+        return len(keys), skipped
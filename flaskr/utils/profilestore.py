@@ -0,0 +1,15 @@
+import os
+import flaskr.environment
+from flaskr.utils.resulttransport import get_spool_dir
+from ovm.profiling import ProfileStore
+
+
+def get_profile_store():
+    """
+    Returns the profile store configured in the flask environment
+    """
+    directory = flaskr.environment.PROFILE_DIR
+    if directory is None:
+        directory = os.path.join(get_spool_dir(flaskr.environment.RESULT_SPOOL_DIR), 'omd_profiles')
+    return ProfileStore(directory=directory,
+                        max_profiles=flaskr.environment.PROFILE_MAX_COUNT)
@@ -0,0 +1,123 @@
+import threading
+import time
+
+
+class _PendingQuery:
+    """
+    A query waiting for the execution of its group
+    """
+    def __init__(self, query):
+        self.query = query
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class _QueryGroup:
+    """
+    Queries executed together, the group spans the union of their time ranges
+    """
+    def __init__(self, begin: int, end: int):
+        self.begin = begin
+        self.end = end
+        self.queries = []
+        self.full = threading.Event()
+
+
+class QueryCoalescer:
+    """
+    The QueryCoalescer groups queries that arrive within a short window and overlap in time range
+    The first query of a group waits for the window to pass or the group to fill up and executes the whole group using a
+    single call, the other queries wait for their result. Keeps the coalescing factor, the average amount of queries
+    per executed group
+    """
+    def __init__(self, execute_group, window: float = 0.05, max_queries: int = 16):
+        """
+        Constructor
+        :param execute_group: function taking a list of queries and returning a list holding the result of every query
+        in the same order, a failed query has an exception as result
+        :param window: seconds the first query of a group waits for other queries to join
+        :param max_queries: maximum amount of queries in a group
+        """
+        self.execute_group = execute_group
+        self.window = window
+        self.max_queries = max_queries
+        self.open_groups = []
+        self.lock = threading.Lock()
+        self.queries = 0
+        self.groups = 0
+        self.errors = 0
+        self.max_group_size = 0
+        self.execute_seconds_total = 0.0
+
+    def submit(self, query, begin: int, end: int):
+        """
+        Executes query together with the other queries overlapping its time range, blocks until the result is there
+        Raises exception if the query fails
+        :param query: the query as passed to execute_group
+        :param begin: begin of the time range of the query as integer (%Y%m%d%H%M%S)
+        :param end: end of the time range of the query as integer (%Y%m%d%H%M%S)
+        :return: result of the query
+        """
+        pending = _PendingQuery(query)
+        with self.lock:
+            group = next((group for group in self.open_groups if group.begin <= end and begin <= group.end), None)
+            leader = group is None
+            if leader:
+                group = _QueryGroup(begin, end)
+                self.open_groups.append(group)
+            group.begin = min(group.begin, begin)
+            group.end = max(group.end, end)
+            group.queries.append(pending)
+            if len(group.queries) >= self.max_queries:
+                self.open_groups.remove(group)
+                group.full.set()
+
+        if leader:
+            group.full.wait(self.window)
+            with self.lock:
+                if group in self.open_groups:
+                    self.open_groups.remove(group)
+            self._execute(group)
+        else:
+            pending.event.wait()
+
+        if pending.error is not None:
+            raise Exception(pending.error.__str__())
+        return pending.value
+
+    def _execute(self, group: _QueryGroup):
+        """
+        Executes a closed group and hands every query its result
+        """
+        begin = time.perf_counter()
+        try:
+            results = self.execute_group([pending.query for pending in group.queries])
+        except Exception as ex:
+            results = [ex] * len(group.queries)
+        elapsed = time.perf_counter() - begin
+
+        with self.lock:
+            self.queries += len(group.queries)
+            self.groups += 1
+            self.max_group_size = max(self.max_group_size, len(group.queries))
+            self.execute_seconds_total += elapsed
+            for pending, result in zip(group.queries, results):
+                if isinstance(result, Exception):
+                    pending.error = result
+                    self.errors += 1
+                else:
+                    pending.value = result
+                pending.event.set()
+
+    def get_stats(self):
+        """
+        Returns query, group and coalescing factor statistics
+        :return: dictionary holding the statistics
+        """
+        return {'queries': self.queries,
+                'groups': self.groups,
+                'coalescing_factor': self.queries / self.groups if self.groups > 0 else 0.0,
+                'max_group_size': self.max_group_size,
+                'errors': self.errors,
+                'execute_seconds_total': self.execute_seconds_total}
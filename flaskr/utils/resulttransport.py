@@ -0,0 +1,89 @@
+import os
+import tempfile
+import uuid
+from dataclasses import dataclass
+from flask import send_file
+from flaskr.utils.encoders import get_headers, write_body
+
+
+@dataclass
+class SpooledResult:
+    """
+    Describes an encoded response written into the result spool by a worker process
+    Only this small header travels through the shared queue, the payload stays in the spool file
+    """
+    path: str
+    mimetype: str
+    encoding: str
+    size: int
+
+
+def get_spool_dir(spool_dir: str = None):
+    """
+    Returns the directory results are spooled to
+    Defaults to /dev/shm when available so spool files live in memory, otherwise the temp directory is used
+    :param spool_dir: configured spool directory, None picks the default
+    :return: the spool directory
+    """
+    if spool_dir is None:
+        spool_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    if not os.path.exists(spool_dir):
+        os.makedirs(spool_dir)
+    return spool_dir
+
+
+def create_result_path(spool_dir: str = None):
+    """
+    Creates a unique spool file path for a single result
+    :param spool_dir: configured spool directory, None picks the default
+    :return: the path
+    """
+    return os.path.join(get_spool_dir(spool_dir), 'omd_result_%s' % uuid.uuid4().hex)
+
+
+def write_result(path: str,
+                 response: dict,
+                 mimetype: str,
+                 encoding: str = None,
+                 min_compress_size: int = 1024,
+                 kind: str = None):
+    """
+    Encodes response and writes it into the spool file, called from the worker process
+    JSON is encoded and compressed in chunks, see write_body
+    :param path: spool file path
+    :param response: response object with status and value
+    :param mimetype: the negotiated mimetype
+    :param encoding: the negotiated content encoding, None disables compression
+    :param min_compress_size: minimum response size in bytes before compression is applied
+    :param kind: kind of the value, fixes the schema of Arrow responses, see response_to_table
+    :return: SpooledResult describing the written result
+    """
+    with open(path, 'wb') as fh:
+        size, mimetype, encoding = write_body(fh, response, mimetype, encoding, min_compress_size, kind)
+    return SpooledResult(path=path, mimetype=mimetype, encoding=encoding, size=size)
+
+
+def send_result(result: SpooledResult):
+    """
+    Streams a spooled result into the HTTP response
+    The spool file is unlinked right after opening, the open file handle keeps the data alive until the response is
+    sent. The file is handed to the WSGI file wrapper, gunicorn sends it using sendfile without copying it into Python
+    :param result: the spooled result
+    :return: flask response
+    """
+    fh = open(result.path, 'rb')
+    os.remove(result.path)
+
+    response = send_file(fh, mimetype=result.mimetype, conditional=False, etag=False)
+    response.content_length = result.size
+    response.headers.extend(get_headers(result.encoding))
+    return response
+
+
+def remove_result(path: str):
+    """
+    Removes a spool file if it still exists, for example when the worker failed after writing
+    :param path: spool file path
+    """
+    if os.path.exists(path):
+        os.remove(path)
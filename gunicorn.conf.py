@@ -0,0 +1,10 @@
+from flaskr import environment
+
+
+def post_fork(server, worker):
+    """
+    Imports the raster plotting stack in the background of every worker after it is forked, see WARM_PLOTTER
+    """
+    if environment.WARM_PLOTTER:
+        from flaskr.api import warm_plotter
+        warm_plotter()
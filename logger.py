@@ -6,7 +6,11 @@ import argparse
 from logging.handlers import TimedRotatingFileHandler
 from numpy import uint64
 from ovm import environment
-from ovm.planelogger import PlaneLogger, PlotOptions
+from ovm.flightfeed import FakeFlightFeed, get_union_bbox
+from ovm.ingestpolicy import DEFAULT_ALTITUDE_TIERS, DEFAULT_FULL_RATE_ALTITUDE, IngestPolicy
+from ovm.metrics import get_metrics
+from ovm.planelogger import PlaneLogger, get_bbox_around_center
+from ovm.profiling import ProfileStore
 
 if __name__ == '__main__':
     # parse cli arguments
@@ -18,7 +22,6 @@ if __name__ == '__main__':
                         help='Latitude Longitude center [lat, lon]')
     parser.add_argument('-r', '--radius',
                         type=int,
-                        nargs=1,
                         default=150000,
                         help='Radius in meters')
     parser.add_argument('-l', '--loglevel',
@@ -43,6 +46,76 @@ if __name__ == '__main__':
                         type=int,
                         default=0,
                         help='Amount of runs between intervals, default = 0 meaning infinite')
+    parser.add_argument('--timelapse',
+                        type=str,
+                        default=None,
+                        help='Write plots into a single timelapse video or gif (extension determines format, '
+                             'requires ffmpeg) instead of separate jpg files')
+    parser.add_argument('--fps',
+                        type=int,
+                        default=10,
+                        help='Frames per second of the timelapse')
+    parser.add_argument('-s', '--spool',
+                        type=str,
+                        default='states.spool',
+                        help='Write-ahead spool file for states that could not be written into the database, '
+                             'replayed once the database is available again')
+    parser.add_argument('--region',
+                        type=float,
+                        nargs=3,
+                        action='append',
+                        default=None,
+                        metavar=('LAT', 'LON', 'RADIUS'),
+                        help='Region to log given by center and radius in meters, can be given multiple times. '
+                             'Replaces center and radius')
+    parser.add_argument('--tilesize',
+                        type=float,
+                        default=None,
+                        help='Split regions into tiles no larger than this amount of meters, fetched concurrently')
+    parser.add_argument('--threads',
+                        type=int,
+                        default=4,
+                        help='Maximum amount of tiles fetched concurrently')
+    parser.add_argument('--feed',
+                        type=str,
+                        default=None,
+                        help='JSON file with flights to use instead of flightradar24, for testing')
+    parser.add_argument('--maxinterval',
+                        type=float,
+                        default=None,
+                        help='Grow the time between runs up to this amount of seconds while there are no planes at or '
+                             'below the full rate altitude, default = interval meaning a fixed interval')
+    parser.add_argument('--fullratealtitude',
+                        type=float,
+                        default=DEFAULT_FULL_RATE_ALTITUDE,
+                        help='Planes at or below this altitude in meters are stored every run')
+    parser.add_argument('--tier',
+                        type=float,
+                        nargs=2,
+                        action='append',
+                        default=None,
+                        metavar=('ALTITUDE', 'INTERVAL'),
+                        help='Store planes at or above altitude in meters at most once per interval in seconds, '
+                             'can be given multiple times, default = the tiers of the web app, --tier 0 0 stores '
+                             'every plane every run')
+    parser.add_argument('-k', '--keyframeinterval',
+                        type=int,
+                        default=30,
+                        help='Store every n-th snapshot in full and the others as delta to the previous snapshot, '
+                             '1 stores every snapshot in full')
+    parser.add_argument('--metrics',
+                        type=str,
+                        default=None,
+                        help='Directory the ingest metrics are flushed to after every run, use the metrics directory '
+                             'of the web app to expose them on its /metrics endpoint')
+    parser.add_argument('--profiledir',
+                        type=str,
+                        default='profiles',
+                        help='Directory profiles of sampled runs are stored in')
+    parser.add_argument('--profilerate',
+                        type=float,
+                        default=0.0,
+                        help='Fraction of runs that is profiled, between 0 and 1, 0 disables profiling')
     args = parser.parse_args()
 
     # Set log level
@@ -51,41 +124,93 @@ if __name__ == '__main__':
     # Load environment
     environment = environment.load_environment('environment.json')
 
+    # Share metrics with the web app
+    get_metrics().configure(args.metrics)
+
     # Create and run plane logger
-    plane_logger = PlaneLogger(environment)
+    if args.region is not None:
+        regions = [((region[0], region[1]), int(region[2])) for region in args.region]
+    else:
+        regions = [((args.center[0], args.center[1]), args.radius)]
+    feed = FakeFlightFeed.from_file(args.feed) if args.feed is not None else None
+    policy = IngestPolicy(full_rate_altitude=args.fullratealtitude,
+                          tiers=[(tier[0], tier[1]) for tier in args.tier]
+                          if args.tier is not None else DEFAULT_ALTITUDE_TIERS,
+                          min_interval=args.interval,
+                          max_interval=args.maxinterval or args.interval)
+    logging.info(f'Trajectories of the logged states need a maximum gap of {policy.get_max_gap_seconds():.0f} seconds '
+                 f'(TRAJECTORY_MAX_GAP_SECONDS)')
+    plane_logger = PlaneLogger(environment,
+                               spool_filename=args.spool,
+                               feed=feed,
+                               max_tile_size=args.tilesize,
+                               fetch_threads=args.threads,
+                               keyframe_interval=args.keyframeinterval,
+                               profile_store=ProfileStore(args.profiledir) if args.profilerate > 0 else None,
+                               profile_rate=args.profilerate,
+                               policy=policy)
+
+    # Create plot worker, plots are rendered in a separate process using a persistent figure and basemap
+    # so logging is never delayed by plotting
+    plot_worker = None
+    if args.plot:
+        from ovm.liveplotter import PlotWorker
+        plot_worker = PlotWorker(bbox=get_union_bbox([get_bbox_around_center(center, radius)
+                                                      for center, radius in regions]),
+                                 tile_zoom=args.zoomlevel,
+                                 timelapse=args.timelapse,
+                                 fps=args.fps)
 
     run = True
+    exit_code = 0
     runs: uint64 = uint64(0)
-    while run:
-        sleep_interval = args.interval
-        try:
-            logging.info('Starting run %i' % runs)
+    try:
+        while run:
+            sleep_interval = args.interval
+            try:
+                logging.info('Starting run %i' % runs)
+
+                # Get current time for performance and time measurement
+                current_time = time.perf_counter()
+
+                # Run plane logger
+                states = plane_logger.log(regions=regions)
 
-            # Get current time for performance and time measurement
-            current_time = time.perf_counter()
+                # Hand states over to the plot worker, never blocks. Stop when the worker stopped, frames would be lost
+                if plot_worker is not None and not plot_worker.is_alive():
+                    logging.error('Plot worker stopped, exiting')
+                    exit_code = 1
+                    break
+                if plot_worker is not None and states is not None:
+                    plot_worker.submit(states,
+                                       label=time.strftime('%Y-%m-%d %H:%M:%S'),
+                                       filename=('%s%i.jpg' % (args.outputfilename, runs)))
 
-            # Run plane logger
-            plane_logger.log(center=(args.center[0], args.center[1]),
-                             radius=args.radius,
-                             plot_options=PlotOptions(args.plot,
-                                                      args.zoomlevel,
-                                                      ('%s%i.jpg' % (args.outputfilename, runs))))
+                time_elapsed = time.perf_counter() - current_time
+                sleep_interval = plane_logger.get_interval(args.interval) - time_elapsed
+                if sleep_interval < 0:
+                    sleep_interval = 0
+                logging.info('PlaneLogger took %f seconds, sleep for %f seconds' % (time_elapsed, sleep_interval))
+            except KeyboardInterrupt:
+                break
+            except Exception as ex:
+                logging.exception(ex.__str__())
 
-            time_elapsed = time.perf_counter() - current_time
-            sleep_interval = sleep_interval - time_elapsed
-            if sleep_interval < 0:
-                sleep_interval = 0
-            logging.info('PlaneLogger took %f seconds, sleep for %f seconds' % (time_elapsed, sleep_interval))
-        except KeyboardInterrupt:
-            exit(0)
-        except Exception as ex:
-            logging.exception(ex.__str__())
+            runs += 1
+            if args.times > 0 and runs >= args.times:
+                run = False
+                logging.info('%i runs finished, exiting.' % runs)
+            else:
+                time.sleep(sleep_interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Write pending states into the database
+        plane_logger.close()
+        get_metrics().flush()
 
-        runs += 1
-        if args.times > 0 and runs >= args.times:
-            run = False
-            logging.info('%i runs finished, exiting.' % args.runs)
-        else:
-            time.sleep(sleep_interval)
+        # Finish pending plots and close the timelapse
+        if plot_worker is not None:
+            plot_worker.close()
 
-    exit(0)
+    exit(exit_code)
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+import argparse
+import logging
+import time
+from ovm import environment
+from ovm.statepartitions import get_state_partitions
+
+if __name__ == '__main__':
+    # parse cli arguments
+    parser = argparse.ArgumentParser(description='Copies states of the single states collection into per-day '
+                                                 'collections, requires partition_by_day in environment.json')
+    parser.add_argument('-s', '--source',
+                        type=str,
+                        default=None,
+                        help='Name of the single states collection, defaults to the collection in environment.json')
+    parser.add_argument('-b', '--batch-size',
+                        type=int,
+                        default=1000,
+                        help='Amount of snapshots per bulk write')
+    parser.add_argument('-k', '--keyframe-interval',
+                        type=int,
+                        default=30,
+                        help='Store every n-th snapshot in full and the others as delta')
+    parser.add_argument('--drop-source',
+                        action=argparse.BooleanOptionalAction,
+                        help='Drop the single states collection after copying')
+    parser.add_argument('-l', '--loglevel',
+                        type=str.upper,
+                        default='INFO',
+                        help='LOG Level (DEBUG, INFO, WARNING, ERROR, CRITICAL)')
+    args = parser.parse_args()
+
+    # Set log level
+    logging.basicConfig(level=args.loglevel)
+
+    # Load environment
+    environment = environment.load_environment('environment.json')
+    partitions = get_state_partitions(environment.mongodb_config)
+    source = args.source if args.source is not None else environment.mongodb_config.collection
+
+    # Copy states
+    begin = time.perf_counter()
+    copied = partitions.migrate(source, batch_size=args.batch_size, keyframe_interval=args.keyframe_interval)
+    logging.info('Copied %i snapshots from %s into %i day collections in %f seconds' %
+                 (copied, source, len(partitions.list_days()), time.perf_counter() - begin))
+
+    if args.drop_source:
+        logging.info('Dropping %s' % source)
+        partitions.database.drop_collection(source)
+
+    exit(0)
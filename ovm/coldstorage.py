@@ -0,0 +1,311 @@
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from ovm.environment import ColdStorageConfiguration, Environment
+from ovm.metrics import get_stages
+from ovm.statestore import STATE_COLUMNS
+
+# Columns holding min/max statistics per row group
+STATISTICS_COLUMNS = ['time', 'latitude', 'longitude', 'geo_altitude']
+
+
+def get_schema():
+    """
+    Returns the columns of a state in cold storage, other state properties are not exported
+    A snapshot without states is stored as a single row holding only its time, so it is still yielded when scanning
+    pyarrow is imported on first use, processes not touching cold storage don't load it
+    """
+    import pyarrow
+    return pyarrow.schema([('time', pyarrow.int64()),
+                           ('callsign', pyarrow.string()),
+                           ('icao24', pyarrow.string()),
+                           ('latitude', pyarrow.float64()),
+                           ('longitude', pyarrow.float64()),
+                           ('geo_altitude', pyarrow.float64())])
+
+
+# Memory-mapped Parquet files shared by all ColdStorage instances of a process, by path
+_open_files = OrderedDict()
+_open_files_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    """
+    A forked child must not use the lock of its parent, another thread of the parent, for example the export job, may
+    have held it while forking. The files opened by the parent are dropped, the child maps the files it reads itself
+    """
+    global _open_files, _open_files_lock
+    _open_files_lock = threading.Lock()
+    _open_files = OrderedDict()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _open_parquet_file(filename: str, max_open_files: int):
+    """
+    Returns the memory-mapped Parquet file, reopened when the file changed since it was opened
+    """
+    import pyarrow.parquet
+    mtime = os.path.getmtime(filename)
+    with _open_files_lock:
+        entry = _open_files.get(filename)
+        if entry is not None and entry[0] == mtime:
+            _open_files.move_to_end(filename)
+            return entry[1]
+
+        parquet_file = pyarrow.parquet.ParquetFile(pyarrow.memory_map(filename, 'r'))
+        _open_files[filename] = (mtime, parquet_file)
+        _open_files.move_to_end(filename)
+        while len(_open_files) > max_open_files:
+            _open_files.popitem(last=False)
+        return parquet_file
+
+
+class ColdStorage:
+    """
+    ColdStorage keeps states of closed days in Parquet files partitioned by date, <directory>/date=YYYYMMDD/states.parquet
+    Rows are ordered by time and written in row groups holding min/max statistics of time, latitude, longitude and
+    altitude. Scans skip row groups outside the requested time window, bounding box or altitude and read only the
+    columns they need
+    """
+    def __init__(self, directory: str, row_group_size: int = 65536, max_open_files: int = 400):
+        """
+        Constructor
+        @param directory: root directory of the date partitions
+        @param row_group_size: maximum amount of rows per row group
+        @param max_open_files: maximum amount of memory-mapped files kept open
+        """
+        self.directory = directory
+        self.row_group_size = row_group_size
+        self.max_open_files = max_open_files
+        self.pattern = re.compile('^date=(\\d{8})$')
+
+    def prepare_log(self, message: str):
+        return self.__class__.__name__ + ': ' + message
+
+    def get_filename(self, day: int):
+        """
+        Returns the Parquet file of a day
+        @param day: day as integer (%Y%m%d)
+        """
+        return os.path.join(self.directory, 'date=%08i' % day, 'states.parquet')
+
+    def list_days(self):
+        """
+        Returns the exported days, ascending
+        """
+        if not os.path.isdir(self.directory):
+            return []
+
+        days = []
+        for name in os.listdir(self.directory):
+            match = self.pattern.match(name)
+            if match is not None and os.path.exists(self.get_filename(int(match.group(1)))):
+                days.append(int(match.group(1)))
+        return sorted(days)
+
+    def export_day(self, day: int, snapshots):
+        """
+        Writes the snapshots of a day into its Parquet file, replaces an earlier export of the day
+        The file is written next to its destination and moved in place once complete
+        @param day: day as integer (%Y%m%d)
+        @param snapshots: iterable of Time, states tuples in order of Time
+        @return: amount of exported snapshots
+        """
+        filename = self.get_filename(day)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        temp_filename = filename + '.tmp'
+
+        import pyarrow.parquet
+        schema = get_schema()
+        count = 0
+        columns = {name: [] for name in schema.names}
+        with pyarrow.parquet.ParquetWriter(temp_filename,
+                                           schema,
+                                           compression='zstd',
+                                           write_statistics=STATISTICS_COLUMNS) as writer:
+            for timestamp_int, states in snapshots:
+                count += 1
+                for state in states if len(states) > 0 else [{}]:
+                    columns['time'].append(timestamp_int)
+                    for name in STATE_COLUMNS:
+                        columns[name].append(state.get(name))
+
+                if len(columns['time']) >= self.row_group_size:
+                    writer.write_table(pyarrow.Table.from_pydict(columns, schema=schema),
+                                       row_group_size=self.row_group_size)
+                    columns = {name: [] for name in schema.names}
+
+            if len(columns['time']) > 0:
+                writer.write_table(pyarrow.Table.from_pydict(columns, schema=schema),
+                                   row_group_size=self.row_group_size)
+
+        if count == 0:
+            os.remove(temp_filename)
+            return 0
+        os.replace(temp_filename, filename)
+        logging.info(self.prepare_log('Exported %i snapshots of %08i' % (count, day)))
+        return count
+
+    def preload(self):
+        """
+        Opens all exported days, reading their footers into the page cache so processes forked afterwards map them
+        without reading the disk
+        """
+        for day in self.list_days()[-self.max_open_files:]:
+            _open_parquet_file(self.get_filename(day), self.max_open_files)
+
+    def _get_days(self, begin: int, end: int = None, descending: bool = False):
+        days = [day for day in self.list_days()
+                if day >= begin // 1000000 and (end is None or day <= end // 1000000)]
+        if descending:
+            days.reverse()
+        return days
+
+    @staticmethod
+    def _get_statistics(row_group):
+        """
+        Returns min, max tuples of the row group by column name
+        """
+        statistics = {}
+        for idx in range(row_group.num_columns):
+            column = row_group.column(idx)
+            if column.statistics is not None and column.statistics.has_min_max:
+                statistics[column.path_in_schema] = (column.statistics.min, column.statistics.max)
+        return statistics
+
+    @staticmethod
+    def _can_skip_states(statistics: dict, bbox: tuple, max_altitude: float):
+        """
+        Returns True if no state of a row group can be within the bounding box and below the altitude
+        """
+        if bbox is not None:
+            lat_min, lat_max, lon_min, lon_max = bbox
+            latitude = statistics.get('latitude')
+            longitude = statistics.get('longitude')
+            if latitude is None or latitude[1] < lat_min or latitude[0] > lat_max:
+                return True
+            if longitude is None or longitude[1] < lon_min or longitude[0] > lon_max:
+                return True
+        if max_altitude is not None:
+            altitude = statistics.get('geo_altitude')
+            if altitude is None or altitude[0] >= max_altitude:
+                return True
+        return False
+
+    def _read_row_group(self, parquet_file, idx: int, begin: int, end: int, bbox: tuple, max_altitude: float,
+                        columns: list):
+        """
+        Reads the snapshots of a row group between begin and end
+        Row groups without states matching bbox and max_altitude are read using only the time column
+        @return: list of Time, states tuples
+        """
+        import pyarrow.compute
+        statistics = self._get_statistics(parquet_file.metadata.row_group(idx))
+        time_min, time_max = statistics['time']
+        if time_max < begin or (end is not None and time_min > end):
+            return []
+
+        # Read the requested columns and the columns needed to filter
+        skip_states = self._can_skip_states(statistics, bbox, max_altitude)
+        read_columns = ['time']
+        if not skip_states:
+            read_columns += ['latitude'] + (['longitude'] if bbox is not None else []) + (
+                ['geo_altitude'] if max_altitude is not None else [])
+            read_columns += [name for name in columns if name not in read_columns]
+        table = parquet_file.read_row_group(idx, columns=read_columns)
+
+        # Every time in the window is yielded, states only when they match
+        mask = pyarrow.compute.greater_equal(table['time'], begin)
+        if end is not None:
+            mask = pyarrow.compute.and_(mask, pyarrow.compute.less_equal(table['time'], end))
+        snapshots = [(timestamp_int, []) for timestamp_int in
+                     pyarrow.compute.unique(table['time'].filter(mask)).to_pylist()]
+        if skip_states or len(snapshots) == 0:
+            return snapshots
+
+        mask = pyarrow.compute.and_(mask, pyarrow.compute.is_valid(table['latitude']))
+        if bbox is not None:
+            lat_min, lat_max, lon_min, lon_max = bbox
+            for name, low, high in (('latitude', lat_min, lat_max), ('longitude', lon_min, lon_max)):
+                mask = pyarrow.compute.and_(mask, pyarrow.compute.greater_equal(table[name], low))
+                mask = pyarrow.compute.and_(mask, pyarrow.compute.less_equal(table[name], high))
+        if max_altitude is not None:
+            mask = pyarrow.compute.and_(mask, pyarrow.compute.less(table['geo_altitude'], max_altitude))
+
+        rows = table.filter(mask).select(['time'] + columns).to_pylist()
+        idx = 0
+        for row in rows:
+            timestamp_int = row.pop('time')
+            while snapshots[idx][0] != timestamp_int:
+                idx += 1
+            snapshots[idx][1].append(row)
+        return snapshots
+
+    def scan(self, begin: int, end: int = None, bbox: tuple = None, max_altitude: float = None,
+             columns: list = None):
+        """
+        Generator yielding snapshots between begin and end in order of Time
+        @param begin: begin Time as integer (%Y%m%d%H%M%S), inclusive
+        @param end: end Time as integer, inclusive, None scans until the last snapshot
+        @param bbox: only yield states within (lat_min, lat_max, lon_min, lon_max)
+        @param max_altitude: only yield states below this altitude in meters
+        @param columns: state columns to read, defaults to STATE_COLUMNS
+        @return: yields Time, states tuples, snapshots without matching states are yielded with an empty list
+        """
+        columns = columns if columns is not None else STATE_COLUMNS
+        for day in self._get_days(begin, end):
+            parquet_file = _open_parquet_file(self.get_filename(day), self.max_open_files)
+
+            # A snapshot can be split over consecutive row groups
+            current = None
+            for idx in range(parquet_file.metadata.num_row_groups):
+                with get_stages().time('fetch'):
+                    row_group = self._read_row_group(parquet_file, idx, begin, end, bbox, max_altitude, columns)
+                for snapshot in row_group:
+                    if current is not None and current[0] == snapshot[0]:
+                        current[1].extend(snapshot[1])
+                        continue
+                    if current is not None:
+                        yield current
+                    current = snapshot
+            if current is not None:
+                yield current
+
+    def get_times_before(self, timestamp_int: int, limit: int):
+        """
+        Returns the Times of up to limit snapshots at or before timestamp_int, reads only the time column
+        @param timestamp_int: Time as integer
+        @param limit: maximum amount of Times
+        @return: list of Times, latest first
+        """
+        import pyarrow.compute
+        times = []
+        for day in self._get_days(0, timestamp_int, descending=True):
+            parquet_file = _open_parquet_file(self.get_filename(day), self.max_open_files)
+            for idx in reversed(range(parquet_file.metadata.num_row_groups)):
+                time_min, _ = self._get_statistics(parquet_file.metadata.row_group(idx))['time']
+                if time_min > timestamp_int:
+                    continue
+                column = parquet_file.read_row_group(idx, columns=['time'])['time']
+                column = column.filter(pyarrow.compute.less_equal(column, timestamp_int))
+                for value in reversed(pyarrow.compute.unique(column).to_pylist()):
+                    if len(times) > 0 and times[-1] <= value:
+                        continue
+                    times.append(value)
+                    if len(times) >= limit:
+                        return times
+        return times
+
+
+def get_cold_storage(environment: Environment):
+    """
+    Returns the cold storage of given environment, None if cold storage is not configured
+    """
+    config: ColdStorageConfiguration = environment.cold_storage
+    if config is None:
+        return None
+    return ColdStorage(config.directory, row_group_size=config.row_group_size, max_open_files=config.max_open_files)
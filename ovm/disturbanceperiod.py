@@ -23,7 +23,8 @@ class CallsignInfo:
 class Disturbance:
     """
     This is a description of a disturbance
-    Holds begin & end time of found disturbance, callsigns and a plotted jpg image encoded as string
+    Holds begin & end time of found disturbance, callsigns and a plotted jpg or svg image encoded as string
+    Trajectories are held as GeoJSON FeatureCollection when geojson output is requested
     """
 
     callsigns: list = field(default_factory=list)
@@ -34,6 +35,8 @@ class Disturbance:
 
     img: str = field(default_factory=str)
 
+    geojson: dict = field(default_factory=dict)
+
 
 @dataclass
 class Disturbances:
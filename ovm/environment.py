@@ -25,25 +25,121 @@ class FlightRadar24Credentials(object):
 class MongoDBConfiguration(object):
     """
     DataClass holding mongodb configuration
+    Connection pool, timeout, compression, read preference and write concern settings are optional
+    With partition_by_day states are stored in per-day collections named <collection>_YYYYMMDD
+    With spatial_index every state is indexed by its geo-cell of spatial_cell_size degrees in <collection>_positions
     """
-    def __init__(self, host, port, database, collection):
+    def __init__(self, host, port, database, collection,
+                 max_pool_size=100,
+                 min_pool_size=0,
+                 max_idle_time_ms=None,
+                 connect_timeout_ms=20000,
+                 server_selection_timeout_ms=30000,
+                 socket_timeout_ms=None,
+                 compressors=None,
+                 read_preference='primary',
+                 write_concern=None,
+                 partition_by_day=False,
+                 spatial_index=False,
+                 spatial_cell_size=0.05):
         self.host = host
         self.port = port
         self.database = database
         self.collection = collection
+        self.max_pool_size = max_pool_size
+        self.min_pool_size = min_pool_size
+        self.max_idle_time_ms = max_idle_time_ms
+        self.connect_timeout_ms = connect_timeout_ms
+        self.server_selection_timeout_ms = server_selection_timeout_ms
+        self.socket_timeout_ms = socket_timeout_ms
+        self.compressors = compressors
+        self.read_preference = read_preference
+        self.write_concern = write_concern
+        self.partition_by_day = partition_by_day
+        self.spatial_index = spatial_index
+        self.spatial_cell_size = spatial_cell_size
+
+    def get_client_options(self):
+        """
+        Returns the MongoClient keyword arguments of this configuration
+        """
+        options = {
+            'maxPoolSize': self.max_pool_size,
+            'minPoolSize': self.min_pool_size,
+            'maxIdleTimeMS': self.max_idle_time_ms,
+            'connectTimeoutMS': self.connect_timeout_ms,
+            'serverSelectionTimeoutMS': self.server_selection_timeout_ms,
+            'socketTimeoutMS': self.socket_timeout_ms,
+            'readPreference': self.read_preference
+        }
+        if self.compressors:
+            options['compressors'] = ','.join(self.compressors)
+        if self.write_concern is not None:
+            options['w'] = self.write_concern
+        return options
 
     def __str__(self):
         return "{0} {1} {2} {3}".format(self.host, self.port, self.database, self.collection)
 
 
+class ColdStorageConfiguration(object):
+    """
+    DataClass holding cold storage configuration
+    States of closed days are exported to Parquet files in directory, partitioned by date
+    """
+    def __init__(self, directory, row_group_size=65536, max_open_files=400):
+        self.directory = directory
+        self.row_group_size = row_group_size
+        self.max_open_files = max_open_files
+
+    def __str__(self):
+        return "{0}".format(self.directory)
+
+
+class StateStoreConfiguration(object):
+    """
+    DataClass holding state store configuration
+    backend is mongodb or sqlite, filename is the database file of the sqlite backend
+    """
+    def __init__(self, backend='mongodb', filename='states.sqlite'):
+        self.backend = backend
+        self.filename = filename
+
+    def __str__(self):
+        return "{0} {1}".format(self.backend, self.filename)
+
+
+class SlowQueryLogConfiguration(object):
+    """
+    DataClass holding slow query log configuration
+    Scans of FlightInfoFinder taking at least threshold_seconds are recorded in the capped collection named collection,
+    <mongodb collection>_slow_queries by default. With explain the plans of the range queries are recorded as well
+    """
+    def __init__(self, threshold_seconds=5.0, collection=None, size_bytes=16777216, max_documents=10000, explain=True):
+        self.threshold_seconds = threshold_seconds
+        self.collection = collection
+        self.size_bytes = size_bytes
+        self.max_documents = max_documents
+        self.explain = explain
+
+    def __str__(self):
+        return "{0} {1}".format(self.threshold_seconds, self.collection)
+
+
 class Environment(object):
     """
     DataClass containing MongoDBConfiguration and OpenSkyCredentials
+    StateStoreConfiguration, ColdStorageConfiguration and SlowQueryLogConfiguration are optional, MongoDBConfiguration is
+    optional when states are not stored in MongoDB
     """
-    def __init__(self, flightradar24_creds, mongodb_config, timezone):
+    def __init__(self, flightradar24_creds, timezone, mongodb_config=None, state_store=None, cold_storage=None,
+                 slow_query_log=None):
         self.flightradar24_creds = FlightRadar24Credentials(**flightradar24_creds)
-        self.mongodb_config = MongoDBConfiguration(**mongodb_config)
+        self.mongodb_config = MongoDBConfiguration(**mongodb_config) if mongodb_config is not None else None
         self.timezone = Timezone(**timezone)
+        self.state_store = StateStoreConfiguration(**(state_store if state_store is not None else {}))
+        self.cold_storage = ColdStorageConfiguration(**cold_storage) if cold_storage is not None else None
+        self.slow_query_log = SlowQueryLogConfiguration(**slow_query_log) if slow_query_log is not None else None
 
     def __str__(self):
         return "{0} ,{1} ,{2}".format(self.flightradar24_creds, self.mongodb_config, self.timezone)
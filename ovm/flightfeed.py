@@ -0,0 +1,114 @@
+import json
+import math
+from dataclasses import dataclass
+from FlightRadar24 import FlightRadar24API
+from ovm.environment import Environment
+
+
+@dataclass
+class FeedFlight:
+    """
+    Flight as returned by a FlightFeed, attribute names follow the flights of FlightRadar24API
+    altitude is in feet
+    """
+    id: str
+    latitude: float
+    longitude: float
+    altitude: float
+    callsign: str
+    airline_icao: str
+
+
+class FlightFeed:
+    """
+    A FlightFeed returns the flights currently within a geographic bounding box
+    Implementations are called from multiple threads concurrently
+    """
+    def get_flights(self, bbox: tuple):
+        """
+        Returns the flights within bbox
+        @param bbox: geographic bounding box (lat_min, lat_max, lon_min, lon_max)
+        @return: list of flights with id, latitude, longitude, altitude, callsign and airline_icao attributes,
+        None on failure
+        """
+        raise NotImplementedError()
+
+
+class FlightRadar24Feed(FlightFeed):
+    """
+    FlightFeed obtaining flights from flightradar24
+    """
+    def __init__(self, environment: Environment):
+        flightradar24_user: str = environment.flightradar24_creds.username
+        flightradar24_pass: str = environment.flightradar24_creds.password
+        if flightradar24_user != "" and flightradar24_pass != "":
+            self.fr_api = FlightRadar24API(user=flightradar24_user, password=flightradar24_pass)
+        else:
+            self.fr_api = FlightRadar24API()
+
+    def get_flights(self, bbox: tuple):
+        bounds = self.fr_api.get_bounds({'tl_y': bbox[1], 'br_y': bbox[0], 'tl_x': bbox[2], 'br_x': bbox[3]})
+        return self.fr_api.get_flights(bounds=bounds)
+
+
+class FakeFlightFeed(FlightFeed):
+    """
+    FlightFeed serving a fixed list of flights, for running the logger without flightradar24
+    max_flights caps the amount of flights returned per call like flightradar24 does
+    """
+    def __init__(self, flights: list, max_flights: int = None):
+        self.flights = flights
+        self.max_flights = max_flights
+        self.calls = 0
+
+    @staticmethod
+    def from_file(filename: str, max_flights: int = None):
+        """
+        Loads flights from a JSON file holding a list of objects with the attributes of FeedFlight
+        """
+        with open(filename) as fh:
+            flights = [FeedFlight(**flight) for flight in json.load(fh)]
+        return FakeFlightFeed(flights, max_flights=max_flights)
+
+    def get_flights(self, bbox: tuple):
+        self.calls += 1
+        flights = [flight for flight in self.flights
+                   if bbox[0] <= flight.latitude <= bbox[1] and bbox[2] <= flight.longitude <= bbox[3]]
+        if self.max_flights is not None:
+            flights = flights[0:self.max_flights]
+        return flights
+
+
+def split_bbox(bbox: tuple, max_tile_size: float):
+    """
+    Splits a bounding box into equally sized tiles no larger than max_tile_size meters per side
+    @param bbox: geographic bounding box (lat_min, lat_max, lon_min, lon_max)
+    @param max_tile_size: maximum tile height and width in meters
+    @return: list of tiles (lat_min, lat_max, lon_min, lon_max)
+    """
+    meters_per_degree = 111320.0
+    height = (bbox[1] - bbox[0]) * meters_per_degree
+    width = (bbox[3] - bbox[2]) * meters_per_degree * math.cos(math.radians((bbox[0] + bbox[1]) / 2))
+    rows = max(1, math.ceil(height / max_tile_size))
+    cols = max(1, math.ceil(width / max_tile_size))
+
+    lat_step = (bbox[1] - bbox[0]) / rows
+    lon_step = (bbox[3] - bbox[2]) / cols
+    tiles = []
+    for row in range(rows):
+        for col in range(cols):
+            tiles.append((bbox[0] + row * lat_step,
+                          bbox[0] + (row + 1) * lat_step,
+                          bbox[2] + col * lon_step,
+                          bbox[2] + (col + 1) * lon_step))
+    return tiles
+
+
+def get_union_bbox(bboxes: list):
+    """
+    Returns the bounding box enclosing all given bounding boxes
+    """
+    return (min(bbox[0] for bbox in bboxes),
+            max(bbox[1] for bbox in bboxes),
+            min(bbox[2] for bbox in bboxes),
+            max(bbox[3] for bbox in bboxes))
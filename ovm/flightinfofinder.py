@@ -2,18 +2,34 @@ import base64
 import collections
 import logging
 import operator
+import time
 from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 import geopy.distance
-import pymongo
-from pymongo import MongoClient
 from ovm import utils
+from ovm.coldstorage import get_cold_storage
 from ovm.disturbanceperiod import DisturbancePeriod, Disturbances, Disturbance, CallsignInfo
 from ovm.environment import Environment
-from ovm.plotter import plot_trajectories
-from ovm.trajectory import Trajectory
+from ovm.geojson import trajectories_to_feature_collection
+from ovm.ingestpolicy import DEFAULT_ALTITUDE_TIERS, IngestPolicy
+from ovm.memory import get_memory_ceiling
+from ovm.metrics import get_stages
+from ovm.sharedscan import ScanSubscription
+from ovm.slowquerylog import SlowQuery, get_slow_query_log
+from ovm.statereader import StateReader
+from ovm.statestore import get_state_store
+from ovm.svgplotter import plot_trajectories_svg
+from ovm.trajectory import Trajectory, TrajectoryProcessor
 from ovm.utils import convert_datetime_to_int
 
+# Supported output formats of found trajectories
+# jpg: raster plot with map tiles, svg: vector plot without map tiles, geojson: trajectories as FeatureCollection
+OUTPUT_FORMATS = ('jpg', 'svg', 'geojson')
+
+# Maximum amount of snapshots read at once for the trajectories of a disturbance period, about an hour of snapshots at
+# the default log interval. Flights further apart are read in consecutive windows
+TRAJECTORY_WINDOW_SNAPSHOTS = 360
+
 
 class FlightInfoFinder:
     """
@@ -21,30 +37,48 @@ class FlightInfoFinder:
     """
 
     # parameterized constructor
-    def __init__(self, environment: Environment):
+    def __init__(self,
+                 environment: Environment,
+                 max_time_ms: int = None,
+                 max_result_periods: int = None,
+                 max_trajectory_gap: float = None):
+        """
+        Constructor
+        @param environment: the environment
+        @param max_time_ms: time limit of every query on the state store in milliseconds, None for no limit
+        @param max_result_periods: maximum amount of disturbance periods with a plot or GeoJSON find_disturbances
+        returns, None for no limit
+        @param max_trajectory_gap: seconds a plane may be missing from the snapshots around a flight before its
+        trajectory ends, see IngestPolicy.get_max_gap_seconds of the policy the states were logged with. None uses the
+        gap of the default tiers and poll interval
+        """
         # Set environment
         self.environment = environment
+        self.max_time_ms = max_time_ms
+        self.max_result_periods = max_result_periods
+        self.max_trajectory_gap = max_trajectory_gap if max_trajectory_gap is not None else \
+            IngestPolicy(tiers=DEFAULT_ALTITUDE_TIERS).get_max_gap_seconds()
 
-        # Create MongoDB client
-        self.mongo_client = MongoClient(environment.mongodb_config.host,
-                                        environment.mongodb_config.port)
+        # Scans taking too long are recorded in the slow query log if configured
+        self.slow_query_log = get_slow_query_log(environment)
 
     def get_trajectory(self,
                        callsign: str,
                        timestamp: datetime,
-                       duration: int):
+                       duration: int,
+                       trajectory_processor: TrajectoryProcessor = None):
         """
         Returns a list of coordinates of the flight path of given callsign around timestamp. Period is determined by
         duration around timestamp. Meaning a duration of 60 means beginning of period of trajectory = timestamp - duration / 2
         and end of period of trajectory = timestamp + duration / 2
+        Coordinates are simplified and/or resampled by the trajectory processor if given
         """
 
-        # Get the collection of states from the mongo db
+        # Get the reader of states from the state store
         # A state holds all plane information (callsign, location, altitude, etc..) on a specific timestamp
-        # The time is the key value of a state and is ordered accordingly in the mongo database
+        # The time is the key value of a state and is ordered accordingly in the state store
         # Time is an int64 holding the timestamp in the following format %Y%m%d%H%M%S
-        states_collection = self.mongo_client[self.environment.mongodb_config.database][
-                self.environment.mongodb_config.collection]
+        state_reader = self._get_state_reader()
 
         # Sanity check callsign
         callsign = utils.remove_whitespace(callsign)
@@ -52,44 +86,53 @@ class FlightInfoFinder:
         # Compute begin and end timestamp
         begin = timestamp - timedelta(minutes=duration / 2)
         end = timestamp + timedelta(minutes=duration / 2)
-
-        # Find the first entry near begin timestamp
-        cursor = states_collection.find({'Time': {'$gte': convert_datetime_to_int(begin)}})
-
-        # Holds all coordinates
-        coords = []
-
-        # Iterate through states
-        for document in cursor:
-            # Get timestamp as integer value and as datetime object
-            timestamp_int = document['Time']
-            new_timestamp = utils.convert_int_to_datetime(timestamp_int)
-
-            # bail if timestamp exceeded end
-            if new_timestamp > end:
-                break
-
-            # Get all states
-            states = document['States']
-
-            # Iterate through states
-            for state in states:
-                # Get callsign
-                found_callsign = utils.remove_whitespace(state['callsign'])
-
-                if callsign == found_callsign:
-                    # Obtain altitude
-                    geo_altitude = state['geo_altitude']
-
-                    # Ignore grounded planes
-                    if geo_altitude is None:
-                        continue
-
-                    # obtain flight coordinate
-                    flight_coord = (state['latitude'], state['longitude'])
-                    coords.append(flight_coord)
-
-        return coords
+        query = SlowQuery('get_trajectory', {'callsign': callsign,
+                                             'timestamp': str(timestamp),
+                                             'duration': duration},
+                          documents_fetched=state_reader.store.get_documents_fetched)
+
+        try:
+            # Holds all coordinates and their timestamps
+            coords = []
+            times = []
+
+            # Iterate through snapshots between begin and end, snapshots stored as delta are reconstructed
+            ceiling = get_memory_ceiling()
+            for timestamp_int, states in state_reader.scan(convert_datetime_to_int(begin),
+                                                           convert_datetime_to_int(end)):
+                ceiling.check()
+                query.snapshots += 1
+                query.states += len(states)
+
+                # Iterate through states
+                for state in states:
+                    # Get callsign
+                    found_callsign = utils.remove_whitespace(state['callsign'])
+
+                    if callsign == found_callsign:
+                        # Obtain altitude
+                        geo_altitude = state['geo_altitude']
+
+                        # Ignore grounded planes
+                        if geo_altitude is None:
+                            continue
+
+                        # obtain flight coordinate
+                        flight_coord = (state['latitude'], state['longitude'])
+                        coords.append(flight_coord)
+                        times.append(timestamp_int)
+            query.hits = len(coords)
+
+            if trajectory_processor is not None:
+                trajectory = trajectory_processor.process(Trajectory(callsign=callsign, coords=coords, times=times),
+                                                          lonlat=False)
+                coords = trajectory.coords
+
+            self._record_slow_query(query, state_reader, begin, end)
+            return coords
+        except Exception as ex:
+            self._record_slow_query(query, state_reader, begin, end, error=ex)
+            raise
 
     def find_flights(self,
                      origin: tuple,
@@ -98,171 +141,255 @@ class FlightInfoFinder:
                      radius: int,
                      altitude: int,
                      plot: bool = False,
-                     zoomlevel: int = 14):
+                     zoomlevel: int = 14,
+                     output_format: str = 'jpg',
+                     precision: int = None,
+                     trajectory_processor: TrajectoryProcessor = None,
+                     shared_scan: ScanSubscription = None,
+                     progress=None):
         """
         Finds all flights that flew within a given radius and time period and below a given altitude
         Returns a single disturbance object containing all flights found
+        Output format geojson returns the trajectories as GeoJSON FeatureCollection and skips plotting, precision only
+        applies to geojson output. Trajectories are simplified and/or resampled by the trajectory processor if given
+        Snapshots are taken from the shared scan if given, trajectories are still read from the state store
+        While scanning, progress is called with the scanned fraction of the period and the CallsignInfo list found so far
         """
+        self._check_output_format(output_format)
 
-        # Create disturbances
-        disturbances: Disturbances = Disturbances()
-        disturbance: Disturbance = Disturbance()
-        disturbances.disturbances.append(disturbance)
-        disturbance.begin = begin.strftime("%Y-%m-%d %H:%M:%S")
-        disturbance.end = end.strftime("%Y-%m-%d %H:%M:%S")
-
-        # Create dictionary of all trajectories
-        trajectories: dict = {}
-
-        # Get the collection of states from the mongo db
+        # Get the reader of states from the state store
         # A state holds all plane information (callsign, location, altitude, etc..) on a specific timestamp
-        # The time is the key value of a state and is ordered accordingly in the mongo database
+        # The time is the key value of a state and is ordered accordingly in the state store
         # Time is an int64 holding the timestamp in the following format %Y%m%d%H%M%S
-        states_collection = self.mongo_client[self.environment.mongodb_config.database][
-            self.environment.mongodb_config.collection]
-        cursor = states_collection.find({'Time': {'$gte': convert_datetime_to_int(begin)}})
-
-        # Iterate through states
-        for document in cursor:
-            # Get timestamp as integer value and as datetime object
-            timestamp_int = document['Time']
-            timestamp = utils.convert_int_to_datetime(timestamp_int)
-
-            # bail if timestamp exceeded end
-            if timestamp > end:
-                break
-
-            # Get all states
-            states = document['States']
-
-            # Iterate through states
-            for state in states:
-                # Get callsign
-                callsign = utils.remove_whitespace(state['callsign'])
-
-                # Ignore if callsign already present
-                callsign_already_registered = False
-                for existing_callsign in disturbance.callsigns:
-                    if existing_callsign.callsign == callsign:
-                        callsign_already_registered = True
+        state_reader = self._get_state_reader()
+
+        query = SlowQuery('find_flights', {'origin': list(origin),
+                                           'begin': str(begin),
+                                           'end': str(end),
+                                           'radius': radius,
+                                           'altitude': altitude,
+                                           'plot': plot,
+                                           'output_format': output_format,
+                                           'shared_scan': shared_scan is not None},
+                          documents_fetched=state_reader.store.get_documents_fetched)
+
+        try:
+            # Trajectories are needed for plots and geojson output
+            collect_trajectories = plot or output_format == 'geojson'
+
+            # Create disturbances
+            disturbances: Disturbances = Disturbances()
+            disturbance: Disturbance = Disturbance()
+            disturbances.disturbances.append(disturbance)
+            disturbance.begin = begin.strftime("%Y-%m-%d %H:%M:%S")
+            disturbance.end = end.strftime("%Y-%m-%d %H:%M:%S")
+
+            # Create dictionary of all trajectories
+            trajectories: dict = {}
+
+            scan_source = shared_scan if shared_scan is not None else state_reader
+            snapshots = scan_source.scan(convert_datetime_to_int(begin),
+                                         convert_datetime_to_int(end),
+                                         bbox=self._get_search_bbox(origin, radius),
+                                         max_altitude=altitude)
+
+            # Seconds spent filtering and building trajectories are summed locally and added to the stages once
+            filter_seconds = 0.0
+            trajectory_seconds = 0.0
+
+            # Iterate through snapshots, snapshots stored as delta are reconstructed
+            ceiling = get_memory_ceiling()
+            for snapshot_time, states in snapshots:
+                snapshot_begin = time.perf_counter()
+                ceiling.check()
+                query.snapshots += 1
+                query.states += len(states)
+
+                # Get timestamp as integer value and as datetime object
+                timestamp_int = snapshot_time
+                timestamp = utils.convert_int_to_datetime(timestamp_int)
+
+                # Iterate through states
+                for state in states:
+                    # Get callsign
+                    callsign = utils.remove_whitespace(state['callsign'])
+
+                    # Ignore if callsign already present
+                    callsign_already_registered = False
+                    for existing_callsign in disturbance.callsigns:
+                        if existing_callsign.callsign == callsign:
+                            callsign_already_registered = True
+                            continue
+                    if callsign_already_registered:
                         continue
-                if callsign_already_registered:
-                    continue
-
-                # Obtain icao24
-                icao24 = utils.xstr(state['icao24'])
-
-                # Obtain altitude
-                geo_altitude = state['geo_altitude']
-
-                # Ignore grounded planes
-                if geo_altitude is None:
-                    continue
-
-                # obtain flight coordinate
-                flight_coord = (state['latitude'], state['longitude'])
-
-                # Check if altitude is lower than altitude and if distance is within specified radius
-                if geo_altitude < altitude:
-                    # Obtain lat lon from location to compute distance from complainant origin
-                    distance = geopy.distance.great_circle(origin, flight_coord).meters
-                    if distance < radius:
-                        disturbance.callsigns.append(CallsignInfo(callsign=callsign,
-                                                                  datetime=timestamp_int,
-                                                                  altitude=geo_altitude,
-                                                                  icao24=icao24,
-                                                                  coord=flight_coord))
-
-                        # obtain trajectory if plot is needed
-                        if plot:
-                            # Create trajectory and append coordinate
-                            trajectories[callsign] = Trajectory()
-                            trajectories[callsign].callsign = callsign
-                            trajectories[callsign].average_altitude += geo_altitude
-
-                            # Get timestamp
-                            timestamp_int = document['Time']
-
-                            # Limit results to cap trajectory, if interval is set to 22 seconds,
-                            # a limit of 15 will be +- 5 minutes, which should be more than enough
-                            items_after = states_collection.find({'Time': {'$gte': timestamp_int}}).limit(15)
-                            items_before = states_collection.find({'Time': {'$lte': timestamp_int}}).sort(
-                                [('Time', pymongo.DESCENDING)]).limit(15)
-
-                            # coordinates will be stored here
-                            coords: list = []
-
-                            # First iterate over the past, insert coordinates
-                            for doc in items_before:
-                                timestamp_int = doc['Time']
-                                older_states = doc['States']
-                                trajectory_complete = False
-                                callsign_found_in_states = False
-                                for older_state in older_states:
-                                    if utils.remove_whitespace(older_state['callsign']) == callsign:
-                                        new_altitude = older_state['geo_altitude']
-                                        if new_altitude is not None:
-                                            # Obtain lat lon from location to compute distance from complainant origin
-                                            old_coord = (older_state['latitude'], older_state['longitude'])
-                                            distance = geopy.distance.great_circle(origin, old_coord).meters
-                                            coords.insert(0, (old_coord[1], old_coord[0]))
-                                            trajectories[callsign].average_altitude += new_altitude
-                                            if distance > radius * 2:
-                                                trajectory_complete = True
-                                        callsign_found_in_states = True
-
-                                # Callsign not preset or distance is outside radius, finish
-                                if trajectory_complete or callsign_found_in_states is False:
-                                    break
 
-                            # Iterate over the future, append coordinates
-                            for doc in items_after:
-                                timestamp_int = doc['Time']
-                                newer_states = doc['States']
-                                trajectory_complete = False
-                                callsign_found_in_states = False
-                                for newer_state in newer_states:
-                                    if utils.remove_whitespace(newer_state['callsign']) == callsign:
-                                        new_altitude = newer_state['geo_altitude']
-                                        if new_altitude is not None:
-                                            # Obtain lat lon from location to compute distance from complainant origin
-                                            new_coord = (newer_state['latitude'], newer_state['longitude'])
-                                            distance = geopy.distance.great_circle(origin, new_coord).meters
-                                            coords.append((new_coord[1], new_coord[0]))
-                                            trajectories[callsign].average_altitude += new_altitude
-                                            if distance > radius * 2:
-                                                trajectory_complete = True
-                                        callsign_found_in_states = True
-
-                                # Callsign not preset or distance is outside radius, finish
-                                if trajectory_complete or callsign_found_in_states is False:
-                                    break
+                    # Obtain icao24
+                    icao24 = utils.xstr(state['icao24'])
+
+                    # Obtain altitude
+                    geo_altitude = state['geo_altitude']
+
+                    # Ignore grounded planes
+                    if geo_altitude is None:
+                        continue
+
+                    # obtain flight coordinate
+                    flight_coord = (state['latitude'], state['longitude'])
+
+                    # Check if altitude is lower than altitude and if distance is within specified radius
+                    if geo_altitude < altitude:
+                        # Obtain lat lon from location to compute distance from complainant origin
+                        distance = geopy.distance.great_circle(origin, flight_coord).meters
+                        if distance < radius:
+                            query.hits += 1
+                            disturbance.callsigns.append(CallsignInfo(callsign=callsign,
+                                                                      datetime=timestamp_int,
+                                                                      altitude=geo_altitude,
+                                                                      icao24=icao24,
+                                                                      coord=flight_coord))
+
+                            # obtain trajectory if plot or geojson is needed
+                            if collect_trajectories:
+                                trajectory_begin = time.perf_counter()
+                                ceiling.check(force=True)
+
+                                # Create trajectory and append coordinate
+                                trajectories[callsign] = Trajectory()
+                                trajectories[callsign].callsign = callsign
+                                trajectories[callsign].average_altitude += geo_altitude
+
+                                # Get timestamp
+                                timestamp_int = snapshot_time
+
+                                # Limit results to cap trajectory, if interval is set to 22 seconds,
+                                # a limit of 15 will be +- 5 minutes, which should be more than enough
+                                items_after = state_reader.scan_after(timestamp_int, 15)
+                                items_before = state_reader.scan_before(timestamp_int, 15)
+
+                                # coordinates and their timestamps will be stored here
+                                coords: list = []
+                                times: list = []
+
+                                # First iterate over the past, insert coordinates
+                                last_seen = snapshot_time
+                                for timestamp_int, older_states in items_before:
+                                    trajectory_complete = False
+                                    callsign_found_in_states = False
+                                    for older_state in older_states:
+                                        if utils.remove_whitespace(older_state['callsign']) == callsign:
+                                            new_altitude = older_state['geo_altitude']
+                                            if new_altitude is not None:
+                                                # Obtain lat lon from location to compute distance from complainant
+                                                # origin
+                                                old_coord = (older_state['latitude'], older_state['longitude'])
+                                                distance = geopy.distance.great_circle(origin, old_coord).meters
+                                                coords.insert(0, (old_coord[1], old_coord[0]))
+                                                times.insert(0, timestamp_int)
+                                                trajectories[callsign].average_altitude += new_altitude
+                                                if distance > radius * 2:
+                                                    trajectory_complete = True
+                                            callsign_found_in_states = True
+
+                                    # Distance is outside radius, finish
+                                    if trajectory_complete:
+                                        break
+
+                                    # Callsign not present, high planes are thinned by the ingest policy so the
+                                    # snapshot is skipped unless the plane has been missing for longer than a thinned
+                                    # plane can be
+                                    if callsign_found_in_states is False:
+                                        if self._is_trajectory_gap(last_seen, timestamp_int):
+                                            break
+                                        continue
+                                    last_seen = timestamp_int
+
+                                # Iterate over the future, append coordinates
+                                last_seen = snapshot_time
+                                for timestamp_int, newer_states in items_after:
+                                    trajectory_complete = False
+                                    callsign_found_in_states = False
+                                    for newer_state in newer_states:
+                                        if utils.remove_whitespace(newer_state['callsign']) == callsign:
+                                            new_altitude = newer_state['geo_altitude']
+                                            if new_altitude is not None:
+                                                # Obtain lat lon from location to compute distance from complainant
+                                                # origin
+                                                new_coord = (newer_state['latitude'], newer_state['longitude'])
+                                                distance = geopy.distance.great_circle(origin, new_coord).meters
+                                                coords.append((new_coord[1], new_coord[0]))
+                                                times.append(timestamp_int)
+                                                trajectories[callsign].average_altitude += new_altitude
+                                                if distance > radius * 2:
+                                                    trajectory_complete = True
+                                            callsign_found_in_states = True
+
+                                    # Distance is outside radius, finish
+                                    if trajectory_complete:
+                                        break
+
+                                    # Callsign not present, high planes are thinned by the ingest policy so the
+                                    # snapshot is skipped unless the plane has been missing for longer than a thinned
+                                    # plane can be
+                                    if callsign_found_in_states is False:
+                                        if self._is_trajectory_gap(last_seen, timestamp_int):
+                                            break
+                                        continue
+                                    last_seen = timestamp_int
+
+                                # Calculate
+                                coord_num = len(coords)
+                                trajectories[callsign].coords = coords
+                                trajectories[callsign].times = times
+                                if coord_num > 0:
+                                    trajectories[callsign].average_altitude /= len(trajectories[callsign].coords)
+
+                                # Simplify and/or resample trajectory before plotting or serialization
+                                if trajectory_processor is not None:
+                                    trajectory_processor.process(trajectories[callsign])
+                                trajectory_seconds += time.perf_counter() - trajectory_begin
+
+                filter_seconds += time.perf_counter() - snapshot_begin
+
+                # Report progress of the scan
+                if progress is not None:
+                    progress(self._get_progress(begin, end, timestamp), disturbance.callsigns)
+
+            get_stages().add('filter', filter_seconds - trajectory_seconds)
+            get_stages().add('trajectory', trajectory_seconds)
+
+            if output_format == 'geojson':
+                with get_stages().time('encode'):
+                    disturbance.geojson = trajectories_to_feature_collection(trajectories,
+                                                                             origin=origin,
+                                                                             precision=precision)
+                disturbance.img = None
+            elif plot:
+                # Set the bounding box for our area of interest, add an extra meters/padding for a better view of
+                # trajectories
+                bbox = utils.get_geo_bbox_around_coord(origin, (radius) / 1000.0)
+
+                # Make plot of all callsign trajectories
+                logging.info('Generating trajectory plot')
+                image = self._create_plot(bbox=bbox,
+                                          origin=origin,
+                                          begin=begin,
+                                          end=end,
+                                          trajectories=trajectories,
+                                          zoomlevel=zoomlevel,
+                                          output_format=output_format)
+                disturbance.img = str(base64.b64encode(image), 'UTF-8')
+            else:
+                disturbance.img = None
 
-                            # Calculate
-                            coord_num = len(coords)
-                            trajectories[callsign].coords = coords
-                            if coord_num > 0:
-                                trajectories[callsign].average_altitude /= len(trajectories[callsign].coords)
-
-        if plot:
-            # Set the bounding box for our area of interest, add an extra meters/padding for a better view of
-            # trajectories
-            bbox = utils.get_geo_bbox_around_coord(origin, (radius) / 1000.0)
-
-            # Make plot of all callsign trajectories
-            logging.info('Generating trajectory plot')
-            image = plot_trajectories(bbox=bbox,
-                                      origin=origin,
-                                      begin=begin,
-                                      end=end,
-                                      trajectories=trajectories,
-                                      tile_zoom=zoomlevel)
-            disturbance.img = str(base64.b64encode(image), 'UTF-8')
-        else:
-            disturbance.img = None
-
-        # sort disturbances by timestamp
-        return disturbances
+            self._record_slow_query(query, state_reader, begin, end, bbox=self._get_search_bbox(origin, radius),
+                                    max_altitude=altitude)
+
+            # sort disturbances by timestamp
+            return disturbances
+        except Exception as ex:
+            self._record_slow_query(query, state_reader, begin, end, bbox=self._get_search_bbox(origin, radius),
+                                    max_altitude=altitude, error=ex)
+            raise
 
     def find_disturbances(self,
                           origin: tuple,
@@ -274,278 +401,487 @@ class FlightInfoFinder:
                           timeframe: int,
                           plot: bool = False,
                           title: str = '',
-                          zoomlevel: int = 14):
+                          zoomlevel: int = 14,
+                          output_format: str = 'jpg',
+                          precision: int = None,
+                          trajectory_processor: TrajectoryProcessor = None,
+                          shared_scan: ScanSubscription = None,
+                          progress=None):
         """
         Finds disturbances within given parameters
         Returns a list holding all disturbances found
+        Output format geojson returns the trajectories of each disturbance as GeoJSON FeatureCollection and skips
+        plotting, precision only applies to geojson output. Trajectories are simplified and/or resampled by the
+        trajectory processor if given
+        Snapshots are taken from the shared scan if given, trajectories are still read from the state store
+        While scanning, progress is called with the scanned fraction of the period and the DisturbancePeriod list found
+        so far
         """
+        self._check_output_format(output_format)
 
-        # Get the collection of states from the mongo db
+        # Get the reader of states from the state store
         # A state holds all plane information (callsign, location, altitude, etc..) on a specific timestamp
-        # The time is the key value of a state and is ordered accordingly in the mongo database
+        # The time is the key value of a state and is ordered accordingly in the state store
         # Time is an int64 holding the timestamp in the following format %Y%m%d%H%M%S
-        states_collection = self.mongo_client[self.environment.mongodb_config.database][
-            self.environment.mongodb_config.collection]
-        cursor = states_collection.find({'Time': {'$gte': convert_datetime_to_int(begin)}})
+        state_reader = self._get_state_reader()
 
-        #
-        all_found_disturbances = []
+        query = SlowQuery('find_disturbances', {'origin': list(origin),
+                                                'begin': str(begin),
+                                                'end': str(end),
+                                                'radius': radius,
+                                                'altitude': altitude,
+                                                'occurrences': occurrences,
+                                                'timeframe': timeframe,
+                                                'plot': plot,
+                                                'output_format': output_format,
+                                                'shared_scan': shared_scan is not None},
+                          documents_fetched=state_reader.store.get_documents_fetched)
 
-        # Disturbances is a dictionary with plane callsign as key value and the integer timestamp as value
-        disturbances: dict = {}
+        try:
+            # Trajectories are needed for plots and geojson output
+            collect_trajectories = plot or output_format == 'geojson'
 
-        # Array of DisturbancePeriod data classes holding information about all disturbance periods found in database
-        disturbance_periods: list = []
+            scan_source = shared_scan if shared_scan is not None else state_reader
+            snapshots = scan_source.scan(convert_datetime_to_int(begin),
+                                         convert_datetime_to_int(end),
+                                         bbox=self._get_search_bbox(origin, radius),
+                                         max_altitude=altitude)
 
-        # Amount of disturbances recorded
-        disturbance_hits: int = 0
+            #
+            all_found_disturbances = []
 
-        # If the disturbance threshold is reached, and we're currently iterating through a disturbance period
-        in_disturbance: bool = False
+            # Disturbances is a dictionary with plane callsign as key value and the integer timestamp as value
+            disturbances: dict = {}
 
-        # Callsigns in current disturbance period
-        callsigns_in_disturbance: list = []
+            # Array of DisturbancePeriod data classes holding information about all disturbance periods found in
+            # database
+            disturbance_periods: list = []
 
-        # Total altitude, this is used to compute the average altitude measured in a disturbance period
-        total_altitude: int = 0
+            # Amount of disturbances recorded
+            disturbance_hits: int = 0
 
-        # Signifies if during this timestamp, a disturbance is detected
-        disturbance_in_this_timestamp: bool = False
+            # If the disturbance threshold is reached, and we're currently iterating through a disturbance period
+            in_disturbance: bool = False
 
-        # The last timestamp found
-        last_timestamp: datetime = None
+            # Callsigns in current disturbance period
+            callsigns_in_disturbance: list = []
 
-        # The timestamp of the beginning of a disturbance period
-        disturbance_begin: datetime = None
+            # Total altitude, this is used to compute the average altitude measured in a disturbance period
+            total_altitude: int = 0
 
-        # The timestamp of the last disturbance occurrence found
-        last_disturbance: datetime = None
+            # Signifies if during this timestamp, a disturbance is detected
+            disturbance_in_this_timestamp: bool = False
 
-        # Iterate through states
-        for document in cursor:
-            # Get timestamp as integer value and as datetime object
-            timestamp_int = document['Time']
-            timestamp = utils.convert_int_to_datetime(timestamp_int)
+            # The last timestamp found
+            last_timestamp: datetime = None
 
-            # bail if timestamp exceeded end
-            if timestamp > end:
-                break
+            # The timestamp of the beginning of a disturbance period
+            disturbance_begin: datetime = None
 
-            # Get all states
-            states = document['States']
+            # The timestamp of the last disturbance occurrence found
+            last_disturbance: datetime = None
 
-            # Signifies if during this timestamp, a disturbance is detected
-            disturbance_in_this_timestamp = False
-
-            # Iterate through states
-            for state in states:
-                # Get callsign
-                callsign = state['callsign']
-
-                # Obtain altitude
-                geo_altitude = state['geo_altitude']
-
-                # Obtain icao24
-                icao24 = utils.xstr(state['icao24'])
-
-                # Ignore grounded planes
-                if geo_altitude is None:
-                    continue
-
-                # Check if altitude is lower than altitude and if distance is within specified radius
-                if geo_altitude < altitude:
-                    # Obtain lat lon from location to compute distance from complainant origin
-                    coord = (state['latitude'], state['longitude'])
-                    distance = geopy.distance.great_circle(origin, coord).meters
-
-                    if distance < radius:
-                        # A disturbance is detected, check if it is a new plane in this disturbance period
-                        if not utils.list_contains_value(callsigns_in_disturbance, callsign):
-                            disturbance_hits += 1
-                            callsigns_in_disturbance.append(callsign)
-
-                        total_altitude += geo_altitude
-
-                        # Check if there already is a disturbance in this timeframe, otherwise create a new
-                        # disturbance
-                        disturbance_in_this_timestamp = True
-                        if not in_disturbance:
-                            in_disturbance = True
-                            disturbance_begin = timestamp
-                            last_disturbance = timestamp
-                        else:
-                            last_disturbance = timestamp
-
-                        # if callsign is not already logged for this disturbance, do it now
-                        if callsign not in disturbances.keys():
-                            disturbances[callsign] = {'timestamp': timestamp_int,
-                                                      'altitude': geo_altitude,
-                                                      'icao24': icao24,
-                                                      'coord' : coord}
-
-            # Check if disturbance has ended and if we need to generate a complaint within set parameters
-            if not disturbance_in_this_timestamp:
-                # There is no disturbance in this timestamp, if we're currently in a disturbance period
-                # check if this needs to end, and we can log store this period as a disturbance period
-                if in_disturbance:
-                    diff_since_last = last_timestamp - last_disturbance
-                    if (diff_since_last.seconds / 60) >= timeframe:
-                        if disturbance_hits >= occurrences:
-                            disturbance_period = DisturbancePeriod(user=title,
-                                                                   disturbances=disturbances.copy(),
-                                                                   begin=disturbance_begin,
-                                                                   end=last_disturbance,
-                                                                   flights=disturbance_hits,
-                                                                   average_altitude=total_altitude / disturbance_hits)
-                            disturbance_periods.append(disturbance_period)
-
-                        in_disturbance = False
-                        disturbance_begin = None
-                        last_disturbance = None
-                        disturbance_hits = 0
-                        total_altitude = 0
-                        disturbances = {}
-                        callsigns_in_disturbance = []
-
-            last_timestamp = timestamp
-
-        if in_disturbance:
-            disturbance_duration = last_disturbance - disturbance_begin
-            if disturbance_hits >= occurrences:
-                if (disturbance_duration.seconds / 60) > timeframe:
-                    disturbance_period = DisturbancePeriod(user=title,
-                                                           disturbances=disturbances.copy(),
-                                                           begin=disturbance_begin,
-                                                           end=last_disturbance,
-                                                           flights=disturbance_hits,
-                                                           average_altitude=total_altitude / disturbance_hits)
-                    disturbance_periods.append(disturbance_period)
-
-        # Calc trajectories for callsigns
-        for disturbance_period in disturbance_periods:
-            # Holds all callsigns for this period
-            callsigns: list = []
-
-            # Calc disturbance duration
-            disturbance_duration = disturbance_period.end - disturbance_period.begin
-            logging.info('User %s : Disturbance detected. %i flights and a total duration of %i minutes. '
-                         'Disturbance began at %s and ended at %s' %
-                         (title, len(disturbance_period.disturbances.items()),
-                          (disturbance_duration.seconds / 60),
-                          disturbance_period.begin.__str__(), disturbance_period.end.__str__()))
-
-            # Create plot if necessary
-            if plot:
-                # Create trajectories for complaint
-                logging.info(
-                    'Collecting trajectories for %i flights' % (len(disturbance_period.disturbances.items())))
-                for callsign, entry in disturbance_period.disturbances.items():
-                    trajectory: Trajectory = Trajectory()
-                    trajectory.callsign = callsign
-                    trajectory.average_altitude = 0
-
-                    # Get timestamp
-                    timestamp_int = entry['timestamp']
-
-                    # Limit results to cap trajectory, if interval is set to 22 seconds,
-                    # a limit of 15 will be +- 5 minutes, which should be more than enough
-                    items_after = states_collection.find({'Time': {'$gte': timestamp_int}}).limit(15)
-                    items_before = states_collection.find({'Time': {'$lte': timestamp_int}}).sort(
-                        [('Time', pymongo.DESCENDING)]).limit(15)
-
-                    # coordinates will be stored here
-                    coords: list = []
-
-                    # First iterate over the past, insert coordinates
-                    for doc in items_before:
-                        timestamp_int = doc['Time']
-                        older_states = doc['States']
-                        trajectory_complete = False
-                        callsign_found_in_states = False
-                        for older_state in older_states:
-                            if older_state['callsign'] == callsign:
-                                new_altitude = older_state['geo_altitude']
-                                if new_altitude is not None:
-                                    # Obtain lat lon from location to compute distance from complainant origin
-                                    old_coord = (older_state['latitude'], older_state['longitude'])
-                                    distance = geopy.distance.great_circle(origin, old_coord).meters
-                                    coords.insert(0, (old_coord[1], old_coord[0]))
-                                    trajectory.average_altitude += new_altitude
-                                    if distance > radius * 2:
-                                        trajectory_complete = True
-                                callsign_found_in_states = True
-
-                        # Callsign not preset or distance is outside radius, finish
-                        if trajectory_complete or callsign_found_in_states is False:
-                            break
-
-                    # Iterate over the future, append coordinates
-                    for doc in items_after:
-                        timestamp_int = doc['Time']
-                        newer_states = doc['States']
-                        trajectory_complete = False
-                        callsign_found_in_states = False
-                        for newer_state in newer_states:
-                            if newer_state['callsign'] == callsign:
-                                new_altitude = newer_state['geo_altitude']
-                                if new_altitude is not None:
-                                    # Obtain lat lon from location to compute distance from complainant origin
-                                    new_coord = (newer_state['latitude'], newer_state['longitude'])
-                                    distance = geopy.distance.great_circle(origin, new_coord).meters
-                                    coords.append((new_coord[1], new_coord[0]))
-                                    trajectory.average_altitude += new_altitude
-                                    if distance > radius * 2:
-                                        trajectory_complete = True
-                                callsign_found_in_states = True
-
-                        # Callsign not preset or distance is outside radius, finish
-                        if trajectory_complete or callsign_found_in_states is False:
-                            break
-
-                    # Calculate
-                    coord_num = len(coords)
-                    trajectory.coords = coords
-                    if coord_num > 0:
-                        trajectory.average_altitude /= coord_num
-
-                    # Add it to the trajectories of this complaint and store callsign
-                    disturbance_period.trajectories[callsign] = trajectory
-                    callsigns.append(CallsignInfo(callsign=callsign,
-                                                  datetime=timestamp_int,
-                                                  altitude=trajectory.average_altitude,
-                                                  icao24=entry['icao24'],
-                                                  coord=entry['coord']))
-            else:
-                for callsign, entry in disturbance_period.disturbances.items():
-                    callsigns.append(CallsignInfo(callsign=callsign,
-                                                  datetime=entry['timestamp'],
-                                                  altitude=entry['altitude'],
-                                                  icao24=entry['icao24'],
-                                                  coord=entry['coord']))
+            # Seconds spent filtering and in the state machine are summed locally and added to the stages once
+            filter_seconds = 0.0
+            state_machine_seconds = 0.0
 
-            if plot:
-                # Set the bounding box for our area of interest
-                bbox = utils.get_geo_bbox_around_coord(origin=origin, radius=radius / 1000.0)
+            # Iterate through snapshots, snapshots stored as delta are reconstructed
+            ceiling = get_memory_ceiling()
+            for timestamp_int, states in snapshots:
+                snapshot_begin = time.perf_counter()
+                ceiling.check()
+                query.snapshots += 1
+                query.states += len(states)
 
-                # Make plot of all callsign trajectories
-                logging.info('Generating disturbance period plot with title %s', title)
-                disturbance_period.plot = plot_trajectories(bbox=bbox,
-                                                            trajectories=disturbance_period.trajectories,
-                                                            origin=origin,
-                                                            begin=disturbance_period.begin,
-                                                            end=disturbance_period.end,
-                                                            tile_zoom=zoomlevel)
-
-            # Create disturbance
-            disturbance: Disturbance = Disturbance()
-            disturbance.begin = disturbance_period.begin.__str__()
-            disturbance.end = disturbance_period.end.__str__()
-            disturbance.callsigns = callsigns
-            if plot:
-                disturbance.img = str(base64.b64encode(disturbance_period.plot), 'UTF-8')
-            else:
-                disturbance.img = {}
-            all_found_disturbances.append(disturbance)
+                # Get timestamp as datetime object
+                timestamp = utils.convert_int_to_datetime(timestamp_int)
+
+                # Signifies if during this timestamp, a disturbance is detected
+                disturbance_in_this_timestamp = False
+
+                # Iterate through states
+                for state in states:
+                    # Get callsign
+                    callsign = state['callsign']
+
+                    # Obtain altitude
+                    geo_altitude = state['geo_altitude']
+
+                    # Obtain icao24
+                    icao24 = utils.xstr(state['icao24'])
+
+                    # Ignore grounded planes
+                    if geo_altitude is None:
+                        continue
 
-        # Finally return all found disturbances
-        return all_found_disturbances
+                    # Check if altitude is lower than altitude and if distance is within specified radius
+                    if geo_altitude < altitude:
+                        # Obtain lat lon from location to compute distance from complainant origin
+                        coord = (state['latitude'], state['longitude'])
+                        distance = geopy.distance.great_circle(origin, coord).meters
+
+                        if distance < radius:
+                            query.hits += 1
+
+                            # A disturbance is detected, check if it is a new plane in this disturbance period
+                            if not utils.list_contains_value(callsigns_in_disturbance, callsign):
+                                disturbance_hits += 1
+                                callsigns_in_disturbance.append(callsign)
+
+                            total_altitude += geo_altitude
+
+                            # Check if there already is a disturbance in this timeframe, otherwise create a new
+                            # disturbance
+                            disturbance_in_this_timestamp = True
+                            if not in_disturbance:
+                                in_disturbance = True
+                                disturbance_begin = timestamp
+                                last_disturbance = timestamp
+                            else:
+                                last_disturbance = timestamp
+
+                            # if callsign is not already logged for this disturbance, do it now
+                            if callsign not in disturbances.keys():
+                                disturbances[callsign] = {'timestamp': timestamp_int,
+                                                          'altitude': geo_altitude,
+                                                          'icao24': icao24,
+                                                          'coord' : coord}
+
+                filtered = time.perf_counter()
+                filter_seconds += filtered - snapshot_begin
+
+                # Check if disturbance has ended and if we need to generate a complaint within set parameters
+                if not disturbance_in_this_timestamp:
+                    # There is no disturbance in this timestamp, if we're currently in a disturbance period
+                    # check if this needs to end, and we can log store this period as a disturbance period
+                    if in_disturbance:
+                        diff_since_last = last_timestamp - last_disturbance
+                        if (diff_since_last.seconds / 60) >= timeframe:
+                            if disturbance_hits >= occurrences:
+                                disturbance_period = DisturbancePeriod(
+                                    user=title,
+                                    disturbances=disturbances,
+                                    begin=disturbance_begin,
+                                    end=last_disturbance,
+                                    flights=disturbance_hits,
+                                    average_altitude=total_altitude / disturbance_hits)
+                                disturbance_periods.append(disturbance_period)
+
+                            in_disturbance = False
+                            disturbance_begin = None
+                            last_disturbance = None
+                            disturbance_hits = 0
+                            total_altitude = 0
+                            disturbances = {}
+                            callsigns_in_disturbance = []
+
+                last_timestamp = timestamp
+                state_machine_seconds += time.perf_counter() - filtered
+
+                # Report progress of the scan
+                if progress is not None:
+                    progress(self._get_progress(begin, end, timestamp), disturbance_periods)
+
+            get_stages().add('filter', filter_seconds)
+            get_stages().add('state_machine', state_machine_seconds)
+
+            if in_disturbance:
+                disturbance_duration = last_disturbance - disturbance_begin
+                if disturbance_hits >= occurrences:
+                    if (disturbance_duration.seconds / 60) > timeframe:
+                        disturbance_period = DisturbancePeriod(user=title,
+                                                               disturbances=disturbances,
+                                                               begin=disturbance_begin,
+                                                               end=last_disturbance,
+                                                               flights=disturbance_hits,
+                                                               average_altitude=total_altitude / disturbance_hits)
+                        disturbance_periods.append(disturbance_period)
+
+            # The found disturbances, with their plot or GeoJSON, are held until the result is encoded
+            if collect_trajectories and self.max_result_periods is not None and \
+                    len(disturbance_periods) > self.max_result_periods:
+                raise Exception('Found %i disturbance periods, more than the %i that can be plotted or returned as '
+                                'GeoJSON in a single query, narrow the period or raise occurrences' %
+                                (len(disturbance_periods), self.max_result_periods))
+
+            # Calc trajectories for callsigns
+            # Periods are completed one at a time and released, only the trajectories and plot of one period are held
+            disturbance_periods.reverse()
+            while len(disturbance_periods) > 0:
+                disturbance_period = disturbance_periods.pop()
+
+                # Holds all callsigns for this period
+                callsigns: list = []
+
+                # Calc disturbance duration
+                disturbance_duration = disturbance_period.end - disturbance_period.begin
+                logging.info('User %s : Disturbance detected. %i flights and a total duration of %i minutes. '
+                             'Disturbance began at %s and ended at %s' %
+                             (title, len(disturbance_period.disturbances.items()),
+                              (disturbance_duration.seconds / 60),
+                              disturbance_period.begin.__str__(), disturbance_period.end.__str__()))
+
+                # Collect trajectories if necessary
+                if collect_trajectories:
+                    trajectory_begin = time.perf_counter()
+
+                    # Create trajectories for complaint
+                    logging.info(
+                        'Collecting trajectories for %i flights' % (len(disturbance_period.disturbances.items())))
+
+                    # Flights are collected in order of time, the snapshots around flights close in time are read and
+                    # decoded once in windows of bounded size
+                    entries = sorted(disturbance_period.disturbances.items(), key=lambda item: item[1]['timestamp'])
+                    last_timestamp = entries[-1][1]['timestamp'] if len(entries) > 0 else None
+                    for callsign, entry in entries:
+                        ceiling.check(force=True)
+                        state_reader.read_window_around(entry['timestamp'], last_timestamp, 15,
+                                                        TRAJECTORY_WINDOW_SNAPSHOTS)
+                        trajectory: Trajectory = Trajectory()
+                        trajectory.callsign = callsign
+                        trajectory.average_altitude = 0
+
+                        # Get timestamp
+                        timestamp_int = entry['timestamp']
+
+                        # Limit results to cap trajectory, if interval is set to 22 seconds,
+                        # a limit of 15 will be +- 5 minutes, which should be more than enough
+                        items_after = state_reader.scan_after(timestamp_int, 15)
+                        items_before = state_reader.scan_before(timestamp_int, 15)
+
+                        # coordinates and their timestamps will be stored here
+                        coords: list = []
+                        times: list = []
+
+                        # First iterate over the past, insert coordinates
+                        last_seen = entry['timestamp']
+                        for timestamp_int, older_states in items_before:
+                            trajectory_complete = False
+                            callsign_found_in_states = False
+                            for older_state in older_states:
+                                if older_state['callsign'] == callsign:
+                                    new_altitude = older_state['geo_altitude']
+                                    if new_altitude is not None:
+                                        # Obtain lat lon from location to compute distance from complainant origin
+                                        old_coord = (older_state['latitude'], older_state['longitude'])
+                                        distance = geopy.distance.great_circle(origin, old_coord).meters
+                                        coords.insert(0, (old_coord[1], old_coord[0]))
+                                        times.insert(0, timestamp_int)
+                                        trajectory.average_altitude += new_altitude
+                                        if distance > radius * 2:
+                                            trajectory_complete = True
+                                    callsign_found_in_states = True
+
+                            # Distance is outside radius, finish
+                            if trajectory_complete:
+                                break
+
+                            # Callsign not present, high planes are thinned by the ingest policy so the snapshot is
+                            # skipped unless the plane has been missing for longer than a thinned plane can be
+                            if callsign_found_in_states is False:
+                                if self._is_trajectory_gap(last_seen, timestamp_int):
+                                    break
+                                continue
+                            last_seen = timestamp_int
+
+                        # Iterate over the future, append coordinates
+                        last_seen = entry['timestamp']
+                        for timestamp_int, newer_states in items_after:
+                            trajectory_complete = False
+                            callsign_found_in_states = False
+                            for newer_state in newer_states:
+                                if newer_state['callsign'] == callsign:
+                                    new_altitude = newer_state['geo_altitude']
+                                    if new_altitude is not None:
+                                        # Obtain lat lon from location to compute distance from complainant origin
+                                        new_coord = (newer_state['latitude'], newer_state['longitude'])
+                                        distance = geopy.distance.great_circle(origin, new_coord).meters
+                                        coords.append((new_coord[1], new_coord[0]))
+                                        times.append(timestamp_int)
+                                        trajectory.average_altitude += new_altitude
+                                        if distance > radius * 2:
+                                            trajectory_complete = True
+                                    callsign_found_in_states = True
+
+                            # Distance is outside radius, finish
+                            if trajectory_complete:
+                                break
+
+                            # Callsign not present, high planes are thinned by the ingest policy so the snapshot is
+                            # skipped unless the plane has been missing for longer than a thinned plane can be
+                            if callsign_found_in_states is False:
+                                if self._is_trajectory_gap(last_seen, timestamp_int):
+                                    break
+                                continue
+                            last_seen = timestamp_int
+
+                        # Calculate
+                        coord_num = len(coords)
+                        trajectory.coords = coords
+                        trajectory.times = times
+                        if coord_num > 0:
+                            trajectory.average_altitude /= coord_num
+
+                        # Simplify and/or resample trajectory before plotting or serialization
+                        if trajectory_processor is not None:
+                            trajectory_processor.process(trajectory)
+
+                        # Add it to the trajectories of this complaint and store callsign
+                        disturbance_period.trajectories[callsign] = trajectory
+                        callsigns.append(CallsignInfo(callsign=callsign,
+                                                      datetime=timestamp_int,
+                                                      altitude=trajectory.average_altitude,
+                                                      icao24=entry['icao24'],
+                                                      coord=entry['coord']))
+                    state_reader.window = None
+
+                    # Keep the order in which the flights were found
+                    order = {callsign: idx for idx, callsign in enumerate(disturbance_period.disturbances.keys())}
+                    callsigns.sort(key=lambda callsign_info: order[callsign_info.callsign])
+                    disturbance_period.trajectories = {callsign_info.callsign:
+                                                       disturbance_period.trajectories[callsign_info.callsign]
+                                                       for callsign_info in callsigns}
+                    get_stages().add('trajectory', time.perf_counter() - trajectory_begin)
+                else:
+                    for callsign, entry in disturbance_period.disturbances.items():
+                        callsigns.append(CallsignInfo(callsign=callsign,
+                                                      datetime=entry['timestamp'],
+                                                      altitude=entry['altitude'],
+                                                      icao24=entry['icao24'],
+                                                      coord=entry['coord']))
+
+                if plot and output_format != 'geojson':
+                    # Set the bounding box for our area of interest
+                    bbox = utils.get_geo_bbox_around_coord(origin=origin, radius=radius / 1000.0)
+
+                    # Make plot of all callsign trajectories
+                    logging.info('Generating disturbance period plot with title %s', title)
+                    disturbance_period.plot = self._create_plot(bbox=bbox,
+                                                                trajectories=disturbance_period.trajectories,
+                                                                origin=origin,
+                                                                begin=disturbance_period.begin,
+                                                                end=disturbance_period.end,
+                                                                zoomlevel=zoomlevel,
+                                                                output_format=output_format)
+
+                # Create disturbance
+                disturbance: Disturbance = Disturbance()
+                disturbance.begin = disturbance_period.begin.__str__()
+                disturbance.end = disturbance_period.end.__str__()
+                disturbance.callsigns = callsigns
+                if output_format == 'geojson':
+                    with get_stages().time('encode'):
+                        disturbance.geojson = trajectories_to_feature_collection(disturbance_period.trajectories,
+                                                                                 origin=origin,
+                                                                                 precision=precision)
+                    disturbance.img = {}
+                elif plot:
+                    disturbance.img = str(base64.b64encode(disturbance_period.plot), 'UTF-8')
+                else:
+                    disturbance.img = {}
+                all_found_disturbances.append(disturbance)
+                get_memory_ceiling().check(force=True)
+
+            self._record_slow_query(query, state_reader, begin, end, bbox=self._get_search_bbox(origin, radius),
+                                    max_altitude=altitude)
+
+            # Finally return all found disturbances
+            return all_found_disturbances
+        except Exception as ex:
+            self._record_slow_query(query, state_reader, begin, end, bbox=self._get_search_bbox(origin, radius),
+                                    max_altitude=altitude, error=ex)
+            raise
+
+    def _get_state_reader(self):
+        """
+        Returns the reader of the state store
+        """
+        return StateReader(get_state_store(self.environment, max_time_ms=self.max_time_ms),
+                           cold_storage=get_cold_storage(self.environment))
+
+    def _record_slow_query(self,
+                           query: SlowQuery,
+                           state_reader: StateReader,
+                           begin: datetime,
+                           end: datetime,
+                           bbox: tuple = None,
+                           max_altitude: float = None,
+                           error: Exception = None):
+        """
+        Records a scan in the slow query log if it took too long, with the plans of its range queries
+        Failed scans are recorded with their error, a scan running into the memory ceiling or the query time limit is
+        often the slowest of all
+        """
+        if self.slow_query_log is None:
+            return
+        self.slow_query_log.record(query,
+                                   store=state_reader.store,
+                                   scan={'begin': convert_datetime_to_int(begin),
+                                         'end': convert_datetime_to_int(end),
+                                         'bbox': list(bbox) if bbox is not None else None,
+                                         'max_altitude': max_altitude},
+                                   error=error)
+
+    def _is_trajectory_gap(self, last_seen: int, timestamp_int: int):
+        """
+        Returns True if a plane last seen at last_seen and missing from the snapshot at timestamp_int is gone rather
+        than thinned by the ingest policy
+        """
+        gap = utils.convert_int_to_datetime(timestamp_int) - utils.convert_int_to_datetime(last_seen)
+        return abs(gap.total_seconds()) > self.max_trajectory_gap
+
+    @staticmethod
+    def _get_progress(begin: datetime, end: datetime, timestamp: datetime):
+        """
+        Returns the fraction of the period between begin and end before timestamp
+        """
+        if end <= begin:
+            return 1.0
+        return min(1.0, max(0.0, (timestamp - begin) / (end - begin)))
+
+    @staticmethod
+    def _get_search_bbox(origin: tuple, radius: int):
+        """
+        Returns the bbox enclosing the search radius around origin, with a margin for the differing earth radii of the
+        bbox and distance computations
+        """
+        return utils.get_geo_bbox_around_coord(origin, radius * 1.01 / 1000.0)
+
+    @staticmethod
+    def _check_output_format(output_format: str):
+        """
+        Raises exception if output format is not supported
+        @param output_format: the output format
+        """
+        if output_format not in OUTPUT_FORMATS:
+            raise Exception('Unsupported output format %s, expected one of %s' %
+                            (output_format, ', '.join(OUTPUT_FORMATS)))
+
+    @staticmethod
+    def _create_plot(origin: tuple,
+                     begin: datetime,
+                     end: datetime,
+                     trajectories: dict,
+                     bbox: tuple,
+                     zoomlevel: int,
+                     output_format: str):
+        """
+        Plots trajectories as jpg with map tiles or as svg without map tiles
+        @return: image in bytes
+        """
+        get_memory_ceiling().check(force=True)
+        with get_stages().time('plot'):
+            if output_format == 'svg':
+                return plot_trajectories_svg(origin=origin,
+                                             begin=begin,
+                                             end=end,
+                                             trajectories=trajectories,
+                                             bbox=bbox)
+            # The raster plotting stack is slow to import, it is only loaded when a jpg is plotted
+            from ovm.plotter import plot_trajectories
+            return plot_trajectories(origin=origin,
+                                     begin=begin,
+                                     end=end,
+                                     trajectories=trajectories,
+                                     bbox=bbox,
+                                     tile_zoom=zoomlevel)
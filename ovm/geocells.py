@@ -0,0 +1,41 @@
+import math
+
+"""
+Geo-cells divide the globe into a grid of cell_size by cell_size degrees, a cell is identified by an integer
+Cells are numbered row by row starting at latitude -90, longitude -180
+"""
+
+
+def get_cell(latitude: float, longitude: float, cell_size: float):
+    """
+    Returns the cell of a position
+    @param latitude: latitude in degrees
+    @param longitude: longitude in degrees
+    @param cell_size: cell size in degrees
+    @return: cell as integer
+    """
+    columns = math.ceil(360.0 / cell_size)
+    row = math.floor((latitude + 90.0) / cell_size)
+    column = min(math.floor((longitude + 180.0) / cell_size), columns - 1)
+    return row * columns + column
+
+
+def get_covering_cells(bbox: tuple, cell_size: float, max_cells: int = 1000):
+    """
+    Returns the cells covering a bounding box
+    @param bbox: bounding box (lat_min, lat_max, lon_min, lon_max)
+    @param cell_size: cell size in degrees
+    @param max_cells: maximum amount of cells
+    @return: list of cells, None if more than max_cells are needed
+    """
+    lat_min, lat_max, lon_min, lon_max = bbox
+    columns = math.ceil(360.0 / cell_size)
+    row_min = math.floor((max(lat_min, -90.0) + 90.0) / cell_size)
+    row_max = math.floor((min(lat_max, 90.0) + 90.0) / cell_size)
+    column_min = math.floor((max(lon_min, -180.0) + 180.0) / cell_size)
+    column_max = min(math.floor((min(lon_max, 180.0) + 180.0) / cell_size), columns - 1)
+    if (row_max - row_min + 1) * (column_max - column_min + 1) > max_cells:
+        return None
+    return [row * columns + column
+            for row in range(row_min, row_max + 1)
+            for column in range(column_min, column_max + 1)]
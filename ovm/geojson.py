@@ -0,0 +1,80 @@
+from ovm.trajectory import Trajectory, simplify_coords
+
+
+def round_coords(coords: list, precision: int = None):
+    """
+    Rounds all coordinates to given amount of decimals
+    @param coords: list of coordinates
+    @param precision: amount of decimals, None keeps the coordinates untouched
+    @return: list of rounded coordinates
+    """
+    if precision is None:
+        return [list(coord) for coord in coords]
+    return [[round(value, precision) for value in coord] for coord in coords]
+
+
+def trajectory_to_feature(trajectory: Trajectory,
+                          precision: int = None,
+                          simplify: float = None,
+                          lonlat: bool = True):
+    """
+    Converts a trajectory into a GeoJSON LineString feature
+    @param trajectory: the trajectory
+    @param precision: amount of decimals of coordinates, None keeps full precision
+    @param simplify: simplification tolerance in meters, None or 0 disables simplification
+    @param lonlat: True if coords of trajectory are ordered (lon, lat), False if ordered (lat, lon)
+    @return: GeoJSON feature as dictionary
+    """
+    coords = simplify_coords(trajectory.coords, simplify, lonlat=lonlat)
+
+    # GeoJSON positions are always ordered lon, lat
+    if not lonlat:
+        coords = [(coord[1], coord[0]) for coord in coords]
+
+    return {
+        'type': 'Feature',
+        'geometry': {
+            'type': 'LineString',
+            'coordinates': round_coords(coords, precision)
+        },
+        'properties': {
+            'callsign': trajectory.callsign,
+            'average_altitude': trajectory.average_altitude
+        }
+    }
+
+
+def trajectories_to_feature_collection(trajectories: dict,
+                                       origin: tuple = None,
+                                       precision: int = None,
+                                       simplify: float = None):
+    """
+    Converts a dictionary of trajectories into a GeoJSON FeatureCollection
+    Trajectories with less than 2 coordinates are skipped, just like they are when plotting
+    @param trajectories: dictionary of trajectories with callsign as key, coords ordered (lon, lat)
+    @param origin: optional origin in lat, lon, added as Point feature
+    @param precision: amount of decimals of coordinates, None keeps full precision
+    @param simplify: simplification tolerance in meters, None or 0 disables simplification
+    @return: GeoJSON FeatureCollection as dictionary
+    """
+    features = []
+    for trajectory in trajectories.values():
+        if len(trajectory.coords) >= 2:
+            features.append(trajectory_to_feature(trajectory, precision=precision, simplify=simplify))
+
+    if origin is not None:
+        features.append({
+            'type': 'Feature',
+            'geometry': {
+                'type': 'Point',
+                'coordinates': round_coords([(origin[1], origin[0])], precision)[0]
+            },
+            'properties': {
+                'origin': True
+            }
+        })
+
+    return {
+        'type': 'FeatureCollection',
+        'features': features
+    }
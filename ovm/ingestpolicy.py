@@ -0,0 +1,134 @@
+import time
+
+# Default altitude-tiered sampling of the plane logger, planes at or below DEFAULT_FULL_RATE_ALTITUDE meters are stored
+# every poll, higher planes at most once per interval of their tier given as (min altitude meters, interval seconds)
+DEFAULT_FULL_RATE_ALTITUDE = 3000
+DEFAULT_ALTITUDE_TIERS = [(3000, 30), (7000, 120)]
+
+
+class IngestPolicy:
+    """
+    The IngestPolicy decides which states are stored and how long to wait until the next poll
+
+    Altitude-tiered sampling: states at or below full_rate_altitude are always stored. Higher planes are thinned, a plane
+    in a tier is stored at most once per interval of that tier. Tiers are given as (min_altitude, interval) tuples,
+    the tier with the highest min_altitude not above the altitude of the plane applies
+
+    Adaptive polling: the poll interval follows the amount of planes at or below full_rate_altitude. When there are
+    at least busy_count of them polling happens at min_interval, with less traffic the interval grows towards
+    max_interval. The interval drops immediately when traffic increases and grows gradually by backoff when it
+    decreases, so a plane entering a quiet area is picked up quickly
+    """
+    def __init__(self,
+                 full_rate_altitude: float = DEFAULT_FULL_RATE_ALTITUDE,
+                 tiers: list = None,
+                 min_interval: float = 10,
+                 max_interval: float = 10,
+                 busy_count: int = 1,
+                 backoff: float = 1.5):
+        """
+        Constructor
+        @param full_rate_altitude: states at or below this altitude in meters are stored at full rate
+        @param tiers: list of (min_altitude, interval) tuples in meters and seconds, None stores every state
+        @param min_interval: poll interval in seconds when busy
+        @param max_interval: poll interval in seconds without low flying planes, equal to min_interval disables
+        adaptive polling
+        @param busy_count: amount of low flying planes from which polling happens at min_interval
+        @param backoff: factor the interval grows with per poll while traffic is low
+        """
+        if max_interval < min_interval:
+            raise Exception('max_interval cannot be smaller than min_interval')
+
+        self.full_rate_altitude = full_rate_altitude
+        self.tiers = sorted(tiers or [], key=lambda tier: tier[0])
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.busy_count = max(1, busy_count)
+        self.backoff = backoff
+
+        self.interval = min_interval
+        self.last_stored = {}
+
+        # Statistics
+        self.states_received = 0
+        self.states_stored = 0
+        self.polls = 0
+
+    def _get_tier_interval(self, altitude: float):
+        if altitude is None or altitude <= self.full_rate_altitude:
+            return 0
+        interval = 0
+        for min_altitude, tier_interval in self.tiers:
+            if altitude >= min_altitude:
+                interval = tier_interval
+        return interval
+
+    def filter(self, states: list, now: float = None):
+        """
+        Thins high altitude states according to the tiers, states without callsign are always stored
+        @param states: all obtained states
+        @param now: current time in seconds, defaults to monotonic clock
+        @return: the states to store
+        """
+        if now is None:
+            now = time.monotonic()
+
+        stored = []
+        for state in states:
+            interval = self._get_tier_interval(state.get('geo_altitude'))
+            key = state.get('callsign')
+            if interval > 0 and key:
+                last = self.last_stored.get(key)
+                if last is not None and now - last < interval:
+                    continue
+                self.last_stored[key] = now
+            stored.append(state)
+
+        # Forget planes not stored for a while, keeps the administration bounded
+        if len(self.tiers) > 0 and len(self.last_stored) > 2 * len(states) + 1000:
+            horizon = max(tier[1] for tier in self.tiers)
+            self.last_stored = {key: last for key, last in self.last_stored.items() if now - last < horizon}
+
+        self.states_received += len(states)
+        self.states_stored += len(stored)
+        return stored
+
+    def next_interval(self, states: list):
+        """
+        Updates and returns the poll interval given the states obtained by the last poll
+        @param states: all obtained states, None when polling failed
+        @return: seconds until the next poll
+        """
+        self.polls += 1
+        if states is None:
+            return self.interval
+
+        low_count = sum(1 for state in states
+                        if state.get('geo_altitude') is not None and state['geo_altitude'] <= self.full_rate_altitude)
+        target = self.max_interval - (self.max_interval - self.min_interval) * min(1.0, low_count / self.busy_count)
+        if target < self.interval:
+            self.interval = target
+        else:
+            self.interval = min(target, self.interval * self.backoff)
+        return self.interval
+
+    def get_max_gap_seconds(self, margin: float = 60):
+        """
+        Returns the longest time in seconds between two stored states of a plane that is still in view. A thinned plane
+        is stored at the first poll after the interval of its tier passed, polls happen at most max_interval apart
+        Readers use it to tell a thinned plane from a plane that is gone
+        @param margin: seconds added for late or failed polls
+        @return: the gap in seconds
+        """
+        return max([tier[1] for tier in self.tiers] + [0]) + self.max_interval + margin
+
+    def get_stats(self):
+        """
+        Returns sampling and polling statistics
+        @return: dictionary holding the statistics
+        """
+        return {'poll_interval_seconds': self.interval,
+                'polls': self.polls,
+                'states_received': self.states_received,
+                'states_stored': self.states_stored,
+                'states_thinned': self.states_received - self.states_stored}
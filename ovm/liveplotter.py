@@ -0,0 +1,208 @@
+import io
+import logging
+import multiprocessing
+import queue
+from multiprocessing import Process
+import contextily as ctx
+import matplotlib
+import matplotlib.pyplot as plt
+import numpy
+from matplotlib.animation import FFMpegWriter
+
+"""
+Use the agg backend because we only want to plot to files
+See : https://matplotlib.org/stable/users/explain/backends.html
+"""
+matplotlib.use('agg')
+
+
+def project_epsg4326_to_epsg3857(lon: numpy.ndarray, lat: numpy.ndarray):
+    """
+    Vectorized version of convert_epsg4326_to_epsg3857
+    @param lon: array of longitudes
+    @param lat: array of latitudes
+    @return: arrays of converted lon, lat
+    """
+    x = lon * 20037508.34 / 180
+    y = numpy.log(numpy.tan((90 + lat) * numpy.pi / 360)) / (numpy.pi / 180) * (20037508.34 / 180)
+    return x, y
+
+
+class StatesPlotter:
+    """
+    StatesPlotter keeps one persistent figure with a cached basemap
+    Each update only moves the scatter offsets of the planes, the figure and map tiles are created once
+    """
+    def __init__(self, bbox: tuple, figsize: tuple = (15, 15), tile_zoom: int = 8):
+        """
+        Constructor, creates the figure and fetches the basemap
+        @param bbox: geographic bounding box (lat_min, lat_max, lon_min, lon_max)
+        @param figsize: figure size
+        @param tile_zoom: zoomlevel
+        """
+        self.bbox = bbox
+        x, y = project_epsg4326_to_epsg3857(numpy.array([bbox[2], bbox[3]]), numpy.array([bbox[0], bbox[1]]))
+
+        self.figure, self.ax = plt.subplots(figsize=figsize)
+        self.ax.set_xlim(x[0], x[1])
+        self.ax.set_ylim(y[0], y[1])
+        try:
+            ctx.add_basemap(self.ax, zoom=tile_zoom)
+        except Exception as ex:
+            # Keep plotting planes without map tiles rather than dropping every frame
+            logging.exception(ex)
+        self.ax.set_axis_off()
+        self.scatter = self.ax.scatter([], [], alpha=0.8, edgecolor='k', zorder=2)
+        self.label = self.ax.text(0.02, 0.02, '',
+                                  verticalalignment='bottom', horizontalalignment='left',
+                                  transform=self.ax.transAxes,
+                                  color='black', fontsize=15,
+                                  bbox={'facecolor': 'white', 'alpha': 1, 'pad': 10})
+
+    def update(self, states: list, label: str = ''):
+        """
+        Moves the scatter offsets to the positions of given states, states outside the bounding box are ignored
+        @param states: all states/planes
+        @param label: text drawn in the lower left corner, for example the timestamp
+        """
+        lat = numpy.array([state['latitude'] for state in states], dtype=float)
+        lon = numpy.array([state['longitude'] for state in states], dtype=float)
+        within = (lat >= self.bbox[0]) & (lat <= self.bbox[1]) & (lon >= self.bbox[2]) & (lon <= self.bbox[3])
+        x, y = project_epsg4326_to_epsg3857(lon[within], lat[within])
+        self.scatter.set_offsets(numpy.column_stack((x, y)))
+        self.label.set_text(label)
+
+    def render(self):
+        """
+        Renders the current figure
+        @return: image in bytes
+        """
+        img: bytes
+        with io.BytesIO() as buffer:  # use buffer memory
+            self.figure.savefig(buffer, format='jpg', bbox_inches="tight", pad_inches=-0.1)
+            buffer.seek(0)
+            img = buffer.getvalue()
+        return img
+
+    def close(self):
+        plt.close(self.figure)
+
+
+class PlotWorker:
+    """
+    PlotWorker renders states in a separate process so logging is never delayed by plotting
+    Frames are either written as separate jpg files or streamed into a single timelapse video or gif using ffmpeg
+    If the worker can't keep up, frames are dropped instead of blocking the caller
+    The constructor waits until the worker has set up its figure and timelapse and raises exception if that fails.
+    Submitting a frame to a worker that stopped raises exception, so frames are never dropped unnoticed
+    """
+    def __init__(self,
+                 bbox: tuple,
+                 tile_zoom: int = 8,
+                 timelapse: str = None,
+                 fps: int = 10,
+                 max_pending: int = 8,
+                 setup_timeout: float = 120.0):
+        """
+        Constructor, starts the worker process and waits for its setup
+        @param bbox: geographic bounding box (lat_min, lat_max, lon_min, lon_max)
+        @param tile_zoom: zoomlevel
+        @param timelapse: filename of timelapse, extension determines format (.mp4, .gif, ..), None writes jpg files
+        @param fps: frames per second of the timelapse
+        @param max_pending: maximum amount of frames waiting to be rendered
+        @param setup_timeout: seconds to wait for the worker to fetch the basemap and start the timelapse
+        """
+        self.frames = multiprocessing.Queue(maxsize=max_pending)
+        setup = multiprocessing.Queue(maxsize=1)
+        self.process = Process(target=PlotWorker._run, args=(self.frames, setup, bbox, tile_zoom, timelapse, fps),
+                               daemon=True)
+        self.process.start()
+
+        try:
+            error = setup.get(timeout=setup_timeout)
+        except queue.Empty:
+            error = 'setup took longer than %f seconds' % setup_timeout
+        if error is not None:
+            self.process.terminate()
+            raise Exception(self.prepare_log('Plot worker failed to start, %s' % error))
+
+    def is_alive(self):
+        """
+        Returns True if the worker process is running
+        """
+        return self.process.is_alive()
+
+    def prepare_log(self, message: str):
+        return self.__class__.__name__ + ': ' + message
+
+    def submit(self, states: list, label: str = '', filename: str = None):
+        """
+        Submits a frame, never blocks
+        @param states: all states/planes
+        @param label: text drawn in the lower left corner
+        @param filename: jpg output filename, ignored when writing a timelapse
+        @return: True if the frame is queued, False if dropped
+        Raises exception if the worker process stopped
+        """
+        if not self.process.is_alive():
+            raise Exception(self.prepare_log('Plot worker stopped with exit code %s' % self.process.exitcode))
+        try:
+            self.frames.put_nowait((states, label, filename))
+            return True
+        except queue.Full:
+            logging.warning(self.prepare_log('Plot worker is behind, dropping frame %s' % label))
+            return False
+
+    def close(self, timeout: float = 60.0):
+        """
+        Finishes all pending frames, closes the timelapse and stops the worker process
+        @param timeout: seconds to wait for the worker to finish
+        """
+        if not self.process.is_alive():
+            return
+        try:
+            self.frames.put(None, timeout=timeout)
+            self.process.join(timeout)
+        except queue.Full:
+            logging.error(self.prepare_log('Plot worker does not respond, terminating'))
+        if self.process.is_alive():
+            self.process.terminate()
+
+    @staticmethod
+    def _run(frames, setup, bbox: tuple, tile_zoom: int, timelapse: str, fps: int):
+        # Report whether the figure and the timelapse could be set up, for example ffmpeg may be missing
+        plotter = None
+        writer = None
+        try:
+            plotter = StatesPlotter(bbox=bbox, tile_zoom=tile_zoom)
+            if timelapse is not None:
+                writer = FFMpegWriter(fps=fps)
+                writer.setup(plotter.figure, timelapse)
+        except Exception as ex:
+            logging.exception(ex)
+            setup.put('%s: %s' % (ex.__class__.__name__, ex))
+            if plotter is not None:
+                plotter.close()
+            exit(1)
+        setup.put(None)
+
+        try:
+            while True:
+                frame = frames.get()
+                if frame is None:
+                    break
+
+                states, label, filename = frame
+                try:
+                    plotter.update(states, label)
+                    if writer is not None:
+                        writer.grab_frame()
+                    elif filename is not None:
+                        with open(filename, 'wb') as fh:
+                            fh.write(plotter.render())
+                except Exception as ex:
+                    logging.exception(ex)
+        finally:
+            if writer is not None:
+                writer.finish()
+            plotter.close()
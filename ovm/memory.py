@@ -0,0 +1,127 @@
+import os
+import resource
+import tracemalloc
+from contextlib import contextmanager
+
+# Size of a memory page, resident memory in /proc/self/statm is counted in pages
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def get_rss_bytes():
+    """
+    Returns the resident memory of this process in bytes, None if it can't be read
+    """
+    try:
+        with open('/proc/self/statm', 'r') as fh:
+            return int(fh.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def get_peak_rss_bytes():
+    """
+    Returns the peak resident memory of this process in bytes
+    A forked process starts with the resident memory of its parent at the time of the fork
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MemoryCeiling:
+    """
+    Limits the resident memory a process may add to the memory it had when the ceiling was set
+    Long loops call check, which fails with an exception once the ceiling is exceeded. Unlike a MemoryError raised by
+    the kernel limit, the exception is raised at a known point in Python code where unwinding is safe
+    Resident memory is only read every interval calls, so checking in a loop doesn't slow it down
+    """
+    def __init__(self, interval: int = 256):
+        """
+        Constructor
+        @param interval: resident memory is read every interval calls of check
+        """
+        self.interval = interval
+        self.limit = None
+        self.baseline = 0
+        self.calls = 0
+
+    def configure(self, limit_mb: int = None):
+        """
+        Sets the ceiling, relative to the resident memory of the process now
+        @param limit_mb: megabytes the process may add, None removes the ceiling
+        """
+        rss = get_rss_bytes()
+        self.limit = limit_mb if rss is not None else None
+        self.baseline = rss if rss is not None else 0
+        self.calls = 0
+
+    def check(self, force: bool = False):
+        """
+        Raises exception if the process exceeds the ceiling, does nothing without ceiling
+        @param force: read resident memory now instead of every interval calls
+        """
+        if self.limit is None:
+            return
+        self.calls += 1
+        if not force and self.calls % self.interval != 0:
+            return
+        rss = get_rss_bytes()
+        if rss is None:
+            return
+        growth = rss - self.baseline
+        if growth > self.limit * 1024 * 1024:
+            raise Exception('Query exceeded the memory ceiling of %i MB, using %i MB, narrow the period or radius' %
+                            (self.limit, growth / (1024 * 1024)))
+
+
+class MemoryUsage:
+    """
+    Memory used by a traced block of code, see trace_memory
+    """
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.traced_peak_bytes = 0
+        self.rss_peak_bytes = 0
+
+    def get_report(self):
+        """
+        Returns the peak memory in megabytes, peak_traced_mb is the peak of memory allocated by Python within the block
+        and peak_rss_mb the peak resident memory of the process, including what it had before the block
+        """
+        report = {'peak_rss_mb': round(self.rss_peak_bytes / (1024 * 1024), 1)}
+        if self.enabled:
+            report['peak_traced_mb'] = round(self.traced_peak_bytes / (1024 * 1024), 1)
+        return report
+
+
+@contextmanager
+def trace_memory(enabled: bool = True):
+    """
+    Context manager measuring the peak memory of the code within using tracemalloc
+    Tracing slows allocations down, without enabled only the peak resident memory of the process is taken
+    @param enabled: trace allocations
+    @return: yields MemoryUsage, complete when the block ends
+    """
+    usage = MemoryUsage(enabled)
+    started = enabled and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    elif enabled:
+        tracemalloc.reset_peak()
+    try:
+        yield usage
+    finally:
+        if enabled:
+            usage.traced_peak_bytes = tracemalloc.get_traced_memory()[1]
+        if started:
+            tracemalloc.stop()
+        usage.rss_peak_bytes = get_peak_rss_bytes()
+
+
+# Memory ceiling of this process
+_ceiling = MemoryCeiling()
+
+
+def get_memory_ceiling():
+    """
+    Returns the memory ceiling of this process
+    """
+    return _ceiling
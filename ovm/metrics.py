@@ -0,0 +1,355 @@
+import fcntl
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+"""
+Bucket bounds of histograms in seconds, used when a histogram is observed without bounds
+"""
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+"""
+Bucket bounds of histograms counting things, such as aircraft per tick
+"""
+COUNT_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+"""
+Bucket bounds of histograms of sizes in bytes
+"""
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+"""
+Bucket bounds of histograms of memory in bytes, 16 MB up to 8 GB
+"""
+MEMORY_BUCKETS = tuple(2 ** exponent * 1048576 for exponent in range(4, 14))
+
+"""
+Type and description of the metrics, metrics that are not listed are exposed without description
+"""
+METRICS = {
+    'omd_request_seconds': ('histogram', 'Latency of API calls including admission, by endpoint'),
+    'omd_request_errors_total': ('counter', 'API calls that failed, by endpoint'),
+    'omd_request_rejected_total': ('counter', 'API calls rejected by admission control, by class'),
+    'omd_stage_seconds': ('histogram', 'Seconds an API call spent per stage: fetch, decode, filter, state_machine, '
+                                       'trajectory, plot, encode and geocode'),
+    'omd_worker_busy_seconds_total': ('counter', 'Seconds running slots were held, by admission class'),
+    'omd_worker_capacity': ('gauge', 'Running slots, by admission class'),
+    'omd_worker_peak_rss_bytes': ('histogram', 'Peak resident memory of worker processes, by endpoint'),
+    'omd_request_traced_peak_bytes': ('histogram', 'Peak memory allocated by API calls traced using tracemalloc, by '
+                                                   'endpoint'),
+    'omd_ingest_tick_seconds': ('histogram', 'Duration of a plane logger tick'),
+    'omd_ingest_tick_interval_seconds': ('histogram', 'Seconds between the starts of consecutive plane logger ticks'),
+    'omd_ingest_aircraft': ('histogram', 'Aircraft obtained per plane logger tick'),
+    'omd_ingest_lag_seconds': ('histogram', 'Seconds between obtaining a snapshot and writing it'),
+    'omd_ingest_write_seconds': ('histogram', 'Duration of a write of a batch of snapshots'),
+    'omd_ingest_queue_depth': ('gauge', 'Snapshots waiting to be written'),
+    'omd_snapshot_bytes': ('histogram', 'Encoded size of stored snapshots, by encoding'),
+}
+
+
+def _get_label_key(labels: dict):
+    """
+    Returns labels in the Prometheus text format, sorted by name, used as key of a series
+    """
+    if not labels:
+        return ''
+    return ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                    for name, value in sorted(labels.items()))
+
+
+def _format_value(value: float):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class StageTimer:
+    """
+    Accumulates the seconds a process spends per stage
+    Hot loops time their stages using local variables and add the totals once, so timing does not slow them down
+    """
+    def __init__(self):
+        self.seconds = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float):
+        """
+        Adds seconds to a stage
+        @param stage: name of the stage
+        @param seconds: seconds spent
+        """
+        with self.lock:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def time(self, stage: str):
+        """
+        Context manager adding the seconds spent within to a stage
+        @param stage: name of the stage
+        """
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - begin)
+
+    def get(self):
+        """
+        Returns a copy of the seconds per stage
+        """
+        with self.lock:
+            return dict(self.seconds)
+
+    def take(self):
+        """
+        Returns the seconds per stage and starts over
+        """
+        with self.lock:
+            seconds = self.seconds
+            self.seconds = {}
+        return seconds
+
+
+class Metrics:
+    """
+    Counters, gauges and histograms of a process, exposed in the Prometheus text format
+    Processes don't share memory, every process records into its own Metrics and flushes them into a file shared by
+    all processes, <directory>/metrics.json, which is updated under an exclusive lock. Flushing adds counters and
+    histograms to the shared totals and replaces gauges. Without directory the metrics stay within the process
+    A forked process starts with empty metrics, so nothing is counted twice
+    Statistics of a component running in a single process, such as the plane logger in the gunicorn master, are
+    published as a whole into <directory>/<name>.json so every process reads their latest state
+    """
+    def __init__(self, directory: str = None):
+        """
+        Constructor
+        @param directory: directory of the file shared by all processes, None keeps the metrics within the process
+        """
+        self.directory = None
+        self.published = {}
+        self.configure(directory)
+        self._reset()
+
+    def _reset(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.stages = StageTimer()
+
+    def configure(self, directory: str = None):
+        """
+        Sets the directory of the file shared by all processes
+        @param directory: the directory, None keeps the metrics within the process
+        """
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+
+    def inc(self, name: str, value: float = 1.0, labels: dict = None):
+        """
+        Increments a counter
+        @param name: name of the counter
+        @param value: amount to add
+        @param labels: labels of the series
+        """
+        key = _get_label_key(labels)
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+
+    def set(self, name: str, value: float, labels: dict = None):
+        """
+        Sets a gauge
+        @param name: name of the gauge
+        @param value: the value
+        @param labels: labels of the series
+        """
+        key = _get_label_key(labels)
+        with self.lock:
+            self.gauges.setdefault(name, {})[key] = value
+
+    def observe(self, name: str, value: float, labels: dict = None, buckets: tuple = DEFAULT_BUCKETS):
+        """
+        Observes a value of a histogram
+        @param name: name of the histogram
+        @param value: the value
+        @param labels: labels of the series
+        @param buckets: upper bounds of the buckets, ascending, the same for every observation of a histogram
+        """
+        key = _get_label_key(labels)
+        with self.lock:
+            histogram = self.histograms.setdefault(name, {}).get(key)
+            if histogram is None:
+                histogram = {'bounds': list(buckets), 'counts': [0] * (len(buckets) + 1), 'sum': 0.0, 'count': 0}
+                self.histograms[name][key] = histogram
+            idx = 0
+            while idx < len(buckets) and value > buckets[idx]:
+                idx += 1
+            histogram['counts'][idx] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def observe_stages(self, labels: dict = None):
+        """
+        Observes the seconds accumulated per stage in omd_stage_seconds and starts over
+        @param labels: labels of the series, the stage is added as label
+        """
+        for stage, seconds in self.stages.take().items():
+            self.observe('omd_stage_seconds', seconds, labels=dict(labels or {}, stage=stage))
+
+    def _take(self):
+        """
+        Returns the metrics recorded since the last flush and starts over
+        """
+        with self.lock:
+            taken = {'counters': self.counters, 'gauges': self.gauges, 'histograms': self.histograms}
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+        return taken
+
+    @staticmethod
+    def _merge(total: dict, taken: dict):
+        """
+        Adds counters and histograms of taken to total and replaces its gauges
+        """
+        for name, series in taken['counters'].items():
+            total_series = total['counters'].setdefault(name, {})
+            for key, value in series.items():
+                total_series[key] = total_series.get(key, 0.0) + value
+        for name, series in taken['gauges'].items():
+            total['gauges'].setdefault(name, {}).update(series)
+        for name, series in taken['histograms'].items():
+            total_series = total['histograms'].setdefault(name, {})
+            for key, histogram in series.items():
+                total_histogram = total_series.get(key)
+                if total_histogram is None or total_histogram['bounds'] != histogram['bounds']:
+                    total_series[key] = histogram
+                    continue
+                total_histogram['counts'] = [a + b for a, b in zip(total_histogram['counts'], histogram['counts'])]
+                total_histogram['sum'] += histogram['sum']
+                total_histogram['count'] += histogram['count']
+        return total
+
+    def flush(self):
+        """
+        Adds the metrics recorded by this process to the file shared by all processes
+        Does nothing without directory
+        """
+        if self.directory is None:
+            return
+        taken = self._take()
+        if not (taken['counters'] or taken['gauges'] or taken['histograms']):
+            return
+        path = os.path.join(self.directory, 'metrics.json')
+        with open(os.path.join(self.directory, 'metrics.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            total = self._read(path)
+            self._merge(total, taken)
+            temp_path = '%s.%i.tmp' % (path, os.getpid())
+            with open(temp_path, 'w') as fh:
+                json.dump(total, fh)
+            os.replace(temp_path, path)
+
+    @staticmethod
+    def _read(path: str):
+        try:
+            with open(path, 'r') as fh:
+                return json.load(fh)
+        except (FileNotFoundError, ValueError):
+            return {'counters': {}, 'gauges': {}, 'histograms': {}}
+
+    def publish(self, name: str, value: dict):
+        """
+        Replaces published statistics, read by all processes using get_published
+        Without directory the statistics stay within the process
+        @param name: name of the statistics
+        @param value: JSON serializable statistics
+        """
+        if self.directory is None:
+            self.published[name] = value
+            return
+        path = os.path.join(self.directory, name + '.json')
+        temp_path = '%s.%i.tmp' % (path, os.getpid())
+        with open(temp_path, 'w') as fh:
+            json.dump(value, fh)
+        os.replace(temp_path, path)
+
+    def get_published(self, name: str):
+        """
+        Returns the statistics last published by any process, None if they were never published
+        @param name: name of the statistics
+        """
+        if self.directory is None:
+            return self.published.get(name)
+        try:
+            with open(os.path.join(self.directory, name + '.json'), 'r') as fh:
+                return json.load(fh)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def collect(self):
+        """
+        Returns the metrics of all processes, flushes the metrics of this process first
+        Without directory the metrics of this process are returned
+        @return: dictionary holding counters, gauges and histograms by name and label key
+        """
+        if self.directory is None:
+            with self.lock:
+                return json.loads(json.dumps({'counters': self.counters,
+                                              'gauges': self.gauges,
+                                              'histograms': self.histograms}))
+        self.flush()
+        return self._read(os.path.join(self.directory, 'metrics.json'))
+
+    def render(self):
+        """
+        Returns the metrics of all processes in the Prometheus text format
+        """
+        collected = self.collect()
+        lines = []
+        names = sorted(set(collected['counters']) | set(collected['gauges']) | set(collected['histograms']))
+        for name in names:
+            _, description = METRICS.get(name, (None, None))
+            if description is not None:
+                lines.append('# HELP %s %s' % (name, description))
+            if name in collected['histograms']:
+                lines.append('# TYPE %s histogram' % name)
+                for key, histogram in sorted(collected['histograms'][name].items()):
+                    cumulative = 0
+                    for bound, count in zip(histogram['bounds'] + [math.inf], histogram['counts']):
+                        cumulative += count
+                        bucket_key = (key + ',' if key else '') + 'le="%s"' % _format_value(bound)
+                        lines.append('%s_bucket{%s} %i' % (name, bucket_key, cumulative))
+                    suffix = '{%s}' % key if key else ''
+                    lines.append('%s_sum%s %s' % (name, suffix, _format_value(histogram['sum'])))
+                    lines.append('%s_count%s %i' % (name, suffix, histogram['count']))
+                continue
+            kind = 'counters' if name in collected['counters'] else 'gauges'
+            lines.append('# TYPE %s %s' % (name, 'counter' if kind == 'counters' else 'gauge'))
+            for key, value in sorted(collected[kind][name].items()):
+                lines.append('%s%s %s' % (name, '{%s}' % key if key else '', _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+# Metrics of this process
+_metrics = Metrics()
+os.register_at_fork(after_in_child=lambda: _metrics._reset())
+
+
+def get_metrics():
+    """
+    Returns the metrics of this process
+    """
+    return _metrics
+
+
+def get_stages():
+    """
+    Returns the stage timer of this process
+    """
+    return _metrics.stages
@@ -0,0 +1,118 @@
+import os
+import threading
+from pymongo import MongoClient, monitoring
+from ovm.environment import MongoDBConfiguration
+
+
+class PoolStatistics(monitoring.ConnectionPoolListener):
+    """
+    Listens to connection pool events of the shared MongoClient and keeps count of them
+    """
+    def __init__(self):
+        self.pools = 0
+        self.connections_open = 0
+        self.connections_created = 0
+        self.connections_closed = 0
+        self.checked_out = 0
+        self.check_outs = 0
+        self.check_out_failures = 0
+
+    def pool_created(self, event):
+        self.pools += 1
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        self.pools -= 1
+
+    def connection_created(self, event):
+        self.connections_created += 1
+        self.connections_open += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self.connections_closed += 1
+        self.connections_open -= 1
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self.check_out_failures += 1
+
+    def connection_checked_out(self, event):
+        self.checked_out += 1
+        self.check_outs += 1
+
+    def connection_checked_in(self, event):
+        self.checked_out -= 1
+
+    def get_stats(self):
+        return {'pools': self.pools,
+                'connections_open': self.connections_open,
+                'connections_created': self.connections_created,
+                'connections_closed': self.connections_closed,
+                'checked_out': self.checked_out,
+                'check_outs': self.check_outs,
+                'check_out_failures': self.check_out_failures}
+
+
+# The process-wide client, its pool statistics and the pid of the process it was created in
+_client: MongoClient = None
+_client_pid: int = None
+_statistics: PoolStatistics = None
+_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    """
+    A forked child must not use the client of its parent, forget it and recreate the lock
+    """
+    global _client, _client_pid, _statistics, _lock
+    _client = None
+    _client_pid = None
+    _statistics = None
+    _lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_mongo_client(config: MongoDBConfiguration):
+    """
+    Returns the MongoClient shared by all components of this process
+    The client is created on first use with the pool, timeout, compression, read preference and write concern settings
+    of the configuration, and created again in a forked child process
+    :param config: the mongodb configuration
+    :return: the shared MongoClient
+    """
+    global _client, _client_pid, _statistics
+    pid = os.getpid()
+    if _client is not None and _client_pid == pid:
+        return _client
+
+    with _lock:
+        if _client is None or _client_pid != pid:
+            _statistics = PoolStatistics()
+            _client = MongoClient(config.host,
+                                  config.port,
+                                  event_listeners=[_statistics],
+                                  **config.get_client_options())
+            _client_pid = pid
+    return _client
+
+
+def get_pool_stats():
+    """
+    Returns connection pool statistics of the shared client of this process
+    :return: dictionary holding the statistics, empty if no client has been created yet
+    """
+    if _statistics is None or _client_pid != os.getpid():
+        return {}
+    return _statistics.get_stats()
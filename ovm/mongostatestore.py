@@ -0,0 +1,380 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+import pymongo
+from pymongo import UpdateOne
+from pymongo.collection import Collection
+from ovm.geocells import get_cell, get_covering_cells
+from ovm.metrics import get_stages
+from ovm.snapshotcodec import KEYFRAME_FIELD, SnapshotDecoder, SnapshotEncoder, get_update
+from ovm.statepartitions import StatePartitions, get_day
+from ovm.statestore import StateStore
+
+"""
+Documents per batch of the cursors of a scan, bounds the fetched documents held in memory while scanning
+"""
+SCAN_BATCH_SIZE = 256
+
+
+class MongoStateStore(StateStore):
+    """
+    StateStore keeping snapshots in MongoDB, one document per snapshot in the collection of its day
+    Snapshots are stored as keyframes and deltas, see SnapshotEncoder. A failed write or reset forces the next snapshot
+    to be a keyframe and unordered snapshots are written as keyframes, so a delta never refers to a snapshot that is not
+    stored. The first snapshot of a day is a keyframe as well, every day collection can be read on its own
+    Before writing, the store checks no other writer stored a snapshot after its last one, and writes a keyframe
+    otherwise, so two loggers writing the same collection don't interleave their deltas
+    Scans start decoding at the last keyframe at or before the requested begin
+    With a position index every state is also written as a document holding a GeoJSON point and its geo-cell into the
+    positions collections, which carry a compound (cell, Time) index. Scans with a bbox query only the cells covering
+    the bbox and don't decode snapshots
+    """
+    def __init__(self,
+                 partitions: StatePartitions,
+                 keyframe_interval: int = 30,
+                 positions: StatePartitions = None,
+                 cell_size: float = 0.05,
+                 max_time_ms: int = None):
+        """
+        Constructor
+        @param partitions: routes snapshots to the states collections
+        @param keyframe_interval: every keyframe_interval-th snapshot is stored in full, 1 disables delta encoding
+        @param positions: routes states to the positions collections, None disables the position index
+        @param cell_size: geo-cell size of the position index in degrees
+        @param max_time_ms: time limit of every scan query in milliseconds, None for no limit
+        """
+        self.partitions = partitions
+        self.encoder = SnapshotEncoder(keyframe_interval=keyframe_interval)
+        self.last_day = None
+        self.positions = positions
+        self.cell_size = cell_size
+        self.max_time_ms = max_time_ms
+        self.documents_fetched = 0
+        self.documents_lock = threading.Lock()
+
+    def prepare_log(self, message: str):
+        return self.__class__.__name__ + ': ' + message
+
+    def _get_position(self, timestamp_int: int, state: dict):
+        """
+        Returns the position index document of a state
+        """
+        return {'Time': timestamp_int,
+                'cell': get_cell(state['latitude'], state['longitude'], self.cell_size),
+                'loc': {'type': 'Point', 'coordinates': [state['longitude'], state['latitude']]},
+                'callsign': state.get('callsign'),
+                'icao24': state.get('icao24'),
+                'geo_altitude': state.get('geo_altitude')}
+
+    def _write_positions(self, snapshots: list):
+        """
+        Replaces the position index documents of snapshots, grouped by day
+        """
+        days = OrderedDict()
+        for key, states in snapshots:
+            day = days.setdefault(get_day(key), ([], []))
+            day[0].append(key)
+            day[1].extend(self._get_position(key, state) for state in states
+                          if state.get('latitude') is not None and state.get('longitude') is not None)
+        for day, (keys, documents) in days.items():
+            collection = self.positions.get_day_collection(day)
+            collection.delete_many({'Time': {'$in': keys}})
+            if len(documents) > 0:
+                collection.insert_many(documents, ordered=False)
+
+    @staticmethod
+    def _bulk_write(partitions: StatePartitions, requests: OrderedDict):
+        """
+        Writes the requests grouped by day using a single ordered bulk_write per day collection
+        Ordered, so on failure every written delta still follows the snapshot it was encoded against
+        """
+        for day, day_requests in requests.items():
+            partitions.get_day_collection(day).bulk_write(day_requests, ordered=True)
+
+    def _is_latest(self, key: int):
+        """
+        Returns True if no snapshot after key is stored, False once another writer stored a snapshot after it
+        """
+        return self.partitions.get_collection(key).find_one({'Time': {'$gt': key}}, projection={'Time': True}) is None
+
+    def write(self, snapshots: list):
+        # A delta must follow the snapshot it was encoded against, when another writer such as a second logger stored
+        # a snapshot after the last one written here the next snapshot is a keyframe
+        previous_key = self.encoder.previous_key
+        if len(snapshots) > 0 and previous_key is not None and not self._is_latest(previous_key):
+            logging.warning(self.prepare_log('Another writer stored snapshots after %i, writing a keyframe' %
+                                             previous_key))
+            self.encoder.reset()
+
+        requests = OrderedDict()
+        for key, states in snapshots:
+            day = get_day(key)
+            if day != self.last_day:
+                self.encoder.reset()
+                self.last_day = day
+            name, value = self.encoder.encode(states, key)
+            requests.setdefault(day, []).append(UpdateOne({'Time': key}, get_update(name, value), upsert=True))
+
+        try:
+            MongoStateStore._bulk_write(self.partitions, requests)
+        except Exception:
+            self.encoder.reset()
+            raise
+
+        if self.positions is not None:
+            self._write_positions(snapshots)
+
+    def write_unordered(self, snapshots: list):
+        requests = OrderedDict()
+        for key, states in snapshots:
+            requests.setdefault(get_day(key), []).append(
+                UpdateOne({'Time': key}, get_update(KEYFRAME_FIELD, states), upsert=True))
+        MongoStateStore._bulk_write(self.partitions, requests)
+        if self.positions is not None:
+            self._write_positions(snapshots)
+
+    def reset(self):
+        self.encoder.reset()
+
+    @staticmethod
+    def _get_keyframe_time(collection: Collection, timestamp_int: int):
+        """
+        Returns the Time of the last keyframe at or before timestamp_int, None if there is none
+        """
+        document = collection.find_one({'Time': {'$lte': timestamp_int}, KEYFRAME_FIELD: {'$exists': True}},
+                                       projection={'Time': 1},
+                                       sort=[('Time', pymongo.DESCENDING)])
+        return document['Time'] if document is not None else None
+
+    def _add_documents_fetched(self, count: int):
+        with self.documents_lock:
+            self.documents_fetched += count
+
+    def _scan_collection(self, collection: Collection, begin: int, end: int = None, max_time_ms: int = None):
+        keyframe_time = MongoStateStore._get_keyframe_time(collection, begin)
+        time_filter = MongoStateStore._get_time_filter(keyframe_time if keyframe_time is not None else begin, end)
+
+        decoder = SnapshotDecoder()
+        cursor = collection.find({'Time': time_filter}, projection={'_id': False}).sort(
+            [('Time', pymongo.ASCENDING)]).batch_size(SCAN_BATCH_SIZE)
+        if max_time_ms is not None:
+            cursor = cursor.max_time_ms(max_time_ms)
+
+        # Fetch and decode seconds and fetched documents are summed locally and added once
+        fetch_seconds = 0.0
+        decode_seconds = 0.0
+        documents = 0
+        try:
+            clock = time.perf_counter()
+            for document in cursor:
+                documents += 1
+                fetched = time.perf_counter()
+                states = decoder.decode(document)
+                decoded = time.perf_counter()
+                fetch_seconds += fetched - clock
+                decode_seconds += decoded - fetched
+                clock = decoded
+                if document['Time'] < begin or states is None:
+                    continue
+                yield document['Time'], states
+                clock = time.perf_counter()
+        finally:
+            get_stages().add('fetch', fetch_seconds)
+            get_stages().add('decode', decode_seconds)
+            self._add_documents_fetched(documents)
+
+    @staticmethod
+    def _get_time_filter(begin: int, end: int):
+        time_filter = {'$gte': begin}
+        if end is not None:
+            time_filter['$lte'] = end
+        return time_filter
+
+    @staticmethod
+    def _get_position_filter(begin: int, end: int, cells: list, max_altitude: float):
+        position_filter = {'cell': {'$in': cells}, 'Time': MongoStateStore._get_time_filter(begin, end)}
+        if max_altitude is not None:
+            position_filter['geo_altitude'] = {'$lt': max_altitude}
+        return position_filter
+
+    def _get_scan_cells(self, begin: int, bbox: tuple):
+        """
+        Returns the cells covering bbox if the scan can be planned on the position index, None otherwise
+        """
+        if self.positions is None or bbox is None:
+            return None
+        cells = get_covering_cells(bbox, self.cell_size)
+        first_position = self.positions.get_first_time()
+        if cells is None or first_position is None or first_position > begin:
+            return None
+        return cells
+
+    def _scan_positions(self, begin: int, end: int, cells: list, max_altitude: float):
+        """
+        Yields the snapshots between begin and end holding only the states in cells, using the (cell, Time) index
+        """
+        time_filter = MongoStateStore._get_time_filter(begin, end)
+        position_filter = MongoStateStore._get_position_filter(begin, end, cells, max_altitude)
+
+        days = self.partitions.get_days(begin, end) if self.partitions.partition_by_day else [None]
+        for day in days:
+            # Every snapshot is yielded, also without states in the cells
+            times = self.partitions.get_day_collection(day).find(
+                {'Time': time_filter}, projection={'_id': False, 'Time': True}).sort(
+                [('Time', pymongo.ASCENDING)]).batch_size(SCAN_BATCH_SIZE)
+            positions = self.positions.get_day_collection(day).find(
+                position_filter, projection={'_id': False, 'cell': False}).sort(
+                [('Time', pymongo.ASCENDING)]).batch_size(SCAN_BATCH_SIZE)
+            if self.max_time_ms is not None:
+                times = times.max_time_ms(self.max_time_ms)
+                positions = positions.max_time_ms(self.max_time_ms)
+            positions = iter(positions)
+
+            # Reading positions is fetching, there is nothing to decode
+            fetch_seconds = 0.0
+            documents = 0
+            try:
+                clock = time.perf_counter()
+                position = next(positions, None)
+                for document in times:
+                    documents += 1
+                    states = []
+                    while position is not None and position['Time'] <= document['Time']:
+                        documents += 1
+                        if position['Time'] == document['Time']:
+                            longitude, latitude = position['loc']['coordinates']
+                            states.append({'callsign': position['callsign'],
+                                           'icao24': position['icao24'],
+                                           'latitude': latitude,
+                                           'longitude': longitude,
+                                           'geo_altitude': position['geo_altitude']})
+                        position = next(positions, None)
+                    fetch_seconds += time.perf_counter() - clock
+                    yield document['Time'], states
+                    clock = time.perf_counter()
+            finally:
+                get_stages().add('fetch', fetch_seconds)
+                self._add_documents_fetched(documents)
+
+    def scan(self, begin: int, end: int = None, bbox: tuple = None, max_altitude: float = None):
+        # Plan the scan on the cells covering bbox if the position index covers the window
+        cells = self._get_scan_cells(begin, bbox)
+        if cells is not None:
+            yield from self._scan_positions(begin, end, cells, max_altitude)
+            return
+
+        for collection in self.partitions.get_collections(begin, end):
+            yield from self._scan_collection(collection, begin, end, max_time_ms=self.max_time_ms)
+
+    def explain(self,
+                begin: int,
+                end: int = None,
+                bbox: tuple = None,
+                max_altitude: float = None,
+                execution_stats: bool = False):
+        # The range queries are the finds on every collection the scan reads, positions or states
+        # Scans of states start at the last keyframe before begin, which doesn't change the plan of the query
+        cells = self._get_scan_cells(begin, bbox)
+        if cells is not None:
+            query_filter = MongoStateStore._get_position_filter(begin, end, cells, max_altitude)
+            collections = self.positions.get_collections(begin, end)
+        else:
+            query_filter = {'Time': MongoStateStore._get_time_filter(begin, end)}
+            collections = self.partitions.get_collections(begin, end)
+        if len(collections) == 0:
+            return None
+
+        plans = []
+        for collection in collections:
+            find = {'find': collection.name, 'filter': query_filter, 'sort': {'Time': pymongo.ASCENDING}}
+            if self.max_time_ms is not None:
+                find['maxTimeMS'] = self.max_time_ms
+            plans.append(collection.database.command(
+                {'explain': find, 'verbosity': 'executionStats' if execution_stats else 'queryPlanner'}))
+        return plans
+
+    def get_documents_fetched(self):
+        return self.documents_fetched
+
+    def get_times_before(self, timestamp_int: int, limit: int):
+        times = []
+        for collection in self.partitions.get_collections(end=timestamp_int, descending=True):
+            cursor = collection.find({'Time': {'$lte': timestamp_int}}, projection={'Time': 1}).sort(
+                [('Time', pymongo.DESCENDING)]).limit(limit - len(times))
+            times.extend(document['Time'] for document in cursor)
+            if len(times) >= limit:
+                break
+        return times
+
+    def get_first_time(self):
+        return self.partitions.get_first_time()
+
+    def remove_older_than(self, timestamp_int: int):
+        # Day collections are dropped as a whole
+        if self.partitions.partition_by_day:
+            self.partitions.drop_older_than(timestamp_int)
+            if self.positions is not None:
+                self.positions.drop_older_than(timestamp_int)
+            return
+
+        if self.positions is not None:
+            self.positions.get_collection(timestamp_int).delete_many({'Time': {'$lt': timestamp_int}})
+
+        # Keep the last keyframe before timestamp, the deltas following it can't be reconstructed without it
+        collection = self.partitions.get_collection(timestamp_int)
+        keyframe = MongoStateStore._get_keyframe_time(collection, timestamp_int)
+        if keyframe is not None:
+            collection.delete_many({'Time': {'$lt': keyframe}})
+
+    def remove_newer_than(self, timestamp_int: int):
+        for collection in self.partitions.get_collections(begin=timestamp_int):
+            collection.delete_many({'Time': {'$gte': timestamp_int}})
+        if self.positions is not None:
+            for collection in self.positions.get_collections(begin=timestamp_int):
+                collection.delete_many({'Time': {'$gte': timestamp_int}})
+
+    def create_indexes(self):
+        """
+        Creates the indexes of all existing states and positions collections
+        """
+        self.partitions.get_collections()
+        if self.positions is not None:
+            self.positions.get_collections()
+
+    def backfill_positions(self, batch_size: int = 1000):
+        """
+        Writes the position index of snapshots stored before the position index was enabled
+        Per states collection the snapshots before the first indexed snapshot of the collection are indexed
+        @param batch_size: amount of snapshots per write
+        @return: amount of indexed snapshots
+        """
+        if self.positions is None:
+            raise Exception('The position index is disabled')
+
+        count = 0
+        for collection in self.partitions.get_collections():
+            first = collection.find_one({}, projection={'Time': True}, sort=[('Time', pymongo.ASCENDING)])
+            if first is None:
+                continue
+            indexed = self.positions.get_collection(first['Time']).find_one(
+                {'Time': {'$gte': first['Time']}}, projection={'Time': True}, sort=[('Time', pymongo.ASCENDING)])
+            end = indexed['Time'] - 1 if indexed is not None else None
+            if end is not None and end < first['Time']:
+                continue
+
+            snapshots = []
+            for snapshot in self._scan_collection(collection, first['Time'], end):
+                snapshots.append(snapshot)
+                if len(snapshots) >= batch_size:
+                    self._write_positions(snapshots)
+                    count += len(snapshots)
+                    snapshots = []
+            if len(snapshots) > 0:
+                self._write_positions(snapshots)
+                count += len(snapshots)
+            logging.info(self.prepare_log('Indexed positions of %s up to %s' % (collection.name, str(end))))
+        return count
+
+    def get_stats(self):
+        return self.encoder.get_stats()
@@ -1,16 +1,23 @@
 import base64
 import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import geopy
 import geopy.distance
 import pytz
 
 from ovm.environment import Environment
-from ovm.plotter import plot_states
-from pymongo import MongoClient
+from ovm.ingestpolicy import IngestPolicy
+from ovm.metrics import COUNT_BUCKETS, get_metrics
+from ovm.flightfeed import FlightFeed, FlightRadar24Feed, split_bbox, get_union_bbox
+from ovm.profiling import ProfileStore
+from ovm.statestore import get_state_store
+from ovm.statespool import StateSpool
+from ovm.statewriter import StateWriter
 from dataclasses import dataclass
 from ovm.utils import *
-from FlightRadar24 import FlightRadar24API
 
 @dataclass
 class PlotOptions:
@@ -22,62 +29,145 @@ class PlotOptions:
     filename: str
 
 
+def get_bbox_around_center(center: tuple, radius: int):
+    """
+    Computes the geographic bounding box around center
+    @param center: center in lat lon
+    @param radius: radius in meters
+    @return: bbox in following order (lat_min, lat_max, lon_min, lon_max)
+    """
+    center = geopy.Point(center[0], center[1])
+    d = geopy.distance.geodesic(meters=radius)
+
+    # get upper bound (north)
+    north = d.destination(point=center, bearing=0)
+    # get right bound (east)
+    east = d.destination(point=center, bearing=90)
+    # get lower bound (south)
+    south = d.destination(point=center, bearing=180)
+    # get left bound (west)
+    west = d.destination(point=center, bearing=270)
+
+    return south.latitude, north.latitude, west.longitude, east.longitude
+
+
 class PlaneLogger:
     """
-    PlaneLogger queries states from open  and writes states into MongoDB
+    PlaneLogger queries states from open  and writes states into the state store
+    Fetching and storing are decoupled, obtained states are handed over to a StateWriter which writes them into the
+    state store in the background
+    Multiple regions are fetched concurrently, regions larger than max_tile_size are split into tiles so busy areas are
+    not truncated by the flight limit of a single response. Planes in overlapping regions are stored once
     """
     # parameterized constructor
-    def __init__(self, environment: Environment):
+    def __init__(self,
+                 environment: Environment,
+                 state_writer: StateWriter = None,
+                 spool_filename: str = None,
+                 feed: FlightFeed = None,
+                 max_tile_size: float = None,
+                 fetch_threads: int = 4,
+                 policy: IngestPolicy = None,
+                 keyframe_interval: int = 30,
+                 profile_store: ProfileStore = None,
+                 profile_rate: float = 0.0):
+        """
+        Constructor
+        @param environment: the environment
+        @param state_writer: storage stage, None creates a default one
+        @param spool_filename: write-ahead spool of the default storage stage, None disables spooling
+        @param feed: the flight feed, None uses flightradar24
+        @param max_tile_size: regions are split into tiles no larger than this amount of meters, None disables tiling
+        @param fetch_threads: maximum amount of tiles fetched concurrently
+        @param policy: decides which states are stored and the poll interval, None stores every state
+        @param keyframe_interval: every keyframe_interval-th snapshot of the default storage stage is stored in full,
+        the others as delta, when the state store encodes deltas
+        @param profile_store: stores profiles of sampled runs, None disables profiling
+        @param profile_rate: fraction of runs that is profiled, between 0 and 1
+        """
         # Set environment
         self.environment = environment
 
         # Set timezone
         self.timezone = pytz.timezone(self.environment.timezone.timezone)
 
-        # Create MongoDB client
-        self.mongo_client = MongoClient(environment.mongodb_config.host,
-                                        environment.mongodb_config.port)
+        # Create storage stage
+        if state_writer is None:
+            state_writer = StateWriter(get_state_store(self.environment, keyframe_interval=keyframe_interval),
+                                       spool=StateSpool(spool_filename) if spool_filename is not None else None)
+        self.state_writer = state_writer
+
+        # Create flight feed, defaults to flightradar24
+        self.feed = feed if feed is not None else FlightRadar24Feed(environment)
+        self.max_tile_size = max_tile_size
+        self.executor = ThreadPoolExecutor(max_workers=fetch_threads, thread_name_prefix='PlaneLoggerFetch')
+
+        # Ingest policy, thins high altitude states and adapts the poll interval
+        self.policy = policy
+
+        # Start of the previous tick, for the ingest cadence
+        self.last_tick = None
 
-        # Create with flightradar24api
-        flightradar24_user: str = environment.flightradar24_creds.username
-        flightradar24_pass: str = environment.flightradar24_creds.password
-        if flightradar24_user != "" and flightradar24_pass != "":
-            self.fr_api = FlightRadar24API(user=flightradar24_user, password=flightradar24_pass)
-        else:
-            self.fr_api = FlightRadar24API()
+        # Profiling of a sample of the runs
+        self.profile_store = profile_store
+        self.profile_rate = profile_rate
 
     def prepare_log(self, message: str):
         return self.__class__.__name__ + ': ' + message
 
-    def log(self, center: tuple, radius: int, plot_options: PlotOptions = None, ignore_grounded: bool = True):
+    def get_tiles(self, regions: list):
         """
-        Queries states from open sky given the specified geographic bounding box and logs states into MongoDB.
-        Creates state plot if required
-        @param center in lat lon
-        @param radius in meters
-        @param plot_options: plot options
-        @:param ignore_grounded: ignore grounded planes
+        Returns the tiles to fetch for given regions
+        @param regions: list of (center, radius) tuples, center in lat lon and radius in meters
+        @return: list of tiles (lat_min, lat_max, lon_min, lon_max)
         """
+        tiles = []
+        for center, radius in regions:
+            bbox = get_bbox_around_center(center, radius)
+            if self.max_tile_size is not None:
+                tiles.extend(split_bbox(bbox, self.max_tile_size))
+            else:
+                tiles.append(bbox)
+        return tiles
 
+    def _fetch_tile(self, tile: tuple):
         try:
-            # Obtain current states
-            logging.info(self.prepare_log('Obtaining states from flightradar24'))
-            bounds = self.fr_api.get_bounds_by_point(latitude=center[0], longitude=center[1], radius=radius)
-            flights = self.fr_api.get_flights(bounds=bounds)
-
-            if flights is None:
-                logging.error(self.prepare_log('Failed to obtain states from flightradar24'))
-                return
-
-            # Create states list with interesting data and store list in mongo db with timestamp as key value
-            timestamp = datetime.datetime.now(self.timezone)
-            logging.info(self.prepare_log('Timestamp of obtained flights : %s' % timestamp.__str__()))
-            key = convert_datetime_to_int(timestamp)
-
-            db_states = self.mongo_client[self.environment.mongodb_config.database][
-                self.environment.mongodb_config.collection]
-            states = []
-            for flight in flights:
+            return self.feed.get_flights(tile)
+        except Exception as ex:
+            logging.exception(ex)
+            return None
+
+    def fetch(self, regions: list, ignore_grounded: bool = True):
+        """
+        Fetch stage, concurrently queries states of all tiles of given regions and merges them into one snapshot
+        A plane seen in multiple tiles is stored once
+        @param regions: list of (center, radius) tuples, center in lat lon and radius in meters
+        @param ignore_grounded: ignore grounded planes
+        @return: Time key and list of states, states is None when no tile could be fetched
+        """
+        tiles = self.get_tiles(regions)
+        logging.info(self.prepare_log('Obtaining states of %i tiles' % len(tiles)))
+        results = list(self.executor.map(self._fetch_tile, tiles))
+
+        # Create states list with interesting data, timestamp is used as key value
+        timestamp = datetime.datetime.now(self.timezone)
+        key = convert_datetime_to_int(timestamp)
+        failed = sum(1 for flights in results if flights is None)
+        if failed == len(tiles):
+            logging.error(self.prepare_log('Failed to obtain states'))
+            return key, None
+        if failed > 0:
+            logging.error(self.prepare_log('Failed to obtain states of %i out of %i tiles' % (failed, len(tiles))))
+        logging.info(self.prepare_log('Timestamp of obtained flights : %s' % timestamp.__str__()))
+
+        states = []
+        seen = set()
+        for flights in results:
+            for flight in flights or []:
+                if flight.id in seen:
+                    continue
+                seen.add(flight.id)
+
                 ignore_flight : bool = False
                 if ignore_grounded and flight.altitude <= 0:
                     ignore_flight = True
@@ -91,28 +181,100 @@ class PlaneLogger:
                         "icao24": flight.airline_icao
                     }
                     states.append(state_object)
-            logging.info(self.prepare_log('Storing %i flights in database' % len(states)))
-            result = db_states.update_one({'Time': key}, {"$set": {'States': states}}, upsert=True)
+        return key, states
+
+    def get_stats(self):
+        """
+        Returns queue depth, write latency and lag statistics of the storage stage and statistics of the ingest policy
+        """
+        stats = self.state_writer.get_stats()
+        if self.policy is not None:
+            stats.update(self.policy.get_stats())
+        return stats
+
+    def publish_stats(self):
+        """
+        Publishes the statistics to all processes as ingest, see Metrics.publish, published after every tick
+        """
+        try:
+            stats = self.get_stats()
+            stats['published'] = datetime.datetime.now(pytz.utc).isoformat()
+            get_metrics().publish('ingest', stats)
+        except Exception as ex:
+            logging.exception(ex)
+
+    def get_interval(self, default: float):
+        """
+        Returns the seconds to wait until the next poll as decided by the ingest policy
+        @param default: interval returned when there is no ingest policy
+        """
+        if self.policy is None:
+            return default
+        return self.policy.interval
+
+    def close(self, timeout: float = 30.0):
+        """
+        Writes all pending states and stops the storage stage
+        @param timeout: seconds to wait for pending states to be written
+        """
+        self.executor.shutdown(wait=True)
+        self.state_writer.close(timeout)
+
+    def log(self,
+            center: tuple = None,
+            radius: int = None,
+            plot_options: PlotOptions = None,
+            ignore_grounded: bool = True,
+            regions: list = None):
+        """
+        Queries states from open sky given the specified geographic bounding box and logs states into MongoDB.
+        Creates state plot if required
+        Tick duration, cadence and aircraft count are recorded in the metrics of this process, which are flushed at the
+        end of every tick
+        @param center in lat lon
+        @param radius in meters
+        @param plot_options: plot options
+        @:param ignore_grounded: ignore grounded planes
+        @param regions: list of (center, radius) tuples, used instead of center and radius
+        @return: all obtained states, the states to store are written into the database in the background,
+        None on failure
+        """
+        if self.profile_store is not None and random.random() < self.profile_rate:
+            with self.profile_store.profile('PlaneLogger.log', info={'regions': regions or [(center, radius)]}):
+                return self._log(center, radius, plot_options, ignore_grounded, regions)
+        return self._log(center, radius, plot_options, ignore_grounded, regions)
+
+    def _log(self, center: tuple, radius: int, plot_options: PlotOptions, ignore_grounded: bool, regions: list):
+        tick_begin = time.perf_counter()
+        if self.last_tick is not None:
+            get_metrics().observe('omd_ingest_tick_interval_seconds', tick_begin - self.last_tick)
+        self.last_tick = tick_begin
+        try:
+            # Obtain current states
+            if regions is None:
+                regions = [(center, radius)]
+            key, states = self.fetch(regions=regions, ignore_grounded=ignore_grounded)
+            if self.policy is not None:
+                self.policy.next_interval(states)
+            if states is None:
+                return None
+            get_metrics().observe('omd_ingest_aircraft', len(states), buckets=COUNT_BUCKETS)
+
+            # Thin high altitude states and hand states over to the storage stage
+            stored_states = states
+            if self.policy is not None:
+                stored_states = self.policy.filter(states)
+            logging.info(self.prepare_log('Storing %i out of %i flights in database' % (len(stored_states), len(states))))
+            self.state_writer.submit(key, stored_states)
 
             # Plot if necessary
             if plot_options is not None and plot_options.plot:
-                # Compute bbox from center and radius
-                center = geopy.Point(center[0], center[1])
-                d = geopy.distance.geodesic(meters=radius)
-
-                # get upper bound (north)
-                north = d.destination(point=center, bearing=0)
-                # get right bound (east)
-                east = d.destination(point=center, bearing=90)
-                # get lower bound (south)
-                south = d.destination(point=center, bearing=180)
-                # get left bound (west)
-                west = d.destination(point=center, bearing=270)
-
-                # Create plot
+                # Create plot, the plotting stack is only loaded when plotting
+                from ovm.plotter import plot_states
                 logging.info(self.prepare_log('Creating plot'))
                 img = plot_states(states,
-                                  bbox=(south.latitude, north.latitude, west.longitude, east.longitude),
+                                  bbox=get_union_bbox([get_bbox_around_center(region[0], region[1])
+                                                       for region in regions]),
                                   tile_zoom=plot_options.tilezoom)
 
                 # Write image to disk
@@ -120,5 +282,11 @@ class PlaneLogger:
                     fh.write(img)
                     fh.close()
 
+            return states
         except Exception as ex:
             logging.exception(ex)
+            return None
+        finally:
+            get_metrics().observe('omd_ingest_tick_seconds', time.perf_counter() - tick_begin)
+            self.publish_stats()
+            get_metrics().flush()
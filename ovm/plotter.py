@@ -110,7 +110,7 @@ def plot_trajectories(origin: tuple,
         plt.savefig(buffer, format='jpg', bbox_inches="tight", pad_inches=-0.1)
         buffer.seek(0)
         img = buffer.getvalue()
-    plt.close()
+    plt.close(f)
 
     return img
 
@@ -0,0 +1,189 @@
+import cProfile
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+
+"""
+Files of a stored profile, pstats can be loaded using pstats.Stats, collapsed holds stacks in the folded format of
+flamegraph.pl and speedscope
+"""
+PROFILE_KINDS = ('pstats', 'collapsed')
+
+
+class StackSampler:
+    """
+    Samples the stacks of all threads of the process every interval seconds in a background thread
+    Counts identical stacks, which gives the collapsed stacks flame graphs are drawn from
+    """
+    def __init__(self, interval: float = 0.005):
+        """
+        Constructor
+        @param interval: seconds between samples
+        """
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='StackSampler', daemon=True)
+
+    @staticmethod
+    def _get_frame_label(frame):
+        code = frame.f_code
+        return '%s (%s:%i)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+    def _run(self):
+        names = {}
+        while not self.stop_event.wait(self.interval):
+            self.samples += 1
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.thread.ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self._get_frame_label(frame))
+                    frame = frame.f_back
+                if thread_id not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def get_collapsed(self):
+        """
+        Returns the sampled stacks in the folded format, one 'root;..;leaf count' line per stack
+        """
+        return ''.join('%s %i\n' % (stack, count) for stack, count in self.stacks.most_common())
+
+
+class ProfileStore:
+    """
+    The ProfileStore runs code under cProfile and a StackSampler and keeps the profiles in a directory, by profile id
+    <directory>/<profile id>.json holds name, duration and info, .pstats the cProfile statistics of the profiled thread
+    and .collapsed the sampled stacks of all threads. Only the latest max_profiles profiles are kept
+    Profiling slows the profiled code down, it is meant for single requests and a fraction of ingest runs
+    """
+    def __init__(self, directory: str, max_profiles: int = 100, sample_interval: float = 0.005):
+        """
+        Constructor
+        @param directory: directory of the profiles
+        @param max_profiles: maximum amount of kept profiles, the oldest are removed
+        @param sample_interval: seconds between stack samples
+        """
+        self.directory = directory
+        self.max_profiles = max_profiles
+        self.sample_interval = sample_interval
+        self.pattern = re.compile('^[0-9a-f]{32}$')
+        os.makedirs(self.directory, exist_ok=True)
+
+    def prepare_log(self, message: str):
+        return self.__class__.__name__ + ': ' + message
+
+    @staticmethod
+    def create_id():
+        """
+        Returns a new profile id
+        """
+        return uuid.uuid4().hex
+
+    def get_filename(self, profile_id: str, kind: str):
+        """
+        Returns the file of a profile, raises exception on an invalid id or kind
+        @param profile_id: the profile id
+        @param kind: json or one of PROFILE_KINDS
+        """
+        if self.pattern.match(profile_id) is None:
+            raise Exception('Invalid profile id %s' % profile_id)
+        if kind != 'json' and kind not in PROFILE_KINDS:
+            raise Exception('Unknown profile kind %s, expected one of %s' % (kind, ', '.join(PROFILE_KINDS)))
+        return os.path.join(self.directory, '%s.%s' % (profile_id, kind))
+
+    @contextmanager
+    def profile(self, name: str, profile_id: str = None, info: dict = None):
+        """
+        Context manager profiling the code within and storing the profile when it ends, also when it raises
+        @param name: name of the profiled operation, for example the api call
+        @param profile_id: id to store the profile under, None creates one
+        @param info: JSON serializable information stored with the profile, such as request parameters
+        @return: yields the profile id
+        """
+        profile_id = profile_id if profile_id is not None else self.create_id()
+        sampler = StackSampler(self.sample_interval)
+        profiler = cProfile.Profile()
+        begin = time.time()
+        sampler.start()
+        profiler.enable()
+        try:
+            yield profile_id
+        finally:
+            profiler.disable()
+            sampler.stop()
+            try:
+                self._save(profile_id, profiler, sampler, {'id': profile_id,
+                                                           'name': name,
+                                                           'created': begin,
+                                                           'duration': time.time() - begin,
+                                                           'samples': sampler.samples,
+                                                           'info': info or {}})
+            except Exception as ex:
+                logging.exception(ex)
+
+    def _save(self, profile_id: str, profiler: cProfile.Profile, sampler: StackSampler, meta: dict):
+        """
+        Writes the files of a profile, the json file is written last and marks the profile complete
+        """
+        profiler.dump_stats(self.get_filename(profile_id, 'pstats'))
+        with open(self.get_filename(profile_id, 'collapsed'), 'w') as fh:
+            fh.write(sampler.get_collapsed())
+        temp_filename = self.get_filename(profile_id, 'json') + '.tmp'
+        with open(temp_filename, 'w') as fh:
+            json.dump(meta, fh)
+        os.replace(temp_filename, self.get_filename(profile_id, 'json'))
+        logging.info(self.prepare_log('Stored profile %s of %s, %f seconds' % (profile_id, meta['name'],
+                                                                               meta['duration'])))
+        self.prune()
+
+    def list_profiles(self):
+        """
+        Returns the information of all complete profiles, latest first
+        """
+        profiles = []
+        for filename in os.listdir(self.directory):
+            profile_id, extension = os.path.splitext(filename)
+            if extension != '.json' or self.pattern.match(profile_id) is None:
+                continue
+            try:
+                with open(os.path.join(self.directory, filename), 'r') as fh:
+                    profiles.append(json.load(fh))
+            except (FileNotFoundError, ValueError):
+                continue
+        return sorted(profiles, key=lambda profile: profile['created'], reverse=True)
+
+    def remove(self, profile_id: str):
+        """
+        Removes the files of a profile
+        """
+        for kind in ('json',) + PROFILE_KINDS:
+            try:
+                os.remove(self.get_filename(profile_id, kind))
+            except FileNotFoundError:
+                pass
+
+    def prune(self):
+        """
+        Removes the oldest profiles beyond max_profiles
+        """
+        for profile in self.list_profiles()[self.max_profiles:]:
+            self.remove(profile['id'])
@@ -0,0 +1,177 @@
+import queue
+import threading
+from ovm.statereader import StateReader
+
+
+class ScanSubscription:
+    """
+    A query taking part in a SharedScan, scanned like a StateReader but fed by the shared scan
+    Every subscription is scanned at most once, from its own thread
+    """
+    def __init__(self, shared_scan, max_pending: int):
+        """
+        Constructor
+        @param shared_scan: the SharedScan feeding this subscription
+        @param max_pending: maximum amount of snapshots waiting to be consumed
+        """
+        self.shared_scan = shared_scan
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.begin = None
+        self.end = None
+        self.bbox = None
+        self.max_altitude = None
+        self.subscribed = False
+        self.closed = False
+
+    def scan(self, begin: int, end: int = None, limit: int = 0, bbox: tuple = None, max_altitude: float = None):
+        """
+        Generator yielding snapshots between begin and end in order of Time, same as StateReader.scan
+        States outside bbox or not below max_altitude are not yielded, every snapshot in the window is
+        Raises exception when the shared scan fails
+        """
+        if self.subscribed:
+            raise Exception('A subscription can only be scanned once')
+        self.begin = begin
+        self.end = end
+        self.bbox = bbox
+        self.max_altitude = max_altitude
+        self.subscribed = True
+        self.shared_scan.notify()
+        return self._consume(limit)
+
+    def _consume(self, limit: int):
+        count = 0
+        try:
+            while True:
+                snapshot = self.queue.get()
+                if snapshot is None:
+                    return
+                if isinstance(snapshot, Exception):
+                    raise Exception(snapshot.__str__())
+                yield snapshot
+                count += 1
+                if count == limit:
+                    return
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Ends the subscription, the shared scan stops feeding it
+        """
+        if not self.closed:
+            self.closed = True
+            self.shared_scan.notify()
+
+    def matches(self, timestamp_int: int):
+        """
+        Returns True if a snapshot is within the window of this subscription
+        """
+        return timestamp_int >= self.begin and (self.end is None or timestamp_int <= self.end)
+
+    def filter(self, states: list):
+        """
+        Returns the states within the bbox and below the altitude of this subscription, states without position are
+        outside any bbox
+        """
+        if self.bbox is None and self.max_altitude is None:
+            return states
+        lat_min, lat_max, lon_min, lon_max = self.bbox if self.bbox is not None else (None, None, None, None)
+        return [state for state in states
+                if (self.bbox is None or (state['latitude'] is not None and state['longitude'] is not None and
+                                          lat_min <= state['latitude'] <= lat_max and
+                                          lon_min <= state['longitude'] <= lon_max)) and
+                (self.max_altitude is None or (state['geo_altitude'] is not None and
+                                               state['geo_altitude'] < self.max_altitude))]
+
+    def put(self, item):
+        """
+        Hands a snapshot, an exception or None marking the end to the consumer, blocks while the consumer is behind
+        Items are dropped once the subscription is closed
+        """
+        while not self.closed:
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+
+class SharedScan:
+    """
+    A SharedScan scans the state store once for multiple queries, each query runs in its own thread and consumes a
+    ScanSubscription instead of a StateReader
+    The scan covers the union of the time windows, bounding boxes and altitudes of all subscriptions. Every snapshot is
+    filtered per subscription and handed over through a bounded queue, a slow query holds back the scan
+    """
+    def __init__(self, reader: StateReader, max_pending: int = 64):
+        """
+        Constructor
+        @param reader: the reader of the state store
+        @param max_pending: maximum amount of snapshots waiting per subscription
+        """
+        self.reader = reader
+        self.max_pending = max_pending
+        self.subscriptions = []
+        self.condition = threading.Condition()
+
+    def subscribe(self):
+        """
+        Returns a new subscription, all subscriptions must be created before run is called
+        """
+        subscription = ScanSubscription(self, self.max_pending)
+        self.subscriptions.append(subscription)
+        return subscription
+
+    def notify(self):
+        """
+        Called by a subscription when it is scanned or closed
+        """
+        with self.condition:
+            self.condition.notify_all()
+
+    def _is_ready(self):
+        return all(subscription.subscribed or subscription.closed for subscription in self.subscriptions)
+
+    def run(self):
+        """
+        Waits until every subscription is scanned or closed, then scans the union of their windows and feeds them
+        A failing scan is passed on to every subscription
+        @return: amount of scanned snapshots
+        """
+        with self.condition:
+            self.condition.wait_for(self._is_ready)
+        active = [subscription for subscription in self.subscriptions
+                  if subscription.subscribed and not subscription.closed]
+        if len(active) == 0:
+            return 0
+
+        # Union of the windows, bounding boxes and altitudes
+        begin = min(subscription.begin for subscription in active)
+        end = None if any(subscription.end is None for subscription in active) else \
+            max(subscription.end for subscription in active)
+        bbox = None
+        if all(subscription.bbox is not None for subscription in active):
+            bbox = (min(subscription.bbox[0] for subscription in active),
+                    max(subscription.bbox[1] for subscription in active),
+                    min(subscription.bbox[2] for subscription in active),
+                    max(subscription.bbox[3] for subscription in active))
+        max_altitude = None if any(subscription.max_altitude is None for subscription in active) else \
+            max(subscription.max_altitude for subscription in active)
+
+        count = 0
+        try:
+            for timestamp_int, states in self.reader.scan(begin, end, bbox=bbox, max_altitude=max_altitude):
+                count += 1
+                for subscription in active:
+                    if not subscription.closed and subscription.matches(timestamp_int):
+                        subscription.put((timestamp_int, subscription.filter(states)))
+                if all(subscription.closed for subscription in active):
+                    break
+        except Exception as ex:
+            for subscription in active:
+                subscription.put(ex)
+        finally:
+            for subscription in active:
+                subscription.put(None)
+        return count
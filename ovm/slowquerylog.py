@@ -0,0 +1,297 @@
+import json
+import logging
+import time
+from datetime import datetime, timezone
+from pymongo.database import Database
+from pymongo.errors import CollectionInvalid
+from ovm.environment import Environment, SlowQueryLogConfiguration
+from ovm.metrics import get_stages
+from ovm.mongoconnection import get_mongo_client
+from ovm.statestore import StateStore
+
+
+def get_plan_summary(explain: dict):
+    """
+    Returns the stages of the winning plan and the execution statistics of an explain result
+    @param explain: result of the explain command
+    @return: dictionary holding plan (stages from the top, for example 'FETCH > IXSCAN'), index, documents_examined,
+    keys_examined, documents_returned and explain_millis, the statistics are None without verbosity executionStats
+    """
+    plan = explain.get('queryPlanner', {}).get('winningPlan', {})
+    # Servers using the slot based engine wrap the plan in queryPlan
+    plan = plan.get('queryPlan', plan)
+    stages = []
+    index = None
+    while plan:
+        stages.append(plan.get('stage', '?'))
+        index = plan.get('indexName', index)
+        plan = plan.get('inputStage') or next(iter(plan.get('inputStages', [])), None)
+    statistics = explain.get('executionStats', {})
+    return {'plan': ' > '.join(stages),
+            'index': index,
+            'documents_examined': statistics.get('totalDocsExamined'),
+            'keys_examined': statistics.get('totalKeysExamined'),
+            'documents_returned': statistics.get('nReturned'),
+            'explain_millis': statistics.get('executionTimeMillis')}
+
+
+def get_plans_summary(explains: list):
+    """
+    Returns the summary of the explain results of all range queries of a scan, see get_plan_summary
+    Distinct plans and indexes are joined by ' | ' in order of the queries, execution statistics are summed
+    @param explains: list of explain results, one per range query
+    @return: dictionary holding plan, index, partitions and the summed statistics
+    """
+    summaries = [get_plan_summary(explain) for explain in explains]
+    summary = {'plan': ' | '.join(dict.fromkeys(summary['plan'] for summary in summaries)),
+               'index': ' | '.join(dict.fromkeys(str(summary['index']) for summary in summaries)),
+               'partitions': len(summaries)}
+    for name in ('documents_examined', 'keys_examined', 'documents_returned', 'explain_millis'):
+        values = [summary[name] for summary in summaries if summary[name] is not None]
+        summary[name] = sum(values) if len(values) > 0 else None
+    return summary
+
+
+class SlowQuery:
+    """
+    Counts what a single scan of FlightInfoFinder did, snapshots and states read and candidate hits, and takes its
+    duration, the seconds it spent per stage and the documents the state store fetched meanwhile
+    Like the stages, fetched documents are counted for the whole process, including reads of trajectories
+    """
+    def __init__(self, operation: str, parameters: dict, documents_fetched=None):
+        """
+        Constructor
+        @param operation: name of the scanning method, for example find_flights
+        @param parameters: JSON serializable parameters of the scan
+        @param documents_fetched: function returning the documents fetched by the state store so far, see
+        StateStore.get_documents_fetched
+        """
+        self.operation = operation
+        self.parameters = parameters
+        self.snapshots = 0
+        self.states = 0
+        self.hits = 0
+        self.begin = time.perf_counter()
+        self.stages = get_stages().get()
+        self.documents_fetched = documents_fetched
+        self.documents = documents_fetched() if documents_fetched is not None else None
+
+    def get_seconds(self):
+        """
+        Returns the seconds since the scan began
+        """
+        return time.perf_counter() - self.begin
+
+    def get_stage_seconds(self):
+        """
+        Returns the seconds per stage spent since the scan began
+        """
+        return {stage: seconds - self.stages.get(stage, 0.0) for stage, seconds in get_stages().get().items()
+                if seconds - self.stages.get(stage, 0.0) > 0.0}
+
+    def get_documents(self):
+        """
+        Returns the documents fetched by the state store since the scan began, None if the store doesn't count them
+        """
+        if self.documents is None:
+            return None
+        return self.documents_fetched() - self.documents
+
+
+class SlowQueryLog:
+    """
+    The SlowQueryLog records scans taking at least threshold_seconds in a capped collection, so it never grows beyond
+    size_bytes and max_documents and the oldest records are overwritten
+    A record holds the parameters, documents fetched, snapshots and states read, candidate hits and seconds per stage
+    of a scan, and the plans of its range queries as reported by the state store. The queries are only planned, not run
+    again, explain_scan runs them on demand to get their execution statistics
+    Recording never raises, a failing slow query log must not fail the scan
+    """
+    def __init__(self,
+                 database: Database,
+                 collection: str,
+                 threshold_seconds: float = 5.0,
+                 size_bytes: int = 16777216,
+                 max_documents: int = 10000,
+                 explain: bool = True):
+        """
+        Constructor
+        @param database: the database
+        @param collection: name of the capped collection
+        @param threshold_seconds: scans taking at least this amount of seconds are recorded
+        @param size_bytes: maximum size of the capped collection
+        @param max_documents: maximum amount of records
+        @param explain: record the plans of the range queries
+        """
+        self.database = database
+        self.name = collection
+        self.threshold_seconds = threshold_seconds
+        self.size_bytes = size_bytes
+        self.max_documents = max_documents
+        self.explain = explain
+        self.created = False
+
+    def prepare_log(self, message: str):
+        return self.__class__.__name__ + ': ' + message
+
+    def get_collection(self):
+        """
+        Returns the capped collection, creates it on first use
+        """
+        if not self.created:
+            try:
+                self.database.create_collection(self.name, capped=True, size=self.size_bytes, max=self.max_documents)
+            except CollectionInvalid:
+                # Created before, by this or another process
+                pass
+            self.created = True
+        return self.database[self.name]
+
+    def record(self, query: SlowQuery, store: StateStore = None, scan: dict = None, error: Exception = None):
+        """
+        Records a scan if it took at least threshold_seconds
+        @param query: the scan
+        @param store: the state store scanned, explains the range queries of the scan
+        @param scan: arguments of StateStore.explain describing the scan, begin, end, bbox and max_altitude
+        @param error: the exception the scan failed with, None if it succeeded
+        @return: True if the scan was recorded
+        """
+        seconds = query.get_seconds()
+        if seconds < self.threshold_seconds:
+            return False
+
+        try:
+            record = {'time': datetime.now(timezone.utc),
+                      'operation': query.operation,
+                      'parameters': query.parameters,
+                      'seconds': seconds,
+                      'documents_fetched': query.get_documents(),
+                      'snapshots': query.snapshots,
+                      'states': query.states,
+                      'hits': query.hits,
+                      'stages': query.get_stage_seconds()}
+            if error is not None:
+                record['error'] = '%s: %s' % (error.__class__.__name__, error)
+            if scan is not None:
+                record['scan'] = scan
+            if self.explain and store is not None and scan is not None:
+                try:
+                    explains = store.explain(**scan)
+                    if explains is not None and len(explains) > 0:
+                        record.update(get_plans_summary(explains))
+                        # The distinct plans hold operators such as $gte, stored as JSON to keep them out of field names
+                        plans = []
+                        for explain in explains:
+                            plan = explain.get('queryPlanner', {}).get('winningPlan', {})
+                            if plan not in plans:
+                                plans.append(plan)
+                        record['winning_plan'] = json.dumps(plans, default=str)
+                except Exception as ex:
+                    record['explain_error'] = str(ex)
+            self.get_collection().insert_one(record)
+            logging.warning(self.prepare_log('%s took %f seconds, %s documents fetched, %i snapshots, %i states, '
+                                             '%i hits, plan %s%s' %
+                                             (query.operation, seconds, record['documents_fetched'], query.snapshots,
+                                              query.states, query.hits, record.get('plan'),
+                                              ', failed with %s' % record['error'] if error is not None else '')))
+            return True
+        except Exception as ex:
+            logging.exception(ex)
+            return False
+
+    def get_records(self, since: datetime = None, operation: str = None):
+        """
+        Returns the records, latest first
+        @param since: only records since this UTC time, None for all records
+        @param operation: only records of this operation, None for all operations
+        @return: list of records
+        """
+        query_filter = {}
+        if since is not None:
+            query_filter['time'] = {'$gte': since}
+        if operation is not None:
+            query_filter['operation'] = operation
+        return list(self.get_collection().find(query_filter, projection={'_id': False}).sort([('$natural', -1)]))
+
+    def get_report(self, since: datetime = None, operation: str = None, limit: int = 10):
+        """
+        Aggregates the records by operation and plan, worst offenders first
+        The offenders are ordered by their total seconds, so frequent slow scans rank above a single very slow one
+        @param since: only records since this UTC time, None for all records
+        @param operation: only records of this operation, None for all operations
+        @param limit: maximum amount of offenders
+        @return: list of dictionaries holding the operation, plan, index, count, failed scans, total, average and
+        maximum seconds, summed documents fetched, snapshots, states and hits, summed seconds per stage and the
+        parameters and scan of the slowest record
+        """
+        offenders = {}
+        for record in self.get_records(since=since, operation=operation):
+            key = (record['operation'], record.get('plan'), record.get('index'))
+            offender = offenders.get(key)
+            if offender is None:
+                offender = {'operation': record['operation'],
+                            'plan': record.get('plan'),
+                            'index': record.get('index'),
+                            'count': 0,
+                            'errors': 0,
+                            'seconds_total': 0.0,
+                            'seconds_max': 0.0,
+                            'documents_fetched': 0,
+                            'snapshots': 0,
+                            'states': 0,
+                            'hits': 0,
+                            'stages': {},
+                            'slowest': None,
+                            'slowest_scan': None}
+                offenders[key] = offender
+            offender['count'] += 1
+            if record.get('error') is not None:
+                offender['errors'] += 1
+            offender['seconds_total'] += record['seconds']
+            for name in ('documents_fetched', 'snapshots', 'states', 'hits'):
+                offender[name] += record.get(name) or 0
+            for stage, seconds in record.get('stages', {}).items():
+                offender['stages'][stage] = offender['stages'].get(stage, 0.0) + seconds
+            if record['seconds'] >= offender['seconds_max']:
+                offender['seconds_max'] = record['seconds']
+                offender['slowest'] = record['parameters']
+                offender['slowest_scan'] = record.get('scan')
+
+        report = sorted(offenders.values(), key=lambda offender: offender['seconds_total'], reverse=True)[:limit]
+        for offender in report:
+            offender['seconds_average'] = offender['seconds_total'] / offender['count']
+        return report
+
+    @staticmethod
+    def explain_scan(store: StateStore, scan: dict):
+        """
+        Runs the range queries of a recorded scan once more and returns their plans and summed execution statistics,
+        see get_plans_summary
+        @param store: the state store
+        @param scan: the scan of a record
+        @return: the summary, None if the store can't explain its scans
+        """
+        explains = store.explain(**scan, execution_stats=True)
+        if explains is None or len(explains) == 0:
+            return None
+        return get_plans_summary(explains)
+
+
+def get_slow_query_log(environment: Environment):
+    """
+    Returns the slow query log of given environment, None if the slow query log is not configured
+    """
+    config: SlowQueryLogConfiguration = environment.slow_query_log
+    if config is None:
+        return None
+    if environment.mongodb_config is None:
+        raise Exception('The slow query log requires mongodb_config')
+    mongodb_config = environment.mongodb_config
+    return SlowQueryLog(get_mongo_client(mongodb_config)[mongodb_config.database],
+                        config.collection if config.collection is not None
+                        else mongodb_config.collection + '_slow_queries',
+                        threshold_seconds=config.threshold_seconds,
+                        size_bytes=config.size_bytes,
+                        max_documents=config.max_documents,
+                        explain=config.explain)
+
@@ -0,0 +1,155 @@
+import bson
+from ovm.metrics import SIZE_BUCKETS, get_metrics
+
+"""
+Documents of the states collection are stored either as keyframe or as delta
+keyframe: {'Time': int, 'States': [state, ..]}, holds all states like documents written before delta encoding
+delta: {'Time': int, 'Delta': {'Upserts': [state, ..], 'Removed': [callsign, ..], 'Unkeyed': [state, ..], 'Base': int}}
+A delta holds the states of planes that are new or changed since the previous document and the callsigns of planes
+that are gone. States without callsign, or with a callsign occurring more than once in a snapshot, can't be tracked
+and are stored in full in Unkeyed of every delta. Base is the Time of the document the delta was encoded against,
+a delta whose Base is not the previous document, for example because a second writer stored a snapshot in between,
+is not decoded. Deltas written before Base was introduced have none and always follow the previous document
+"""
+KEYFRAME_FIELD = 'States'
+DELTA_FIELD = 'Delta'
+
+
+def _split_states(states: list):
+    """
+    Splits states into states with a unique callsign, keyed by callsign, and the other states
+    """
+    counts = {}
+    for state in states:
+        callsign = state.get('callsign')
+        if callsign:
+            counts[callsign] = counts.get(callsign, 0) + 1
+
+    keyed = {}
+    unkeyed = []
+    for state in states:
+        callsign = state.get('callsign')
+        if callsign and counts[callsign] == 1:
+            keyed[callsign] = state
+        else:
+            unkeyed.append(state)
+    return keyed, unkeyed
+
+
+class SnapshotEncoder:
+    """
+    Encodes consecutive snapshots into keyframes and deltas
+    Every keyframe_interval-th snapshot is a keyframe, a keyframe_interval of 1 disables delta encoding
+    Encoding assumes every encoded document gets stored, call reset when storing fails so the next snapshot is
+    encoded as keyframe again
+    """
+    def __init__(self, keyframe_interval: int = 30):
+        self.keyframe_interval = max(1, keyframe_interval)
+        self.previous = None
+        self.previous_key = None
+        self.since_keyframe = 0
+
+        # Statistics
+        self.keyframes = 0
+        self.deltas = 0
+        self.raw_bytes = 0
+        self.encoded_bytes = 0
+
+    def reset(self):
+        """
+        Forces the next snapshot to be encoded as keyframe
+        """
+        self.previous = None
+        self.previous_key = None
+
+    def encode(self, states: list, key: int = None):
+        """
+        Encodes a snapshot
+        @param states: all states of the snapshot
+        @param key: Time of the snapshot, stored as Base of the next delta
+        @return: field name (KEYFRAME_FIELD or DELTA_FIELD) and its value
+        """
+        keyed, unkeyed = _split_states(states)
+
+        if self.previous is None or self.since_keyframe + 1 >= self.keyframe_interval:
+            name, value = KEYFRAME_FIELD, states
+            self.since_keyframe = 0
+            self.keyframes += 1
+        else:
+            upserts = [state for callsign, state in keyed.items() if self.previous.get(callsign) != state]
+            removed = [callsign for callsign in self.previous.keys() if callsign not in keyed]
+            name, value = DELTA_FIELD, {'Upserts': upserts, 'Removed': removed, 'Unkeyed': unkeyed}
+            if self.previous_key is not None:
+                value['Base'] = self.previous_key
+            self.since_keyframe += 1
+            self.deltas += 1
+        self.previous = keyed
+        self.previous_key = key
+
+        encoded_bytes = len(bson.encode({name: value}))
+        self.raw_bytes += len(bson.encode({KEYFRAME_FIELD: states}))
+        self.encoded_bytes += encoded_bytes
+        get_metrics().observe('omd_snapshot_bytes', encoded_bytes,
+                              labels={'encoding': 'keyframe' if name == KEYFRAME_FIELD else 'delta'},
+                              buckets=SIZE_BUCKETS)
+        return name, value
+
+    def get_stats(self):
+        """
+        Returns keyframe and delta counts and the compression ratio, the size of full snapshots divided by the size of
+        the encoded snapshots
+        @return: dictionary holding the statistics
+        """
+        return {'keyframes': self.keyframes,
+                'deltas': self.deltas,
+                'raw_bytes': self.raw_bytes,
+                'encoded_bytes': self.encoded_bytes,
+                'compression_ratio': self.raw_bytes / self.encoded_bytes if self.encoded_bytes > 0 else 1.0}
+
+
+class SnapshotDecoder:
+    """
+    Reconstructs full snapshots from keyframes and deltas, documents must be decoded in order of Time
+    """
+    def __init__(self):
+        self.keyed = None
+        self.time = None
+
+    def decode(self, document: dict):
+        """
+        Decodes a document of the states collection
+        @param document: keyframe or delta document
+        @return: list of all states, None for a delta without preceding keyframe or not following its base
+        """
+        previous_time = self.time
+        self.time = document.get('Time')
+        if KEYFRAME_FIELD in document:
+            states = document[KEYFRAME_FIELD]
+            self.keyed, _ = _split_states(states)
+            return states
+
+        delta = document.get(DELTA_FIELD)
+        if delta is None or self.keyed is None:
+            return None
+
+        # The states of the previous document are not the states this delta was encoded against
+        if delta.get('Base', previous_time) != previous_time:
+            self.keyed = None
+            return None
+
+        for callsign in delta['Removed']:
+            self.keyed.pop(callsign, None)
+        for state in delta['Upserts']:
+            self.keyed[state['callsign']] = state
+        return list(self.keyed.values()) + delta['Unkeyed']
+
+
+def get_update(name: str, value):
+    """
+    Returns the update of a document holding an encoded snapshot, clears the field of the other encoding
+    @param name: KEYFRAME_FIELD or DELTA_FIELD
+    @param value: the encoded snapshot
+    @return: update document
+    """
+    other = DELTA_FIELD if name == KEYFRAME_FIELD else KEYFRAME_FIELD
+    return {'$set': {name: value}, '$unset': {other: ''}}
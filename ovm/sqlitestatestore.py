@@ -0,0 +1,211 @@
+import calendar
+import os
+import sqlite3
+import threading
+import time
+from ovm.statestore import STATE_COLUMNS, StateStore
+
+"""
+Tables of the SQLite state store
+snapshots: the Time of every snapshot, also of snapshots without states
+states: one row per state
+states_rtree: R*Tree over time, latitude, longitude and altitude of every state, rowid equals the rowid of the state
+R*Tree coordinates are 32-bit floats rounded outwards, time is stored as seconds since epoch and rows found through the
+R*Tree are filtered on their exact values
+"""
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS snapshots (time INTEGER PRIMARY KEY)',
+    'CREATE TABLE IF NOT EXISTS states (id INTEGER PRIMARY KEY, time INTEGER NOT NULL, callsign TEXT, icao24 TEXT, '
+    'latitude REAL, longitude REAL, geo_altitude REAL)',
+    'CREATE INDEX IF NOT EXISTS states_time ON states (time)',
+    'CREATE VIRTUAL TABLE IF NOT EXISTS states_rtree USING rtree (id, min_time, max_time, min_lat, max_lat, '
+    'min_lon, max_lon, min_alt, max_alt)'
+]
+
+# R*Tree altitude of states without altitude, below any altitude searched for
+NO_ALTITUDE = -100000.0
+
+
+def _get_epoch_seconds(timestamp_int: int):
+    """
+    Returns the seconds since epoch of a Time value, a monotonic mapping the R*Tree can hold
+    """
+    return calendar.timegm(time.strptime(str(timestamp_int), '%Y%m%d%H%M%S'))
+
+
+class SqliteStateStore(StateStore):
+    """
+    StateStore keeping snapshots in a single SQLite database file, for deployments without MongoDB
+    Every state is a row, searches within a radius and below an altitude are range lookups in an R*Tree over time,
+    latitude, longitude and altitude instead of scans over whole snapshots
+    The database runs in WAL mode, so scans from other processes don't block the writer. Snapshots are inserted in
+    batches using a single transaction per write
+    Only the properties in STATE_COLUMNS are stored
+    """
+    def __init__(self, filename: str, timeout: float = 30.0):
+        """
+        Constructor, creates the tables if they don't exist
+        @param filename: the database file
+        @param timeout: seconds to wait for a lock held by another connection
+        """
+        self.filename = filename
+        self.timeout = timeout
+        self.local = threading.local()
+        self.write_lock = threading.Lock()
+
+        # Statistics
+        self.written = 0
+        self.write_seconds_total = 0.0
+        self.documents_fetched = 0
+        self.documents_lock = threading.Lock()
+
+        connection = self._get_connection()
+        connection.execute('PRAGMA journal_mode=WAL')
+        with connection:
+            for statement in SCHEMA:
+                connection.execute(statement)
+
+    def _get_connection(self):
+        """
+        Returns the connection of the calling thread, a forked process opens its own
+        """
+        if getattr(self.local, 'pid', None) != os.getpid():
+            self.local.connection = sqlite3.connect(self.filename, timeout=self.timeout)
+            self.local.connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.pid = os.getpid()
+        return self.local.connection
+
+    def _delete(self, connection, condition: str, parameters: tuple):
+        connection.execute('DELETE FROM states_rtree WHERE id IN (SELECT id FROM states WHERE %s)' % condition,
+                           parameters)
+        connection.execute('DELETE FROM states WHERE %s' % condition, parameters)
+        connection.execute('DELETE FROM snapshots WHERE %s' % condition, parameters)
+
+    def write(self, snapshots: list):
+        begin = time.perf_counter()
+        with self.write_lock:
+            connection = self._get_connection()
+            with connection:
+                # Replace snapshots written before
+                keys = [(key,) for key, _ in snapshots]
+                connection.executemany('DELETE FROM states_rtree WHERE id IN (SELECT id FROM states WHERE time = ?)',
+                                       keys)
+                connection.executemany('DELETE FROM states WHERE time = ?', keys)
+                connection.executemany('INSERT OR REPLACE INTO snapshots (time) VALUES (?)', keys)
+
+                # Assign row ids up front so states and R*Tree entries are inserted in two batches
+                next_id = connection.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM states').fetchone()[0]
+                rows = []
+                boxes = []
+                for key, states in snapshots:
+                    seconds = _get_epoch_seconds(key)
+                    for state in states:
+                        latitude = state.get('latitude')
+                        longitude = state.get('longitude')
+                        altitude = state.get('geo_altitude')
+                        rows.append((next_id, key) + tuple(state.get(name) for name in STATE_COLUMNS))
+                        if latitude is not None and longitude is not None:
+                            altitude = altitude if altitude is not None else NO_ALTITUDE
+                            boxes.append((next_id, seconds, seconds, latitude, latitude, longitude, longitude,
+                                          altitude, altitude))
+                        next_id += 1
+                connection.executemany('INSERT INTO states (id, time, %s) VALUES (?, ?, ?, ?, ?, ?, ?)' %
+                                       ', '.join(STATE_COLUMNS), rows)
+                connection.executemany('INSERT INTO states_rtree VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', boxes)
+        self.written += len(snapshots)
+        self.write_seconds_total += time.perf_counter() - begin
+
+    def write_unordered(self, snapshots: list):
+        self.write(snapshots)
+
+    def _select_states(self, connection, begin: int, end: int, bbox: tuple, max_altitude: float):
+        """
+        Returns a cursor over Time and state columns of the states between begin and end, in order of Time
+        """
+        columns = ', '.join('states.%s' % name for name in STATE_COLUMNS)
+        if bbox is None and max_altitude is None:
+            return connection.execute('SELECT time, %s FROM states WHERE time >= ? AND time <= ? ORDER BY time, id' %
+                                      columns, (begin, end))
+
+        # Range lookup in the R*Tree, the exact values are checked on the states found
+        conditions = ['states.time >= ?', 'states.time <= ?']
+        parameters = [begin, end]
+        try:
+            conditions += ['states_rtree.max_time >= ?', 'states_rtree.min_time <= ?']
+            parameters += [_get_epoch_seconds(begin), _get_epoch_seconds(end)]
+        except ValueError:
+            # Not a valid date, for example a begin of 0, only the exact time range applies
+            conditions = conditions[0:2]
+            parameters = parameters[0:2]
+        if bbox is not None:
+            lat_min, lat_max, lon_min, lon_max = bbox
+            conditions += ['states_rtree.max_lat >= ?', 'states_rtree.min_lat <= ?',
+                           'states_rtree.max_lon >= ?', 'states_rtree.min_lon <= ?',
+                           'states.latitude BETWEEN ? AND ?', 'states.longitude BETWEEN ? AND ?']
+            parameters += [lat_min, lat_max, lon_min, lon_max, lat_min, lat_max, lon_min, lon_max]
+        if max_altitude is not None:
+            conditions += ['states_rtree.min_alt < ?', 'states.geo_altitude < ?']
+            parameters += [max_altitude, max_altitude]
+        return connection.execute('SELECT states.time, %s FROM states_rtree JOIN states ON states.id = states_rtree.id '
+                                  'WHERE %s ORDER BY states.time, states.id' % (columns, ' AND '.join(conditions)),
+                                  parameters)
+
+    def scan(self, begin: int, end: int = None, bbox: tuple = None, max_altitude: float = None):
+        connection = self._get_connection()
+        if end is None:
+            end = connection.execute('SELECT MAX(time) FROM snapshots').fetchone()[0]
+            if end is None:
+                return
+
+        # Merge the states into the snapshots, snapshots without matching states are yielded empty
+        # Fetched rows of snapshots and states are counted as documents
+        rows = self._select_states(connection, begin, end, bbox, max_altitude)
+        row = rows.fetchone()
+        documents = 1 if row is not None else 0
+        try:
+            for timestamp_int, in connection.execute('SELECT time FROM snapshots WHERE time >= ? AND time <= ? '
+                                                     'ORDER BY time', (begin, end)):
+                documents += 1
+                states = []
+                while row is not None and row[0] <= timestamp_int:
+                    if row[0] == timestamp_int:
+                        states.append(dict(zip(STATE_COLUMNS, row[1:])))
+                    row = rows.fetchone()
+                    documents += 1 if row is not None else 0
+                yield timestamp_int, states
+        finally:
+            with self.documents_lock:
+                self.documents_fetched += documents
+
+    def get_times_before(self, timestamp_int: int, limit: int):
+        cursor = self._get_connection().execute('SELECT time FROM snapshots WHERE time <= ? ORDER BY time DESC '
+                                                'LIMIT ?', (timestamp_int, limit))
+        return [row[0] for row in cursor]
+
+    def get_first_time(self):
+        return self._get_connection().execute('SELECT MIN(time) FROM snapshots').fetchone()[0]
+
+    def remove_older_than(self, timestamp_int: int):
+        with self.write_lock:
+            connection = self._get_connection()
+            with connection:
+                self._delete(connection, 'time < ?', (timestamp_int,))
+
+    def remove_newer_than(self, timestamp_int: int):
+        with self.write_lock:
+            connection = self._get_connection()
+            with connection:
+                self._delete(connection, 'time >= ?', (timestamp_int,))
+
+    def get_documents_fetched(self):
+        return self.documents_fetched
+
+    def get_stats(self):
+        return {'sqlite_written': self.written,
+                'sqlite_write_seconds_total': self.write_seconds_total}
+
+    def close(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None and self.local.pid == os.getpid():
+            connection.close()
+            self.local.pid = None
@@ -0,0 +1,264 @@
+import bisect
+import logging
+import os
+import re
+import threading
+import time
+from pymongo import UpdateOne
+from pymongo.database import Database
+from ovm.environment import MongoDBConfiguration
+from ovm.mongoconnection import get_mongo_client
+from ovm.snapshotcodec import SnapshotDecoder, SnapshotEncoder, get_update
+
+
+def get_day(timestamp_int: int):
+    """
+    Returns the day of a Time value
+    @param timestamp_int: Time as integer (%Y%m%d%H%M%S)
+    @return: day as integer (%Y%m%d)
+    """
+    return timestamp_int // 1000000
+
+
+class StatePartitions:
+    """
+    StatePartitions routes snapshots to per-day collections named <collection>_YYYYMMDD
+    Writers get the collection of the day of a snapshot, readers get only the collections a time window touches and
+    retention drops whole collections instead of deleting documents
+    When partitioning is disabled every snapshot goes to the single collection
+    The indexes of a collection are created the first time the collection is used. The listed days are kept for
+    days_max_age seconds, they are listed again earlier when a window reaches past the last known day
+    """
+    def __init__(self,
+                 database: Database,
+                 collection: str,
+                 partition_by_day: bool = True,
+                 indexes: list = None,
+                 days_max_age: float = 10.0):
+        """
+        Constructor
+        @param database: the database
+        @param collection: name of the single collection, also the prefix of the day collections
+        @param partition_by_day: store snapshots in per-day collections
+        @param indexes: keys of the indexes of every collection as accepted by create_index, None indexes Time
+        @param days_max_age: seconds the listed days are kept, 0 lists the days on every call
+        """
+        self.database = database
+        self.collection = collection
+        self.partition_by_day = partition_by_day
+        self.indexes = indexes if indexes is not None else ['Time']
+        self.pattern = re.compile('^%s_(\\d{8})$' % re.escape(collection))
+        self.indexed = set()
+        self.days_max_age = days_max_age
+        self.days = None
+        self.days_listed = 0.0
+
+    def get_name(self, day: int):
+        """
+        Returns the name of the collection of a day
+        """
+        if not self.partition_by_day:
+            return self.collection
+        return '%s_%08i' % (self.collection, day)
+
+    def _get(self, name: str):
+        collection = self.database[name]
+        if name not in self.indexed:
+            for keys in self.indexes:
+                collection.create_index(keys)
+            self.indexed.add(name)
+
+            # Creating the index creates the collection, add its day to the listed days
+            match = self.pattern.match(name)
+            days = self.days
+            if match is not None and days is not None and int(match.group(1)) not in days:
+                days = list(days)
+                bisect.insort(days, int(match.group(1)))
+                self.days = days
+        return collection
+
+    def get_collection(self, timestamp_int: int):
+        """
+        Returns the collection a snapshot is stored in
+        @param timestamp_int: Time of the snapshot as integer
+        @return: the collection
+        """
+        return self.get_day_collection(get_day(timestamp_int))
+
+    def get_day_collection(self, day: int):
+        """
+        Returns the collection of a day
+        @param day: day as integer (%Y%m%d)
+        @return: the collection
+        """
+        return self._get(self.get_name(day))
+
+    def list_days(self, refresh: bool = False):
+        """
+        Returns the days having a collection, ascending
+        @param refresh: list the days again even if the listed days are not older than days_max_age
+        """
+        days = self.days
+        now = time.monotonic()
+        if refresh or days is None or now - self.days_listed > self.days_max_age:
+            days = []
+            for name in self.database.list_collection_names():
+                match = self.pattern.match(name)
+                if match is not None:
+                    days.append(int(match.group(1)))
+            days.sort()
+            self.days = days
+            self.days_listed = now
+        return list(days)
+
+    def get_days(self, begin: int = None, end: int = None, descending: bool = False):
+        """
+        Returns the days having a collection holding snapshots between begin and end
+        @param begin: begin Time as integer, None for no lower bound
+        @param end: end Time as integer, None for no upper bound
+        @param descending: latest day first
+        @return: list of days as integer (%Y%m%d)
+        """
+        days = self.list_days()
+        if end is not None and (len(days) == 0 or get_day(end) > days[-1]):
+            # The window reaches past the last known day, another process may have started a new day
+            days = self.list_days(refresh=True)
+        days = [day for day in days
+                if (begin is None or day >= get_day(begin)) and (end is None or day <= get_day(end))]
+        if descending:
+            days.reverse()
+        return days
+
+    def get_collections(self, begin: int = None, end: int = None, descending: bool = False):
+        """
+        Returns the existing collections holding snapshots between begin and end
+        @param begin: begin Time as integer, None for no lower bound
+        @param end: end Time as integer, None for no upper bound
+        @param descending: latest collection first
+        @return: list of collections
+        """
+        if not self.partition_by_day:
+            return [self._get(self.collection)]
+        return [self._get(self.get_name(day)) for day in self.get_days(begin, end, descending)]
+
+    def get_first_time(self):
+        """
+        Returns the Time of the oldest stored snapshot, None if there are none
+        """
+        for collection in self.get_collections():
+            document = collection.find_one({}, projection={'Time': 1}, sort=[('Time', 1)])
+            if document is not None:
+                return document['Time']
+        return None
+
+    def drop_older_than(self, timestamp_int: int):
+        """
+        Drops the collections of all days before the day of timestamp_int
+        @param timestamp_int: Time as integer
+        @return: names of the dropped collections
+        """
+        dropped = []
+        for day in self.list_days():
+            if day < get_day(timestamp_int):
+                name = self.get_name(day)
+                logging.info('Dropping states collection %s' % name)
+                self.database.drop_collection(name)
+                self.indexed.discard(name)
+                dropped.append(name)
+        self.days = None
+        return dropped
+
+    def migrate(self, source: str, batch_size: int = 1000, keyframe_interval: int = 30):
+        """
+        Copies all snapshots of a single collection into the day collections, snapshots are re-encoded so every day
+        collection starts with a keyframe. Copying again overwrites, the source collection is left untouched
+        @param source: name of the single collection
+        @param batch_size: amount of snapshots per bulk write
+        @param keyframe_interval: every keyframe_interval-th snapshot is stored in full
+        @return: amount of copied snapshots
+        """
+        if not self.partition_by_day:
+            raise Exception('Partitioning by day is disabled')
+
+        decoder = SnapshotDecoder()
+        encoder = SnapshotEncoder(keyframe_interval=keyframe_interval)
+        copied = 0
+        day = None
+        requests = []
+        for document in self.database[source].find({}).sort([('Time', 1)]).allow_disk_use(True):
+            states = decoder.decode(document)
+            if states is None:
+                continue
+
+            # A new day starts a new collection with a keyframe
+            timestamp_int = document['Time']
+            if get_day(timestamp_int) != day:
+                if len(requests) > 0:
+                    self.get_day_collection(day).bulk_write(requests, ordered=True)
+                    requests = []
+                day = get_day(timestamp_int)
+                encoder.reset()
+
+            name, value = encoder.encode(states, timestamp_int)
+            requests.append(UpdateOne({'Time': timestamp_int}, get_update(name, value), upsert=True))
+            copied += 1
+            if len(requests) >= batch_size:
+                self.get_day_collection(day).bulk_write(requests, ordered=True)
+                requests = []
+
+        if len(requests) > 0:
+            self.get_day_collection(day).bulk_write(requests, ordered=True)
+        return copied
+
+
+# Partitions of this process by configuration, so indexes are created and days are listed once per process instead of
+# once per query
+_partitions = {}
+_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    """
+    A forked child keeps the partitions of its parent, the collections known to be indexed stay indexed, but must not
+    use the database of the client of its parent, the partitions are bound to the client of the child on next use
+    """
+    global _lock
+    _lock = threading.Lock()
+    for partitions in _partitions.values():
+        partitions.database = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _get_partitions(config: MongoDBConfiguration, collection: str, indexes: list = None):
+    """
+    Returns the partitions of a collection of given configuration shared by this process using the shared MongoDB client
+    """
+    key = (config.host, config.port, config.database, collection, config.partition_by_day)
+    with _lock:
+        partitions = _partitions.get(key)
+        if partitions is None:
+            partitions = StatePartitions(get_mongo_client(config)[config.database],
+                                         collection,
+                                         partition_by_day=config.partition_by_day,
+                                         indexes=indexes)
+            _partitions[key] = partitions
+        elif partitions.database is None:
+            partitions.database = get_mongo_client(config)[config.database]
+    return partitions
+
+
+def get_state_partitions(config: MongoDBConfiguration):
+    """
+    Returns the state partitions of given configuration using the shared MongoDB client, shared by this process
+    """
+    return _get_partitions(config, config.collection)
+
+
+def get_position_partitions(config: MongoDBConfiguration):
+    """
+    Returns the partitions of the position index of given configuration, collections are named <collection>_positions
+    and carry a compound (cell, Time) index, shared by this process
+    """
+    return _get_partitions(config, config.collection + '_positions', indexes=[[('cell', 1), ('Time', 1)], 'Time'])
@@ -0,0 +1,192 @@
+import bisect
+from ovm.coldstorage import ColdStorage
+from ovm.memory import get_memory_ceiling
+from ovm.statestore import StateStore
+
+
+class SnapshotWindow:
+    """
+    Consecutive snapshots read in a single scan, see StateReader.read_window
+    """
+    def __init__(self, snapshots: list, at_first: bool, at_last: bool):
+        """
+        Constructor
+        @param snapshots: consecutive Time, states tuples in order of Time
+        @param at_first: the window begins at the first stored snapshot
+        @param at_last: the window ends at the last stored snapshot
+        """
+        self.snapshots = snapshots
+        self.times = [snapshot[0] for snapshot in snapshots]
+        self.at_first = at_first
+        self.at_last = at_last
+
+    def get_before(self, timestamp_int: int, limit: int):
+        """
+        Returns up to limit snapshots at or before timestamp_int, latest first, None if the window doesn't hold them
+        """
+        if (len(self.times) == 0 or timestamp_int > self.times[-1]) and not self.at_last:
+            return None
+        idx = bisect.bisect_right(self.times, timestamp_int)
+        if idx < limit and not self.at_first:
+            return None
+        snapshots = self.snapshots[max(0, idx - limit):idx]
+        snapshots.reverse()
+        return snapshots
+
+    def get_after(self, timestamp_int: int, limit: int):
+        """
+        Returns up to limit snapshots at or after timestamp_int, earliest first, None if the window doesn't hold them
+        """
+        if (len(self.times) == 0 or timestamp_int < self.times[0]) and not self.at_first:
+            return None
+        idx = bisect.bisect_left(self.times, timestamp_int)
+        if idx + limit > len(self.times) and not self.at_last:
+            return None
+        return self.snapshots[idx:idx + limit]
+
+
+class StateReader:
+    """
+    The StateReader scans snapshots from a state store in order of Time
+    With cold storage, snapshots older than the oldest snapshot in the state store are read from cold storage
+    The snapshots around trajectories are read into a window, so the trajectories of flights close in time share a
+    single scan and decode instead of reading from the last keyframe for every flight. A window can be bounded in
+    size, flights further apart share consecutive windows, only one window is held at a time
+    """
+    def __init__(self, store: StateStore, cold_storage: ColdStorage = None):
+        """
+        Constructor
+        @param store: the state store
+        @param cold_storage: cold storage of days past the retention period, None reads the state store only
+        """
+        self.store = store
+        self.cold_storage = cold_storage
+        self.live_begin = None
+        self.live_begin_known = False
+        self.window = None
+
+    def _get_live_begin(self):
+        """
+        Returns the Time of the oldest snapshot in the state store, looked up once per reader
+        """
+        if not self.live_begin_known:
+            self.live_begin = self.store.get_first_time()
+            self.live_begin_known = True
+        return self.live_begin
+
+    def _scan_cold_storage(self, begin: int, end: int, bbox: tuple, max_altitude: float):
+        if self.cold_storage is None:
+            return
+        live_begin = self._get_live_begin()
+        if live_begin is not None:
+            if begin >= live_begin:
+                return
+            end = live_begin - 1 if end is None else min(end, live_begin - 1)
+        yield from self.cold_storage.scan(begin, end, bbox=bbox, max_altitude=max_altitude)
+
+    def _scan(self, begin: int, end: int, bbox: tuple, max_altitude: float):
+        yield from self._scan_cold_storage(begin, end, bbox, max_altitude)
+        yield from self.store.scan(begin, end, bbox=bbox, max_altitude=max_altitude)
+
+    def scan(self, begin: int, end: int = None, limit: int = 0, bbox: tuple = None, max_altitude: float = None):
+        """
+        Generator yielding snapshots between begin and end in order of Time
+        bbox and max_altitude allow skipping states that are not needed, states outside may still be yielded but every
+        snapshot in the window is
+        @param begin: begin Time as integer (%Y%m%d%H%M%S), inclusive
+        @param end: end Time as integer, inclusive, None scans until the last snapshot
+        @param limit: maximum amount of snapshots, 0 means no limit
+        @param bbox: states of interest are within (lat_min, lat_max, lon_min, lon_max)
+        @param max_altitude: states of interest are below this altitude in meters
+        @return: yields Time, states tuples
+        """
+        count = 0
+        for snapshot in self._scan(begin, end, bbox, max_altitude):
+            yield snapshot
+            count += 1
+            if count == limit:
+                return
+
+    def _get_times_before(self, timestamp_int: int, limit: int):
+        """
+        Returns the Time of up to limit snapshots at or before timestamp_int, latest first
+        """
+        times = self.store.get_times_before(timestamp_int, limit)
+        if len(times) < limit and self.cold_storage is not None:
+            live_begin = self._get_live_begin()
+            cold_end = timestamp_int if live_begin is None else min(timestamp_int, live_begin - 1)
+            times.extend(self.cold_storage.get_times_before(cold_end, limit - len(times)))
+        return times
+
+    def read_window(self, first: int, last: int, limit: int, max_snapshots: int = 0):
+        """
+        Reads the snapshots from limit snapshots before first up to limit snapshots after last in a single scan,
+        scan_before and scan_after of timestamps between first and last are served from this window afterwards
+        The memory ceiling is checked while reading
+        @param first: first Time as integer
+        @param last: last Time as integer
+        @param limit: amount of snapshots before first and after last
+        @param max_snapshots: the window ends early once it holds this amount of snapshots and the snapshots around
+        first, 0 means no limit
+        """
+        # Release the current window before reading the next one
+        self.window = None
+        ceiling = get_memory_ceiling()
+        times = self._get_times_before(first, limit)
+        snapshots = []
+        after_first = 0
+        after_last = 0
+        at_last = True
+        for snapshot in self.scan(times[-1] if len(times) > 0 else first):
+            ceiling.check()
+            snapshots.append(snapshot)
+            if snapshot[0] >= first:
+                after_first += 1
+            if snapshot[0] >= last:
+                after_last += 1
+            if after_last >= limit or (0 < max_snapshots <= len(snapshots) and after_first >= limit):
+                at_last = False
+                break
+        self.window = SnapshotWindow(snapshots, len(times) < limit, at_last)
+
+    def read_window_around(self, timestamp_int: int, last: int, limit: int, max_snapshots: int):
+        """
+        Reads a window from timestamp_int towards last unless the current window holds the limit snapshots before and
+        after timestamp_int, timestamps passed in order of Time share windows of at most about max_snapshots snapshots
+        @param timestamp_int: Time as integer
+        @param last: last Time as integer the window may reach
+        @param limit: amount of snapshots before and after timestamp_int
+        @param max_snapshots: maximum amount of snapshots of a window
+        """
+        if self.window is not None and self.window.get_before(timestamp_int, limit) is not None and \
+                self.window.get_after(timestamp_int, limit) is not None:
+            return
+        self.read_window(timestamp_int, max(timestamp_int, last), limit, max_snapshots=max_snapshots)
+
+    def scan_before(self, timestamp_int: int, limit: int):
+        """
+        Returns up to limit snapshots at or before timestamp_int, reads a window around timestamp_int unless the
+        current window holds them
+        @param timestamp_int: Time as integer
+        @param limit: maximum amount of snapshots
+        @return: list of Time, states tuples, latest first
+        """
+        snapshots = self.window.get_before(timestamp_int, limit) if self.window is not None else None
+        if snapshots is None:
+            self.read_window(timestamp_int, timestamp_int, limit)
+            snapshots = self.window.get_before(timestamp_int, limit)
+        return snapshots if snapshots is not None else []
+
+    def scan_after(self, timestamp_int: int, limit: int):
+        """
+        Returns up to limit snapshots at or after timestamp_int, reads a window around timestamp_int unless the
+        current window holds them
+        @param timestamp_int: Time as integer
+        @param limit: maximum amount of snapshots
+        @return: list of Time, states tuples, earliest first
+        """
+        snapshots = self.window.get_after(timestamp_int, limit) if self.window is not None else None
+        if snapshots is None:
+            self.read_window(timestamp_int, timestamp_int, limit)
+            snapshots = self.window.get_after(timestamp_int, limit)
+        return snapshots if snapshots is not None else []
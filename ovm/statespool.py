@@ -0,0 +1,190 @@
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+import msgpack
+from ovm.statestore import StateStore
+
+"""
+Binary layout of a spool record
+header: payload length (uint32), crc32 of payload (uint32)
+payload: MessagePack encoded [key, states]
+"""
+RECORD_HEADER = struct.Struct('<II')
+
+
+class StateSpool:
+    """
+    The StateSpool is a local append-only write-ahead file for snapshots that could not be written into the database
+    Replaying moves the spool aside first, so new snapshots can be appended while the old ones are replayed. The moved
+    spool is removed once all its snapshots are written, a failed replay is retried from the start of the moved spool
+    Corrupt records are skipped and counted. A replayed spool that held corrupt or unreadable records is kept as
+    <filename>.<time>.corrupt instead of being removed, so records past a damaged header can still be recovered
+    Snapshots are replayed as unordered writes replacing snapshots with the same Time, so replaying the same snapshot
+    twice is harmless
+    """
+    def __init__(self, filename: str, fsync: bool = False):
+        """
+        Constructor
+        @param filename: the spool file, created on first append
+        @param fsync: fsync after every append, survives power loss at the cost of append latency
+        """
+        self.filename = filename
+        self.replay_filename = filename + '.replay'
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.file = None
+
+        # Statistics
+        self.appended = 0
+        self.replayed = 0
+        self.replay_errors = 0
+        self.dropped = 0
+        self.quarantined = 0
+        self.replay_seconds_last = 0.0
+
+    def prepare_log(self, message: str):
+        return self.__class__.__name__ + ': ' + message
+
+    def append(self, key: int, states: list):
+        """
+        Appends a snapshot to the spool
+        @param key: Time value of the snapshot
+        @param states: the states
+        """
+        payload = msgpack.packb([key, states], use_bin_type=True)
+        record = RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.filename, 'ab')
+            self.file.write(record)
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+            self.appended += 1
+
+    def get_size(self):
+        """
+        Returns the amount of bytes waiting to be replayed
+        """
+        size = 0
+        for filename in (self.filename, self.replay_filename):
+            if os.path.exists(filename):
+                size += os.path.getsize(filename)
+        return size
+
+    @staticmethod
+    def read(filename: str, damage: dict = None):
+        """
+        Generator reading the snapshots of a spool file in order of appending
+        A record failing its checksum or decoding is skipped, reading continues at the next record. Reading stops at a
+        torn record, for example when the process died halfway an append, or at a header pointing past the end of the
+        file, the remainder can't be read
+        @param filename: the spool file
+        @param damage: dictionary receiving the amount of skipped records as corrupt and the amount of bytes that
+        couldn't be read as unreadable_bytes
+        @return: yields key, states tuples
+        """
+        if damage is None:
+            damage = {}
+        damage['corrupt'] = 0
+        damage['unreadable_bytes'] = 0
+        with open(filename, 'rb') as fh:
+            while True:
+                offset = fh.tell()
+                header = fh.read(RECORD_HEADER.size)
+                if len(header) == 0:
+                    return
+                payload = None
+                if len(header) == RECORD_HEADER.size:
+                    length, crc = RECORD_HEADER.unpack(header)
+                    payload = fh.read(length)
+                if payload is None or len(payload) < length:
+                    damage['unreadable_bytes'] = os.path.getsize(filename) - offset
+                    logging.warning('StateSpool: Torn record at offset %i in %s, ignoring remaining %i bytes' %
+                                    (offset, filename, damage['unreadable_bytes']))
+                    return
+                if zlib.crc32(payload) != crc:
+                    damage['corrupt'] += 1
+                    logging.warning('StateSpool: Corrupt record at offset %i in %s, skipping it' % (offset, filename))
+                    continue
+                try:
+                    key, states = msgpack.unpackb(payload, raw=False)
+                except Exception:
+                    damage['corrupt'] += 1
+                    logging.warning('StateSpool: Undecodable record at offset %i in %s, skipping it' %
+                                    (offset, filename))
+                    continue
+                yield key, states
+
+    def replay(self, store: StateStore, batch_size: int = 1000):
+        """
+        Writes all spooled snapshots into the state store in writes of up to batch_size snapshots
+        @param store: the state store
+        @param batch_size: amount of snapshots per write
+        @return: amount of replayed snapshots, raises exception when writing fails
+        """
+        # Move the spool aside unless a previous replay failed, appending continues in a new spool file
+        with self.lock:
+            if not os.path.exists(self.replay_filename):
+                if not os.path.exists(self.filename):
+                    return 0
+                if self.file is not None:
+                    self.file.close()
+                    self.file = None
+                os.replace(self.filename, self.replay_filename)
+
+        begin = time.perf_counter()
+        replayed = 0
+        snapshots = []
+        damage = {}
+        try:
+            for key, states in StateSpool.read(self.replay_filename, damage):
+                snapshots.append((key, states))
+                if len(snapshots) >= batch_size:
+                    store.write_unordered(snapshots)
+                    replayed += len(snapshots)
+                    snapshots = []
+            if len(snapshots) > 0:
+                store.write_unordered(snapshots)
+                replayed += len(snapshots)
+        except Exception:
+            self.replay_errors += 1
+            raise
+        finally:
+            self.replayed += replayed
+
+        # Everything readable is written, truncate the spool by removing the replayed file, a damaged file is kept aside
+        if damage['corrupt'] > 0 or damage['unreadable_bytes'] > 0:
+            quarantine_filename = '%s.%i.corrupt' % (self.filename, time.time())
+            os.replace(self.replay_filename, quarantine_filename)
+            self.dropped += damage['corrupt']
+            self.quarantined += 1
+            logging.error(self.prepare_log('Dropped %i corrupt records and %i unreadable bytes, kept the spool as %s' %
+                                           (damage['corrupt'], damage['unreadable_bytes'], quarantine_filename)))
+        else:
+            os.remove(self.replay_filename)
+        self.replay_seconds_last = time.perf_counter() - begin
+        logging.info(self.prepare_log('Replayed %i snapshots in %f seconds' % (replayed, self.replay_seconds_last)))
+        return replayed
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def get_stats(self):
+        """
+        Returns append and replay statistics
+        @return: dictionary holding the statistics
+        """
+        return {'spool_bytes': self.get_size(),
+                'spool_appended': self.appended,
+                'spool_replayed': self.replayed,
+                'spool_replay_errors': self.replay_errors,
+                'spool_dropped': self.dropped,
+                'spool_quarantined': self.quarantined,
+                'spool_replay_seconds_last': self.replay_seconds_last}
@@ -0,0 +1,186 @@
+import abc
+import os
+import threading
+from ovm.environment import Environment
+
+"""
+Properties of a state every store keeps, stores with a fixed schema keep only these
+"""
+STATE_COLUMNS = ['callsign', 'icao24', 'latitude', 'longitude', 'geo_altitude']
+
+
+class StateStore(abc.ABC):
+    """
+    A StateStore stores snapshots of states by Time, an integer in the format %Y%m%d%H%M%S, and scans them in order
+    of Time
+    write and reset are called from a single writer thread, write_unordered may be called concurrently from another
+    thread. Scans may run in any thread or process
+    Backends implement every abstract method, a backend missing one can't be instantiated
+    """
+    @abc.abstractmethod
+    def write(self, snapshots: list):
+        """
+        Writes snapshots following the previously written snapshots, raises exception when writing fails
+        Writing a snapshot with an existing Time replaces it
+        @param snapshots: list of Time, states tuples in order of Time
+        """
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def write_unordered(self, snapshots: list):
+        """
+        Writes snapshots that don't follow the previously written snapshots, for example replayed from a spool
+        Writing a snapshot with an existing Time replaces it, raises exception when writing fails
+        @param snapshots: list of Time, states tuples in order of Time
+        """
+        raise NotImplementedError()
+
+    def reset(self):
+        """
+        Tells the store the next written snapshot doesn't follow the previously written ones
+        """
+        pass
+
+    @abc.abstractmethod
+    def scan(self, begin: int, end: int = None, bbox: tuple = None, max_altitude: float = None):
+        """
+        Generator yielding snapshots between begin and end in order of Time
+        bbox and max_altitude allow a store to skip states that are not needed, states outside may still be yielded but
+        every snapshot in the window is
+        @param begin: begin Time as integer, inclusive
+        @param end: end Time as integer, inclusive, None scans until the last snapshot
+        @param bbox: states of interest are within (lat_min, lat_max, lon_min, lon_max)
+        @param max_altitude: states of interest are below this altitude in meters
+        @return: yields Time, states tuples
+        """
+        raise NotImplementedError()
+
+    def explain(self,
+                begin: int,
+                end: int = None,
+                bbox: tuple = None,
+                max_altitude: float = None,
+                execution_stats: bool = False):
+        """
+        Returns the query plans of the range queries of a scan, as reported by the backend
+        Without execution_stats the queries are only planned, with execution_stats they run once more
+        @param begin: begin Time as integer, inclusive
+        @param end: end Time as integer, inclusive, None scans until the last snapshot
+        @param bbox: states of interest are within (lat_min, lat_max, lon_min, lon_max)
+        @param max_altitude: states of interest are below this altitude in meters
+        @param execution_stats: run the queries and include their execution statistics
+        @return: list of plans as dictionary, one per range query, None if the store can't explain its scans
+        """
+        return None
+
+    def get_documents_fetched(self):
+        """
+        Returns the amount of documents the scans of this store fetched from the backend in this process so far, so the
+        documents fetched by a scan are the difference before and after it. None if the store doesn't count them
+        """
+        return None
+
+    @abc.abstractmethod
+    def get_times_before(self, timestamp_int: int, limit: int):
+        """
+        Returns the Times of up to limit snapshots at or before timestamp_int
+        @param timestamp_int: Time as integer
+        @param limit: maximum amount of Times
+        @return: list of Times, latest first
+        """
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def get_first_time(self):
+        """
+        Returns the Time of the oldest stored snapshot, None if there are none
+        """
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def remove_older_than(self, timestamp_int: int):
+        """
+        Removes snapshots before timestamp_int, a store may keep older snapshots it needs to reconstruct newer ones
+        @param timestamp_int: Time as integer
+        """
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def remove_newer_than(self, timestamp_int: int):
+        """
+        Removes snapshots at or after timestamp_int
+        @param timestamp_int: Time as integer
+        """
+        raise NotImplementedError()
+
+    def get_stats(self):
+        """
+        Returns statistics of the store
+        @return: dictionary holding the statistics
+        """
+        return {}
+
+    def close(self):
+        pass
+
+
+# State stores of this process by configuration, see get_state_store
+_stores = {}
+_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    """
+    A forked child keeps the stores of its parent, they open their own connections, only the lock is recreated
+    """
+    global _lock
+    _lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _get_store(key: tuple, create):
+    """
+    Returns the store of this process under key, created using create on first use
+    """
+    with _lock:
+        store = _stores.get(key)
+        if store is None:
+            store = create()
+            _stores[key] = store
+    return store
+
+
+def get_state_store(environment: Environment, keyframe_interval: int = 30, max_time_ms: int = None):
+    """
+    Returns the state store configured in environment, shared by this process
+    A store is created once per configuration, keyframe_interval and max_time_ms, so schemas and indexes are created
+    and connections are opened once per process instead of once per query
+    @param environment: the environment
+    @param keyframe_interval: every keyframe_interval-th snapshot is stored in full by stores encoding deltas
+    @param max_time_ms: time limit of every scan query in milliseconds by stores supporting it, None for no limit
+    @return: the state store
+    """
+    config = environment.state_store
+    if config.backend == 'mongodb':
+        if environment.mongodb_config is None:
+            raise Exception('The mongodb state store requires mongodb_config')
+        from ovm.mongostatestore import MongoStateStore
+        from ovm.statepartitions import get_position_partitions, get_state_partitions
+        mongodb_config = environment.mongodb_config
+
+        # The partitions are shared by this process as well, getting them binds them to the client of this process
+        partitions = get_state_partitions(mongodb_config)
+        positions = get_position_partitions(mongodb_config) if mongodb_config.spatial_index else None
+        return _get_store(('mongodb', id(partitions), id(positions), mongodb_config.spatial_cell_size,
+                           keyframe_interval, max_time_ms),
+                          lambda: MongoStateStore(partitions,
+                                                  keyframe_interval=keyframe_interval,
+                                                  positions=positions,
+                                                  cell_size=mongodb_config.spatial_cell_size,
+                                                  max_time_ms=max_time_ms))
+    if config.backend == 'sqlite':
+        from ovm.sqlitestatestore import SqliteStateStore
+        return _get_store(('sqlite', os.path.abspath(config.filename)), lambda: SqliteStateStore(config.filename))
+    raise Exception('Unknown state store backend %s' % config.backend)
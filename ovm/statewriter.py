@@ -0,0 +1,269 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from ovm.metrics import get_metrics
+from ovm.statespool import StateSpool
+from ovm.statestore import StateStore
+
+
+@dataclass
+class Snapshot:
+    """
+    States obtained in a single poll, key is the Time value of the document
+    """
+    key: int
+    states: list
+    fetched: float
+
+
+class StateWriter:
+    """
+    The StateWriter is the storage stage of the ingest pipeline
+    Snapshots are submitted by the fetch stage into a bounded queue, a background thread writes them into the state
+    store in batches, so a slow database never delays the next poll
+    Snapshots with the same key are coalesced while waiting, the latest states win
+    When the queue is full the fetch stage is blocked for at most backpressure_timeout seconds, after that the oldest
+    waiting snapshot is moved to the spool, or dropped when there is no spool
+    Snapshots that fail to be written are moved to the spool as well, a background thread replays the spool into the
+    state store every replay_interval seconds. The state store is reset after snapshots are moved to the spool, the
+    next written snapshot doesn't follow the previously written one
+    """
+    def __init__(self,
+                 store: StateStore,
+                 max_pending: int = 64,
+                 batch_size: int = 16,
+                 batch_wait: float = 0.5,
+                 backpressure_timeout: float = 1.0,
+                 spool: StateSpool = None,
+                 replay_interval: float = 30.0):
+        """
+        Constructor, starts the writer thread
+        @param store: the state store
+        @param max_pending: maximum amount of snapshots waiting to be written
+        @param batch_size: maximum amount of snapshots written at once
+        @param batch_wait: seconds to wait for more snapshots before writing an incomplete batch
+        @param backpressure_timeout: seconds submit blocks when the queue is full
+        @param spool: write-ahead spool for snapshots that could not be written, None drops them
+        @param replay_interval: seconds between attempts to replay the spool
+        """
+        self.store = store
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.backpressure_timeout = backpressure_timeout
+        self.spool = spool
+        self.replay_interval = replay_interval
+        self.force_reset = False
+
+        self.pending = OrderedDict()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.writing = False
+
+        # Statistics
+        self.submitted = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.spooled = 0
+        self.written = 0
+        self.batches = 0
+        self.write_errors = 0
+        self.max_queue_depth = 0
+        self.write_seconds_last = 0.0
+        self.write_seconds_max = 0.0
+        self.write_seconds_total = 0.0
+        self.lag_seconds_last = 0.0
+        self.lag_seconds_max = 0.0
+
+        self.thread = threading.Thread(target=self._run, name='StateWriter', daemon=True)
+        self.thread.start()
+
+        self.stop_replay = threading.Event()
+        self.replay_thread = None
+        if self.spool is not None:
+            self.replay_thread = threading.Thread(target=self._run_replay, name='StateSpoolReplay', daemon=True)
+            self.replay_thread.start()
+
+    def prepare_log(self, message: str):
+        return self.__class__.__name__ + ': ' + message
+
+    def submit(self, key: int, states: list):
+        """
+        Submits a snapshot for writing, blocks at most backpressure_timeout seconds when the queue is full
+        @param key: Time value of the snapshot
+        @param states: the states
+        @return: True if the snapshot is queued without dropping another one
+        """
+        snapshot = Snapshot(key=key, states=states, fetched=time.time())
+        with self.condition:
+            self.submitted += 1
+            if key in self.pending:
+                self.pending[key] = snapshot
+                self.coalesced += 1
+                return True
+
+            queued = self.condition.wait_for(lambda: len(self.pending) < self.max_pending or self.closed,
+                                             timeout=self.backpressure_timeout)
+            if not queued:
+                oldest = self.pending.popitem(last=False)[1]
+                self._overflow([oldest], 'Storage is behind')
+
+            self.pending[key] = snapshot
+            self.max_queue_depth = max(self.max_queue_depth, len(self.pending))
+            get_metrics().set('omd_ingest_queue_depth', len(self.pending))
+            self.condition.notify_all()
+            return queued
+
+    def _overflow(self, snapshots: list, reason: str):
+        """
+        Moves snapshots that can't be written now to the spool, drops them when there is no spool or spooling fails
+        The state store is reset before the next write, spooled snapshots are replayed in between later
+        @param snapshots: list of snapshots
+        @param reason: reason logged
+        """
+        self.force_reset = True
+        if self.spool is not None:
+            try:
+                for snapshot in snapshots:
+                    self.spool.append(snapshot.key, snapshot.states)
+                self.spooled += len(snapshots)
+                logging.warning(self.prepare_log('%s, spooled %i snapshots' % (reason, len(snapshots))))
+                return
+            except Exception as ex:
+                logging.exception(ex)
+        self.dropped += len(snapshots)
+        logging.warning(self.prepare_log('%s, dropped %i snapshots' % (reason, len(snapshots))))
+
+    def flush(self, timeout: float = None):
+        """
+        Waits until all waiting snapshots are written
+        @param timeout: seconds to wait, None waits forever
+        @return: True if the queue is empty
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: len(self.pending) == 0 and not self.writing, timeout=timeout)
+
+    def close(self, timeout: float = 30.0):
+        """
+        Writes all waiting snapshots and stops the writer thread
+        @param timeout: seconds to wait for the writer thread
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.stop_replay.set()
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            logging.error(self.prepare_log('Writer thread did not finish, %i snapshots not written' % len(self.pending)))
+        if self.replay_thread is not None:
+            self.replay_thread.join(timeout)
+            self.spool.close()
+
+    def _take_batch(self):
+        """
+        Takes up to batch_size snapshots from the queue, waits at most batch_wait seconds for the batch to fill
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.pending) > 0 or self.closed)
+            if len(self.pending) == 0:
+                return None
+
+            deadline = time.monotonic() + self.batch_wait
+            while len(self.pending) < self.batch_size and not self.closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.condition.wait(remaining):
+                    break
+
+            if self.force_reset:
+                self.store.reset()
+                self.force_reset = False
+
+            batch = []
+            while len(self.pending) > 0 and len(batch) < self.batch_size:
+                batch.append(self.pending.popitem(last=False)[1])
+            self.writing = True
+            self.condition.notify_all()
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if batch is None:
+                return
+
+            try:
+                self._write(batch)
+            finally:
+                with self.condition:
+                    self.writing = False
+                    self.condition.notify_all()
+
+    def _run_replay(self):
+        # Replay what is left from a previous run right away, after that every replay_interval seconds
+        while True:
+            if self.spool.get_size() > 0:
+                try:
+                    self.spool.replay(self.store)
+                except Exception as ex:
+                    logging.error(self.prepare_log('Failed to replay spool, retrying in %f seconds' %
+                                                   self.replay_interval))
+                    logging.exception(ex)
+            if self.stop_replay.wait(self.replay_interval):
+                return
+
+    def _write(self, batch: list):
+        """
+        Writes a batch of snapshots into the state store, moves the batch to the spool on failure
+        @param batch: list of snapshots
+        @return: True on success
+        """
+        begin = time.perf_counter()
+        try:
+            self.store.write([(snapshot.key, snapshot.states) for snapshot in batch])
+        except Exception as ex:
+            self.write_errors += 1
+            logging.exception(ex)
+            self._overflow(batch, 'Failed to write')
+            return False
+
+        elapsed = time.perf_counter() - begin
+        lag = time.time() - batch[0].fetched
+        self.batches += 1
+        self.written += len(batch)
+        self.write_seconds_last = elapsed
+        self.write_seconds_max = max(self.write_seconds_max, elapsed)
+        self.write_seconds_total += elapsed
+        self.lag_seconds_last = lag
+        self.lag_seconds_max = max(self.lag_seconds_max, lag)
+        get_metrics().observe('omd_ingest_write_seconds', elapsed)
+        get_metrics().observe('omd_ingest_lag_seconds', lag)
+        get_metrics().set('omd_ingest_queue_depth', len(self.pending))
+        logging.info(self.prepare_log('Wrote %i snapshots in %f seconds, lag %f seconds' % (len(batch), elapsed, lag)))
+        return True
+
+    def get_stats(self):
+        """
+        Returns queue depth, write latency, end-to-end lag and compression statistics
+        Lag is the time between obtaining the oldest snapshot of a batch and the batch being written
+        @return: dictionary holding the statistics
+        """
+        stats = {'queue_depth': len(self.pending),
+                 'max_queue_depth': self.max_queue_depth,
+                 'submitted': self.submitted,
+                 'coalesced': self.coalesced,
+                 'dropped': self.dropped,
+                 'spooled': self.spooled,
+                 'written': self.written,
+                 'batches': self.batches,
+                 'write_errors': self.write_errors,
+                 'write_seconds_last': self.write_seconds_last,
+                 'write_seconds_max': self.write_seconds_max,
+                 'write_seconds_total': self.write_seconds_total,
+                 'lag_seconds_last': self.lag_seconds_last,
+                 'lag_seconds_max': self.lag_seconds_max}
+        stats.update(self.store.get_stats())
+        if self.spool is not None:
+            stats.update(self.spool.get_stats())
+        return stats
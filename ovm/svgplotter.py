@@ -0,0 +1,76 @@
+from datetime import datetime
+from xml.sax.saxutils import escape
+from ovm.utils import convert_epsg4326_to_epsg3857
+
+"""
+Colors used for trajectories, cycled when there are more trajectories than colors
+"""
+TRAJECTORY_COLORS = ['#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd',
+                     '#8c564b', '#e377c2', '#7f7f7f', '#bcbd22', '#17becf']
+
+
+def plot_trajectories_svg(origin: tuple,
+                          begin: datetime,
+                          end: datetime,
+                          trajectories: dict,
+                          bbox: tuple,
+                          size: int = 1000):
+    """
+    Plots trajectories into a SVG image without map tiles, clients can draw it on top of their own map.
+    Coordinates are projected to web mercator (EPSG:3857), same as the raster plot.
+    Returns image as bytes
+    @param origin: origin in lat, lon
+    @param begin: beginning of the plot in time
+    @param end: end of the plot in time
+    @param trajectories: all the trajectories to plot, coords ordered (lon, lat)
+    @param bbox: the geographic bounding box (lat_min, lat_max, lon_min, lon_max)
+    @param size: width and height of the image in pixels
+    @return: image in bytes
+    """
+
+    # define lat lon bounding box in web mercator
+    min_3857 = convert_epsg4326_to_epsg3857(bbox[2], bbox[0])
+    max_3857 = convert_epsg4326_to_epsg3857(bbox[3], bbox[1])
+    scale_x = size / (max_3857[0] - min_3857[0])
+    scale_y = size / (max_3857[1] - min_3857[1])
+
+    def project(lon, lat):
+        x, y = convert_epsg4326_to_epsg3857(lon, lat)
+        return (x - min_3857[0]) * scale_x, (max_3857[1] - y) * scale_y
+
+    elements = ['<svg xmlns="http://www.w3.org/2000/svg" width="%i" height="%i" viewBox="0 0 %i %i">' %
+                (size, size, size, size),
+                '<rect x="0" y="0" width="%i" height="%i" fill="none" stroke="blue"/>' % (size, size)]
+
+    # draw trajectories
+    average_altitude = 0
+    idx = 0
+    for key, value in trajectories.items():
+        if len(value.coords) < 2:
+            continue
+        points = ' '.join('%.1f,%.1f' % project(coord[0], coord[1]) for coord in value.coords)
+        elements.append('<polyline points="%s" fill="none" stroke="%s" stroke-opacity="0.6" stroke-width="3">'
+                        '<title>%s</title></polyline>' %
+                        (points, TRAJECTORY_COLORS[idx % len(TRAJECTORY_COLORS)], escape(str(key))))
+        average_altitude += value.average_altitude
+        idx += 1
+    if idx > 0:
+        average_altitude /= idx
+
+    # draw origin
+    origin_x, origin_y = project(origin[1], origin[0])
+    elements.append('<circle cx="%.1f" cy="%.1f" r="8" fill="blue" fill-opacity="0.7"/>' % (origin_x, origin_y))
+
+    # draw meta information
+    lines = ['location: [%f, %f]' % (origin[0], origin[1]),
+             'period: [%s, %s]' % (begin.strftime("%Y-%m-%d %H:%M:%S"), end.strftime("%Y-%m-%d %H:%M:%S")),
+             'flights: %i' % len(trajectories.items()),
+             'average altitude: %im' % average_altitude]
+    text_y = size - 20 * len(lines)
+    elements.append('<text x="20" y="%i" font-family="sans-serif" font-size="15">' % text_y)
+    for line in lines:
+        elements.append('<tspan x="20" dy="18">%s</tspan>' % escape(line))
+    elements.append('</text>')
+    elements.append('</svg>')
+
+    return '\n'.join(elements).encode('utf-8')
@@ -1,13 +1,181 @@
+import math
 from dataclasses import dataclass, field
+from datetime import timedelta
+import numpy
+from ovm.utils import convert_int_to_datetime
+
+# Smallest resample interval in seconds, the Times of coordinates have a resolution of a second
+MIN_RESAMPLE_SECONDS = 1.0
+
+# Maximum amount of coordinates of a resampled trajectory, bounds the work of a single trajectory
+MAX_RESAMPLE_SAMPLES = 100000
+
+# Smallest simplification tolerance in meters, smaller tolerances keep practically every coordinate
+MIN_SIMPLIFY_METERS = 1.0
 
 
 @dataclass
 class Trajectory:
     """
     Trajectory holds a list of lat lon coordinates for a specific callsign together with the average altitude of the trajectory
+    Times optionally holds the int64 timestamp (%Y%m%d%H%M%S) of each coordinate
     """
     callsign: str = field(default_factory=str)
 
     coords: list = field(default_factory=list)
 
-    average_altitude: float = field(default_factory=float)
\ No newline at end of file
+    average_altitude: float = field(default_factory=float)
+
+    times: list = field(default_factory=list)
+
+
+def simplify_indices(coords: list, tolerance: float, lonlat: bool = True):
+    """
+    Computes which coordinates to keep using the Douglas-Peucker algorithm
+    Points are projected onto a local equirectangular plane so the tolerance can be given in meters
+    @param coords: list of coordinates
+    @param tolerance: maximum allowed deviation of the simplified track in meters
+    @param lonlat: True if coordinates are ordered (lon, lat), False if ordered (lat, lon)
+    @return: list of indices of coordinates to keep, first and last coordinate are always kept
+    """
+    if tolerance is None or tolerance <= 0 or len(coords) <= 2:
+        return list(range(len(coords)))
+
+    points = numpy.asarray(coords, dtype=float)
+    if lonlat:
+        lon, lat = points[:, 0], points[:, 1]
+    else:
+        lat, lon = points[:, 0], points[:, 1]
+
+    # Project onto a local plane in meters around the mean latitude
+    r_earth = 6371000.0
+    cos_lat = math.cos(math.radians(float(numpy.mean(lat))))
+    x = numpy.radians(lon) * r_earth * cos_lat
+    y = numpy.radians(lat) * r_earth
+
+    keep = numpy.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+
+    # Iterative Douglas-Peucker, distances of a segment are computed at once
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+
+        dx = x[last] - x[first]
+        dy = y[last] - y[first]
+        px = x[first + 1:last] - x[first]
+        py = y[first + 1:last] - y[first]
+        length = math.hypot(dx, dy)
+        if length == 0:
+            distances = numpy.hypot(px, py)
+        else:
+            distances = numpy.abs(dx * py - dy * px) / length
+
+        index = int(numpy.argmax(distances))
+        if distances[index] > tolerance:
+            split = first + 1 + index
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+
+    return numpy.flatnonzero(keep).tolist()
+
+
+def simplify_coords(coords: list, tolerance: float, lonlat: bool = True):
+    """
+    Simplifies a list of coordinates using the Douglas-Peucker algorithm
+    @param coords: list of coordinates
+    @param tolerance: maximum allowed deviation of the simplified track in meters
+    @param lonlat: True if coordinates are ordered (lon, lat), False if ordered (lat, lon)
+    @return: simplified list of coordinates, first and last coordinate are always kept
+    """
+    return [coords[i] for i in simplify_indices(coords, tolerance, lonlat=lonlat)]
+
+
+def resample_coords(coords: list, times: list, interval: float):
+    """
+    Resamples coordinates to a uniform time interval using linear interpolation
+    @param coords: list of coordinates
+    @param times: int64 timestamp (%Y%m%d%H%M%S) of each coordinate
+    @param interval: interval in seconds
+    @return: resampled coordinates and their int64 timestamps
+    Raises exception if the trajectory would hold more than MAX_RESAMPLE_SAMPLES coordinates
+    """
+    if interval is None or interval <= 0 or len(coords) <= 2 or len(times) != len(coords):
+        return list(coords), list(times)
+
+    # Convert timestamps to seconds, duplicate timestamps are dropped as interpolation needs increasing values
+    datetimes = [convert_int_to_datetime(value) for value in times]
+    seconds = numpy.array([dt.timestamp() for dt in datetimes])
+    order = numpy.argsort(seconds, kind='stable')
+    seconds, unique = numpy.unique(seconds[order], return_index=True)
+    points = numpy.asarray(coords, dtype=float)[order][unique]
+    if len(seconds) <= 2:
+        return list(coords), list(times)
+
+    if (seconds[-1] - seconds[0]) / interval > MAX_RESAMPLE_SAMPLES:
+        raise Exception('Resampling a trajectory of %i seconds every %s seconds exceeds %i coordinates, raise '
+                        'resample' % (seconds[-1] - seconds[0], interval, MAX_RESAMPLE_SAMPLES))
+
+    # Always keep the last coordinate so the trajectory keeps its full length
+    samples = numpy.arange(seconds[0], seconds[-1], interval)
+    samples = numpy.append(samples, seconds[-1])
+    first = numpy.interp(samples, seconds, points[:, 0])
+    second = numpy.interp(samples, seconds, points[:, 1])
+
+    start = datetimes[int(order[0])]
+    resampled_times = [int((start + timedelta(seconds=float(sample - seconds[0]))).strftime("%Y%m%d%H%M%S"))
+                       for sample in samples]
+    return list(zip(first.tolist(), second.tolist())), resampled_times
+
+
+class TrajectoryProcessor:
+    """
+    The TrajectoryProcessor simplifies and/or resamples trajectories before serialization or plotting
+    Keeps count of the amount of points going in and out so the reduction can be reported
+    """
+    def __init__(self, simplify: float = None, resample: float = None):
+        """
+        Constructor
+        @param simplify: simplification tolerance in meters, None or 0 disables simplification
+        @param resample: resample interval in seconds, None or 0 disables resampling
+        """
+        self.simplify = simplify
+        self.resample = resample
+        self.points_in = 0
+        self.points_out = 0
+
+    def process(self, trajectory: Trajectory, lonlat: bool = True):
+        """
+        Resamples and then simplifies coordinates of given trajectory in place
+        @param trajectory: the trajectory
+        @param lonlat: True if coordinates are ordered (lon, lat), False if ordered (lat, lon)
+        @return: the trajectory
+        """
+        self.points_in += len(trajectory.coords)
+
+        if self.resample:
+            trajectory.coords, trajectory.times = resample_coords(trajectory.coords, trajectory.times, self.resample)
+
+        if self.simplify:
+            indices = simplify_indices(trajectory.coords, self.simplify, lonlat=lonlat)
+            if len(trajectory.times) == len(trajectory.coords):
+                trajectory.times = [trajectory.times[i] for i in indices]
+            trajectory.coords = [trajectory.coords[i] for i in indices]
+
+        self.points_out += len(trajectory.coords)
+        return trajectory
+
+    def get_metadata(self):
+        """
+        Returns point counts before and after processing
+        @return: dictionary holding point counts and reduction ratio
+        """
+        reduction = 0.0
+        if self.points_in > 0:
+            reduction = 1.0 - self.points_out / self.points_in
+        return {'points': self.points_in,
+                'points_processed': self.points_out,
+                'points_reduction': round(reduction, 4)}
@@ -4,9 +4,6 @@ import json
 import math
 import string
 
-import numpy
-import pandas as pd
-
 
 def convert_datetime_to_int(dt: datetime):
     """
@@ -85,6 +82,16 @@ def convert_epsg4326_to_epsg3857(lon, lat):
     return lonInEPSG3857, latInEPSG3857
 
 
+def dataclass_to_dict(o):
+    """
+    Shallow conversion of a dataclass into a dictionary
+    Unlike dataclasses.asdict the field values are not deep-copied, nested dataclasses are left to the encoder
+    :param o: the dataclass instance
+    :return: dictionary holding the field values
+    """
+    return {f.name: getattr(o, f.name) for f in dataclasses.fields(o)}
+
+
 class DataclassJSONEncoder(json.JSONEncoder):
     """
     Use this encoder to serialize dataclasses
@@ -92,7 +99,7 @@ class DataclassJSONEncoder(json.JSONEncoder):
 
     def default(self, o):
         if dataclasses.is_dataclass(o):
-            return dataclasses.asdict(o)
+            return dataclass_to_dict(o)
         return super().default(o)
 
 
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+import argparse
+import logging
+from datetime import datetime, timedelta, timezone
+from ovm import environment
+from ovm.slowquerylog import SlowQueryLog, get_slow_query_log
+from ovm.statestore import get_state_store
+
+if __name__ == '__main__':
+    # parse cli arguments
+    parser = argparse.ArgumentParser(description='Reports the worst offenders of the slow query log, scans grouped by '
+                                                 'operation and query plan ordered by their total seconds, requires '
+                                                 'slow_query_log in environment.json')
+    parser.add_argument('-s', '--since',
+                        type=float,
+                        default=24,
+                        help='Report scans of the last amount of hours, 0 reports all recorded scans')
+    parser.add_argument('-o', '--operation',
+                        type=str,
+                        default=None,
+                        help='Report scans of this operation only, find_flights, find_disturbances or get_trajectory')
+    parser.add_argument('-n', '--limit',
+                        type=int,
+                        default=10,
+                        help='Maximum amount of offenders')
+    parser.add_argument('-e', '--explain',
+                        action='store_true',
+                        help='Run the range queries of the slowest scan of every offender once more and report the '
+                             'documents they examine')
+    parser.add_argument('-l', '--loglevel',
+                        type=str.upper,
+                        default='INFO',
+                        help='LOG Level (DEBUG, INFO, WARNING, ERROR, CRITICAL)')
+    args = parser.parse_args()
+
+    # Set log level
+    logging.basicConfig(level=args.loglevel)
+
+    # Load environment
+    environment = environment.load_environment('environment.json')
+    slow_query_log = get_slow_query_log(environment)
+    if slow_query_log is None:
+        raise Exception('The slow query log is not configured, add slow_query_log to environment.json')
+
+    since = datetime.now(timezone.utc) - timedelta(hours=args.since) if args.since > 0 else None
+    report = slow_query_log.get_report(since=since, operation=args.operation, limit=args.limit)
+    if len(report) == 0:
+        logging.info('No scans took %f seconds or more' % slow_query_log.threshold_seconds)
+
+    for rank, offender in enumerate(report, start=1):
+        logging.info('#%i %s, plan %s, index %s' % (rank, offender['operation'], offender['plan'], offender['index']))
+        logging.info('   %i scans, %i failed, %.2f seconds total, %.2f average, %.2f max' %
+                     (offender['count'], offender['errors'], offender['seconds_total'], offender['seconds_average'],
+                      offender['seconds_max']))
+        logging.info('   %i documents fetched, %i snapshots, %i states read, %i hits' %
+                     (offender['documents_fetched'], offender['snapshots'], offender['states'], offender['hits']))
+        logging.info('   stages %s' % ', '.join('%s %.2f' % (stage, seconds) for stage, seconds in
+                                                sorted(offender['stages'].items(), key=lambda item: -item[1])))
+        logging.info('   slowest %s' % offender['slowest'])
+        if args.explain and offender['slowest_scan'] is not None:
+            summary = SlowQueryLog.explain_scan(get_state_store(environment), offender['slowest_scan'])
+            if summary is not None:
+                logging.info('   explained %s over %i partitions, %s keys and %s documents examined for %s returned in '
+                             '%s ms' % (summary['plan'], summary['partitions'], summary['keys_examined'],
+                                        summary['documents_examined'], summary['documents_returned'],
+                                        summary['explain_millis']))
+
+    exit(0)